@@ -49,14 +49,17 @@ import random
 import re
 from collections import deque
 from datetime import datetime, timedelta
+from pathlib import Path
 from typing import Set
 
-import dbus
 from dbus.mainloop.glib import DBusGMainLoop
 
 from autoqueue.blocking import Blocking
 from autoqueue.context import Context
+from autoqueue.features import FEATURES_FILE, FeatureReader
 from autoqueue.request import Requests
+from autoqueue.transport import DBUS, connect
+from autoqueue.utilities import player_get_data_dir
 
 try:
     import pyowm
@@ -174,6 +177,10 @@ class Cache(object):
         self.newly_added = set()
         self.newest_days = 1
         self.newest_high_water_mark = 0
+        # Songs whose album and artists were sent to the similarity service.
+        self.grouped = set()
+        # Written by the similarity service as it analyzes tracks.
+        self.features = FeatureReader(Path(player_get_data_dir()) / FEATURES_FILE)
 
     @property
     def prefer_newly_added(self):
@@ -235,19 +242,13 @@ class AutoQueueBase(object):
 
     """Generic base class for autoqueue plugins."""
 
-    def __init__(self, player):
+    def __init__(self, player, transport=DBUS, socket_path=None):
         self._cache_dir = None
         self.blocking = Blocking()
         self.configuration = Configuration()
         self.context = None
         self.cache = Cache()
-        bus = dbus.SessionBus()
-        sim = bus.get_object(
-            "org.autoqueue", "/org/autoqueue/Similarity", follow_name_owner_changes=True
-        )
-        self.similarity = dbus.Interface(
-            sim, dbus_interface="org.autoqueue.SimilarityInterface"
-        )
+        self.similarity = connect(transport, socket_path, main_loop=True)
         self.has_gaia = self.similarity.has_gaia()
         self.player = player
         self.requests = Requests()
@@ -330,6 +331,7 @@ class AutoQueueBase(object):
         if song is None:
             return
         self.cache.song = song
+        self.set_track_groups([song])
         if self.cache.running:
             return
         if self.configuration.desired_queue_length == 0 or self.queue_needs_songs():
@@ -337,6 +339,42 @@ class AutoQueueBase(object):
         self.blocking.unblock_artists()
         self.pop_request(song)
 
+    @staticmethod
+    def album_key(song):
+        """Identify the album of a song, by musicbrainz id if it has one."""
+        album_id = song.get_musicbrainz_albumid()
+        if album_id:
+            return album_id
+
+        album = song.get_album()
+        if not album or album.lower() in BANNED_ALBUMS:
+            return ""
+
+        return "%s\t%s" % (song.get_album_artist() or "", album)
+
+    def set_track_groups(self, songs):
+        """Let the similarity service count songs towards their albums and artists.
+
+        Songs that were sent before are skipped, and the rest go in one call.
+        """
+        if not self.use_gaia:
+            return
+        tracks = []
+        for song in songs:
+            filename = song.get_filename()
+            if not filename or filename in self.cache.grouped:
+                continue
+            self.cache.grouped.add(filename)
+            tracks.append((filename, self.album_key(song), list(song.get_artists())))
+        if not tracks:
+            return
+        self.similarity.set_track_groups_many(
+            tracks,
+            reply_handler=no_op,
+            error_handler=self.error_handler,
+            timeout=TIMEOUT,
+        )
+
     def pop_request(self, song):
         filename = song.get_filename()
         if self.requests.has(filename):
@@ -572,8 +610,13 @@ class AutoQueueBase(object):
 
     def search_filenames(self, results):
         filenames = [r["filename"] for r in results]
-        search = self.construct_filenames_search(filenames)
-        self.perform_search(search, results)
+        songs = self.player.search_files(
+            filenames, restrictions=self.configuration.restrictions
+        )
+        self.match_songs(songs, results)
+        # These were analyzed, so they count towards the album and artist
+        # centroids, whether they were ever played or not.
+        self.set_track_groups(songs)
 
     def search_database(self, results):
         """Search for songs in results."""
@@ -596,20 +639,21 @@ class AutoQueueBase(object):
         if not filename:
             return
 
-        search = self.construct_filenames_search([filename])
-        songs = self.player.search(search)
+        songs = self.player.search_files([filename])
         if not songs:
             return
 
         return songs[0]
 
     def perform_search(self, search, results):
-        songs = {
-            song.get_filename(): song
-            for song in self.player.search(
-                search, restrictions=self.configuration.restrictions
-            )
-        }
+        self.match_songs(
+            self.player.search(search, restrictions=self.configuration.restrictions),
+            results,
+        )
+
+    def match_songs(self, found_songs, results):
+        """Add the song each result refers to, out of the songs found for them."""
+        songs = {song.get_filename(): song for song in found_songs}
         song_values = set(songs.values())
         found = set()
         for result in results:
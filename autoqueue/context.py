@@ -9,6 +9,8 @@ from dateutil.easter import easter  # type: ignore[import-untyped]
 from dateutil.rrule import TH, YEARLY, rrule  # type: ignore[import-untyped]
 from sentence_transformers import SentenceTransformer
 
+from autoqueue.features import FeatureTable
+
 HISTORY = 10
 
 HALF_HOUR = timedelta(minutes=30)
@@ -38,6 +40,21 @@ TIME = re.compile(r"([0-9]{2}):([0-9]{2})")
 static_predicates = []
 
 
+def get_bpm(song, features: Optional[FeatureTable]) -> Optional[float]:
+    """Get the tempo of a song from its tag, or else from its analysis."""
+    try:
+        bpm = float(song.song.get("bpm"))
+    except (ValueError, TypeError):
+        bpm = 0
+    if bpm > 0:
+        return bpm
+
+    if features is None:
+        return None
+
+    return features.get(song.get_filename(), "bpm")
+
+
 def static_predicate(cls):
     static_predicates.append(cls())
     return cls
@@ -64,6 +81,7 @@ class Context(object):
         self.configuration = configuration
         self.cache = cache
         self.weather = cache.get_weather(configuration)
+        self.features = cache.features.get_table()
         self.predicates = []
         self.build_predicates()
         self.transformer_model = SentenceTransformer(
@@ -105,6 +123,9 @@ class Context(object):
                 predicate.score(result, applies, self)
 
     def adjust_scores(self, results: list[dict[str, Any]]):
+        songs = [result["song"] for result in results if "song" in result]
+        for predicate in self.predicates:
+            predicate.prepare(songs)
         predicates = [
             p for p in self.predicates if p.sentence and p.applies_in_context(self)
         ]
@@ -163,7 +184,7 @@ class Context(object):
         bpm = None
         number_of_songs = len(self.cache.previous_songs)
         for i, song in enumerate(self.cache.previous_songs):
-            bpm = song.song.get("bpm")
+            bpm = get_bpm(song, self.features)
             scale = (i + 1) / number_of_songs
             previous_terms.append(
                 String(song.get_title(with_version=False), scale=scale)
@@ -174,10 +195,7 @@ class Context(object):
             previous_terms.append(Geohash(song.get_geohashes(), scale=scale))
 
         if bpm:
-            try:
-                self.predicates.append(BPM(float(bpm)))
-            except (ValueError, TypeError):
-                pass
+            self.predicates.append(BPM(bpm, self.features))
 
         self.predicates.extend(previous_terms)
 
@@ -327,6 +345,9 @@ class Predicate:
     def applies_in_context(self, context):
         return True
 
+    def prepare(self, songs):
+        """Look up whatever scoring @songs needs, all at once."""
+
     def get_factor(self, song, context):
         return 1
 
@@ -360,15 +381,40 @@ class Tags(Predicate):
 
 
 class BPM(Predicate):
-    def __init__(self, bpm: float):
+    def __init__(self, bpm: float, features: Optional[FeatureTable] = None):
         self.bpm = bpm
+        self.features = features
+        self.analyzed: dict[str, Optional[float]] = {}
+
+    def prepare(self, songs):
+        """Look up the analyzed tempo of all @songs in one go."""
+        if self.features is None:
+            return
+
+        filenames = [song.get_filename() for song in songs]
+        self.analyzed = {
+            filename: float(bpm) if bpm > 0 else None
+            for filename, bpm in zip(
+                filenames, self.features.lookup(filenames, "bpm")
+            )
+        }
+
+    def get_song_bpm(self, song):
+        tagged = get_bpm(song, None)
+        if tagged:
+            return tagged
+
+        filename = song.get_filename()
+        if filename in self.analyzed:
+            return self.analyzed[filename]
+
+        return get_bpm(song, self.features)
 
     def applies_to_song(self, song):
-        try:
-            if float(song.song.get("bpm")) > 0 and (self.get_factor(song, None) < 1):
-                return float(song.song.get("bpm"))
-        except (ValueError, TypeError):
-            return False
+        bpm = self.get_song_bpm(song)
+        if bpm and self.get_factor(song, None) < 1:
+            return bpm
+        return False
 
     def score(self, result, applies, context):
         original_factor = self.get_factor(result["song"], context)
@@ -379,14 +425,14 @@ class BPM(Predicate):
         )
 
     def get_factor(self, song, context):
+        song_bpm = self.get_song_bpm(song)
+        if not song_bpm:
+            return 1
+
         difference = min(
-            abs(float(song.song.get("bpm")) - bpm)
-            for bpm in (self.bpm, self.bpm * 2, self.bpm / 2)
+            abs(song_bpm - bpm) for bpm in (self.bpm, self.bpm * 2, self.bpm / 2)
         )
-        try:
-            return difference / 10
-        except (ValueError, TypeError):
-            return 1
+        return difference / 10
 
     def __repr__(self):
         return f"<BPM {self.bpm!r}>"
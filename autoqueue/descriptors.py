@@ -0,0 +1,255 @@
+"""Essentia descriptor pipeline in NumPy, an alternative to gaia2.
+
+Follows the transformation chain GaiaDB applies with gaia2: fixlength,
+cleaner, removal of the beat positions and MFCCs, normalize and a PCA of
+the means and variances. Only the descriptors that end up in the PCA are
+kept, since nothing else is used for comparing tracks.
+"""
+
+import json
+from dataclasses import dataclass
+from fnmatch import fnmatchcase
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from uuid import uuid4
+
+import numpy as np
+
+Descriptors = Dict[str, np.ndarray]
+
+
+@dataclass(frozen=True)
+class Profile:
+
+    """Which descriptors go into the PCA, and how many dimensions come out."""
+
+    name: str
+    dimension: int
+    removed: Tuple[str, ...] = ("*beats_position*", "*mfcc*")
+    descriptors: Tuple[str, ...] = ("*.mean", "*.var")
+
+    def uses(self, name: str) -> bool:
+        """Check whether a descriptor is one of the PCA's inputs."""
+        if any(fnmatchcase(name, pattern) for pattern in self.removed):
+            return False
+
+        return any(fnmatchcase(name, pattern) for pattern in self.descriptors)
+
+
+DEFAULT_PROFILE = "default"
+PROFILES = {
+    profile.name: profile
+    for profile in (
+        Profile("fast", 12),
+        Profile(DEFAULT_PROFILE, 30),
+        Profile("rich", 60, removed=("*beats_position*",)),
+    )
+}
+
+
+def flatten(signature: dict, prefix: str = "") -> Descriptors:
+    """Get the numeric descriptors of an essentia signature by dotted name."""
+    descriptors = {}
+    for key, value in signature.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            descriptors.update(flatten(value, name + "."))
+            continue
+        try:
+            array = np.asarray(value, dtype=np.float64).ravel()
+        except (TypeError, ValueError):
+            continue
+        if array.size:
+            descriptors[name] = array
+    return descriptors
+
+
+def signature_descriptors(signature: dict) -> Descriptors:
+    """Get the descriptors any profile's PCA uses from an essentia signature."""
+    signature.get("metadata", {}).pop("tags", None)
+    return {
+        name: value
+        for name, value in flatten(signature).items()
+        if any(profile.uses(name) for profile in PROFILES.values())
+    }
+
+
+def load_signature(path: Path) -> Descriptors:
+    """Load the descriptors any profile's PCA uses from an essentia JSON file."""
+    with path.open() as sig:
+        return signature_descriptors(json.load(sig))
+
+
+class DescriptorModel(object):
+
+    """Fitted normalization and PCA, mapping descriptors to vectors."""
+
+    def __init__(
+        self,
+        version: str,
+        dimension: int,
+        names: List[str],
+        lengths: List[int],
+        minimum: np.ndarray,
+        scale: np.ndarray,
+        mean: np.ndarray,
+        components: np.ndarray,
+    ):
+        self.version = version
+        self.dimension = dimension
+        self.names = names
+        self.lengths = lengths
+        self.minimum = minimum
+        self.scale = scale
+        self.mean = mean
+        self.components = components
+        ends = np.cumsum(lengths)
+        self.spans = list(zip(names, ends - lengths, ends))
+
+    @classmethod
+    def fit(cls, fragments: List[Descriptors], profile: Profile) -> "DescriptorModel":
+        """Fit a model for @profile to the descriptors of @fragments."""
+        lengths: Dict[str, set] = {}
+        for descriptors in fragments:
+            for name, value in descriptors.items():
+                if profile.uses(name):
+                    lengths.setdefault(name, set()).add(len(value))
+        # fixlength: only descriptors that every fragment has, with the same
+        # length everywhere.
+        names = sorted(
+            name
+            for name, seen in lengths.items()
+            if len(seen) == 1
+            and all(name in descriptors for descriptors in fragments)
+        )
+        values = {
+            name: np.array([descriptors[name] for descriptors in fragments])
+            for name in names
+        }
+        # cleaner: drop descriptors that are constant or not finite anywhere.
+        names = [
+            name
+            for name in names
+            if np.isfinite(values[name]).all()
+            and (np.ptp(values[name], axis=0) > 0).all()
+        ]
+        lengths_kept = [values[name].shape[1] for name in names]
+        matrix = np.hstack(
+            [values[name] for name in names] or [np.zeros((len(fragments), 0))]
+        )
+        # normalize: scale each descriptor as a whole to [0, 1].
+        minimum = np.repeat([values[name].min() for name in names], lengths_kept)
+        scale = np.repeat([np.ptp(values[name]) for name in names], lengths_kept)
+        normalized = (matrix - minimum) / scale
+        mean = normalized.mean(axis=0)
+        _, _, components = np.linalg.svd(normalized - mean, full_matrices=False)
+        return cls(
+            uuid4().hex,
+            profile.dimension,
+            names,
+            lengths_kept,
+            minimum,
+            scale,
+            mean,
+            components[: profile.dimension],
+        )
+
+    def transform(self, descriptors: Descriptors) -> np.ndarray:
+        """Get the vector for one fragment.
+
+        Descriptors the fragment lacks count as the average of the fitted
+        fragments.
+        """
+        normalized = self.mean.copy()
+        for name, start, end in self.spans:
+            value = descriptors.get(name)
+            if value is not None and len(value) == end - start:
+                normalized[start:end] = (
+                    value - self.minimum[start:end]
+                ) / self.scale[start:end]
+        vector = np.zeros(self.dimension)
+        vector[: len(self.components)] = self.components @ (normalized - self.mean)
+        return vector
+
+    def save(self, path: Path) -> None:
+        tmp = path.with_suffix(".tmp.npz")
+        np.savez(
+            tmp,
+            version=self.version,
+            dimension=self.dimension,
+            names=np.array(self.names),
+            lengths=np.array(self.lengths),
+            minimum=self.minimum,
+            scale=self.scale,
+            mean=self.mean,
+            components=self.components,
+        )
+        tmp.replace(path)
+
+    @classmethod
+    def load(cls, path: Path) -> "DescriptorModel":
+        with np.load(path) as data:
+            return cls(
+                str(data["version"]),
+                int(data["dimension"]),
+                [str(name) for name in data["names"]],
+                [int(length) for length in data["lengths"]],
+                data["minimum"],
+                data["scale"],
+                data["mean"],
+                data["components"],
+            )
+
+
+class DescriptorDB(object):
+
+    """The descriptor model, and the fragments analyzed before it was fitted.
+
+    Like a gaia dataset, the model is fitted to whatever was analyzed by the
+    time it is first saved, and new fragments are mapped through it after
+    that.
+    """
+
+    def __init__(self, path: Path, profile: Profile):
+        self.path = path
+        self.profile = profile
+        self.model: Optional[DescriptorModel] = (
+            DescriptorModel.load(path) if path.exists() else None
+        )
+        self.pending: Dict[str, Descriptors] = {}
+
+    @property
+    def transformed(self) -> bool:
+        return self.model is not None
+
+    @property
+    def version(self) -> Optional[str]:
+        return self.model.version if self.model is not None else None
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.pending
+
+    def size(self) -> int:
+        return len(self.pending)
+
+    def add(self, name: str, descriptors: Descriptors) -> Optional[np.ndarray]:
+        """Add a fragment, returning its vector if there is a model."""
+        if self.model is None:
+            self.pending[name] = descriptors
+            return None
+
+        return self.model.transform(descriptors)
+
+    def remove(self, name: str) -> None:
+        self.pending.pop(name, None)
+
+    def fit_and_save(self) -> Tuple[List[str], np.ndarray]:
+        """Fit the model to the pending fragments and return their vectors."""
+        names = list(self.pending)
+        self.model = DescriptorModel.fit(
+            [self.pending[name] for name in names], self.profile
+        )
+        self.model.save(self.path)
+        vectors = np.array([self.model.transform(self.pending[name]) for name in names])
+        self.pending = {}
+        return names, vectors
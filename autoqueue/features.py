@@ -0,0 +1,231 @@
+"""Scalar essentia features of analyzed tracks, in a columnar sidecar file.
+
+The similarity service writes features.npz next to its databases as tracks
+are analyzed, and the plugin reads it, so both can filter and score songs by
+tempo, key or loudness without reading signatures or tags again.
+"""
+
+import os
+from pathlib import Path
+from threading import Lock
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+FEATURES_FILE = "features.npz"
+
+# Feature names, and where they can be in an essentia signature.
+FEATURES = (
+    ("bpm", ("rhythm.bpm",)),
+    ("danceability", ("rhythm.danceability",)),
+    ("onset_rate", ("rhythm.onset_rate",)),
+    ("loudness", ("lowlevel.average_loudness",)),
+    ("dynamic_complexity", ("lowlevel.dynamic_complexity",)),
+    ("key", ("tonal.key_key", "tonal.key_edma.key")),
+    ("major", ("tonal.key_scale", "tonal.key_edma.scale")),
+    ("key_strength", ("tonal.key_strength", "tonal.key_edma.strength")),
+)
+NAMES = tuple(name for name, _ in FEATURES)
+# Features that are labels, which can not be averaged over fragments.
+LABELS = frozenset({"key", "major"})
+PITCH_CLASSES = {
+    name: pitch_class
+    for pitch_class, names in enumerate(
+        (
+            ("C", "B#"),
+            ("C#", "Db"),
+            ("D",),
+            ("D#", "Eb"),
+            ("E", "Fb"),
+            ("F", "E#"),
+            ("F#", "Gb"),
+            ("G",),
+            ("G#", "Ab"),
+            ("A",),
+            ("A#", "Bb"),
+            ("B", "Cb"),
+        )
+    )
+    for name in names
+}
+
+
+def lookup(signature: dict, path: str):
+    value = signature
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def to_number(name: str, value) -> float:
+    if name == "key":
+        return float(PITCH_CLASSES.get(value, np.nan))
+    if name == "major":
+        return {"major": 1.0, "minor": 0.0}.get(value, np.nan)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def signature_features(signature: dict) -> np.ndarray:
+    """Get the scalar features of one fragment's signature, NaN where missing."""
+    values = np.full(len(NAMES), np.nan, dtype=np.float32)
+    for i, (name, paths) in enumerate(FEATURES):
+        for path in paths:
+            value = lookup(signature, path)
+            if value is not None:
+                values[i] = to_number(name, value)
+                break
+    return values
+
+
+def track_features(fragments: List[np.ndarray]) -> np.ndarray:
+    """Combine the features of a track's fragments.
+
+    Measurements are averaged, labels come from the first fragment that has
+    them.
+    """
+    stacked = np.array(fragments, dtype=np.float32).reshape(-1, len(NAMES))
+    known = ~np.isnan(stacked)
+    counts = known.sum(axis=0)
+    values = np.where(known, stacked, 0).sum(axis=0) / np.maximum(counts, 1)
+    values[counts == 0] = np.nan
+    for i, name in enumerate(NAMES):
+        if name in LABELS and counts[i]:
+            values[i] = stacked[np.argmax(known[:, i]), i]
+    return values.astype(np.float32)
+
+
+class FeatureTable(object):
+
+    """Features by track: one contiguous column per feature, a row per track."""
+
+    def __init__(self, filenames: Sequence[str] = (), columns=None):
+        self.lock = Lock()
+        self.filenames = list(filenames)
+        self.rows = {filename: row for row, filename in enumerate(self.filenames)}
+        self.size = len(self.filenames)
+        self.columns = (
+            np.array(columns, dtype=np.float32).reshape(len(NAMES), self.size)
+            if columns is not None
+            else np.zeros((len(NAMES), 0), dtype=np.float32)
+        )
+        self.changed = False
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self.rows
+
+    def __len__(self):
+        return self.size
+
+    def put(self, filename: str, values: np.ndarray) -> None:
+        with self.lock:
+            row = self.rows.get(filename)
+            if row is None:
+                if self.size == self.columns.shape[1]:
+                    grown = np.zeros(
+                        (len(NAMES), max(16, 2 * self.size)), dtype=np.float32
+                    )
+                    grown[:, : self.size] = self.columns[:, : self.size]
+                    self.columns = grown
+                row = self.rows[filename] = self.size
+                self.filenames.append(filename)
+                self.size += 1
+            self.columns[:, row] = values
+            self.changed = True
+
+    def remove(self, filename: str) -> None:
+        with self.lock:
+            row = self.rows.pop(filename, None)
+            if row is None:
+                return
+
+            last = self.size - 1
+            if row != last:
+                moved = self.filenames[last]
+                self.filenames[row] = moved
+                self.rows[moved] = row
+                self.columns[:, row] = self.columns[:, last]
+            self.filenames.pop()
+            self.size -= 1
+            self.changed = True
+
+    def get(self, filename: str, name: str) -> Optional[float]:
+        """Get one feature of a track, or None if it is not known."""
+        with self.lock:
+            row = self.rows.get(filename)
+            if row is None:
+                return None
+
+            value = float(self.columns[NAMES.index(name), row])
+        return None if np.isnan(value) else value
+
+    def lookup(self, filenames: Sequence[str], name: str) -> np.ndarray:
+        """Get one feature of many tracks at once, NaN where it is not known."""
+        with self.lock:
+            rows = np.fromiter(
+                (self.rows.get(filename, -1) for filename in filenames),
+                dtype=np.int64,
+                count=len(filenames),
+            )
+            if not self.size:
+                return np.full(len(rows), np.nan)
+
+            values = self.columns[NAMES.index(name), np.maximum(rows, 0)]
+        return np.where(rows >= 0, values, np.nan)
+
+    def save(self, path: Path) -> None:
+        tmp = path.with_suffix(".tmp.npz")
+        with self.lock:
+            np.savez(
+                tmp,
+                filenames=np.array(self.filenames, dtype=str),
+                **{
+                    name: self.columns[i, : self.size]
+                    for i, name in enumerate(NAMES)
+                },
+            )
+            self.changed = False
+        tmp.replace(path)
+
+    @classmethod
+    def load(cls, path: Path) -> "FeatureTable":
+        """Load the sidecar, with NaN for features it was written without."""
+        if not path.exists():
+            return cls()
+
+        with np.load(path) as data:
+            filenames = [str(filename) for filename in data["filenames"]]
+            missing = np.full(len(filenames), np.nan)
+            return cls(
+                filenames,
+                [data[name] if name in data.files else missing for name in NAMES],
+            )
+
+    def describe(self) -> dict:
+        with self.lock:
+            return {"tracks": self.size, "bytes": self.columns.nbytes}
+
+
+class FeatureReader(object):
+
+    """The sidecar as last written by the service, read again when it changes."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.mtime_ns: Optional[int] = None
+        self.table = FeatureTable()
+
+    def get_table(self) -> FeatureTable:
+        try:
+            mtime_ns = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return self.table
+        if mtime_ns != self.mtime_ns:
+            self.table = FeatureTable.load(self.path)
+            self.mtime_ns = mtime_ns
+        return self.table
+
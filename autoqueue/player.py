@@ -175,6 +175,16 @@ class PlayerBase(metaclass=ABCMeta):
     def get_songs_in_queue(self):
         """Return (wrapped) song objects for the songs in the queue."""
 
+    def search_files(self, filenames, restrictions=None):
+        """Find the songs with these filenames.
+
+        Override this if the player can look songs up by filename without
+        running a search.
+        """
+        return self.search(
+            self.construct_files_search(filenames), restrictions=restrictions
+        )
+
     @staticmethod
     def execute_async(method, *args, **kwargs):
         """Override this if the player can execute methods asynchronously."""
@@ -18,25 +18,52 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301  USA.
 """
 
+from __future__ import annotations
+
+import argparse
+import asyncio
 import json
 import os
+import re
+import shlex
 import sqlite3
 import subprocess
-from dataclasses import dataclass
-from functools import total_ordering
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from heapq import heappop, heappush
 from pathlib import Path
-from queue import Empty, LifoQueue, PriorityQueue, Queue
-from threading import Thread
-from time import sleep, time
-from typing import Callable, List, Optional, Sequence, Tuple
+from queue import Empty, LifoQueue
+from random import sample
+from threading import Condition, Event, Lock, Thread
+from time import perf_counter, sleep, time
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import quote
 from uuid import uuid4
 
 import dbus
 import dbus.service
+import numpy as np
 from dbus.mainloop.glib import DBusGMainLoop
 from dbus.service import method
 from gi.repository import GObject
 
+from autoqueue.descriptors import (
+    DEFAULT_PROFILE,
+    PROFILES,
+    DescriptorDB,
+    Profile,
+    signature_descriptors,
+)
+from autoqueue.features import (
+    FEATURES_FILE,
+    NAMES,
+    FeatureTable,
+    signature_features,
+    track_features,
+)
+from autoqueue.stats import Histogram, Stats, StatsDumper
+from autoqueue.transport import SimilaritySocketServer, get_socket_path
 from autoqueue.utilities import player_get_data_dir
 
 try:
@@ -46,6 +73,7 @@ try:
         DistanceFunction,
         DistanceFunctionFactory,
         Point,
+        TransfoChain,
         View,
         transform,
     )
@@ -64,19 +92,67 @@ DBUS_PATH = "/org/autoqueue/Similarity"
 
 # XXX: make this configurable
 ESSENTIA_EXTRACTOR_PATH = "streaming_extractor_music"
+# The command that writes the signature of an audio file, with the audio and
+# signature paths appended.
+EXTRACTOR = (ESSENTIA_EXTRACTOR_PATH,)
 
 ADD = "add"
 REMOVE = "remove"
 
 FRAGMENT_SECONDS = 30
 
+# Upper bounds for how much work goes into a single database transaction.
+MAX_BATCH_STATEMENTS = 500
+MAX_BATCH_SECONDS = 0.05
+DATABASE_READERS = 3
+# Every this many seconds of waiting a queued SQL command is treated as one
+# priority level more urgent, so low priority writes cannot starve.
+AGING_SECONDS = 0.5
+# Statements that take longer than this get their query plan recorded.
+SLOW_STATEMENT_SECONDS = 0.1
+
+# How many artist and track ids are kept in memory.
+ARTIST_CACHE_SIZE = 10000
+TRACK_CACHE_SIZE = 100000
+# How many changed edges a similarity graph collects before it is rebuilt.
+COMPACT_EDGES = 10000
+# Maximum number of ids in one IN (...) clause.
+MAX_SQL_VARIABLES = 500
+
+VACUUM_FULL = "full"
+VACUUM_INCREMENTAL = "incremental"
+# The values of PRAGMA auto_vacuum.
+AUTO_VACUUM_MODES = ("none", "full", "incremental")
+
+VECTOR_DESCRIPTOR = "pca30"
+NUMPY_VECTOR_DESCRIPTOR = "numpy-pca30"
+# How many tracks the profile report looks up in every profile.
+PROFILE_SAMPLE = 100
+
+ACOUSTIC_GAIA = "gaia"
+ACOUSTIC_NUMPY = "numpy"
+ACOUSTIC_BACKENDS = (ACOUSTIC_GAIA, ACOUSTIC_NUMPY)
+
+VECTOR_STORE_GAIA = "gaia"
+VECTOR_STORE_SQLITE = "sqlite"
+VECTOR_STORES = (VECTOR_STORE_GAIA, VECTOR_STORE_SQLITE)
+
+ANALYZED = "analyzed"
+FAILED = "failed"
+
+ALBUM = "album"
+ARTIST = "artist"
+
 
 @dataclass
 class GaiaDB:
     path: Path
+    stats: Stats = field(default_factory=Stats)
+    profile: Profile = PROFILES[DEFAULT_PROFILE]
     transformed: bool = False
     _dataset: DataSet | None = None
     _metric: DistanceFunction | None = None
+    _history: TransfoChain | None = None
 
     @property
     def dataset(self):
@@ -103,20 +179,53 @@ class GaiaDB:
 
         return self._metric
 
+    @property
+    def vector_descriptor(self) -> str:
+        return "pca%d" % self.profile.dimension
+
+    @property
+    def history_path(self) -> Path:
+        return self.path.with_suffix(".history")
+
+    def load_history(self) -> bool:
+        """Load only the transformation of the dataset, if it was saved."""
+        if not self.history_path.exists():
+            return False
+
+        self._history = TransfoChain()
+        self._history.load(str(self.history_path))
+        self.transformed = True
+        return True
+
+    def keep_history_only(self) -> None:
+        """Save the transformation of the dataset and let go of its points.
+
+        Points added after this have to be mapped with map_point, since
+        the dataset is not kept.
+        """
+        self._history = self.dataset.history()
+        self._history.save(str(self.history_path))
+        self._dataset = None
+        self._metric = None
+
+    def map_point(self, point: Point) -> Point:
+        """Transform a point the way the dataset was transformed."""
+        return self._history.mapPoint(point)
+
     def transform(self):
         """Transform dataset for distance computations."""
         dataset = transform(self.dataset, "fixlength")
         dataset = transform(dataset, "cleaner")
-        dataset = transform(dataset, "remove", {"descriptorNames": "*beats_position*"})
-        dataset = transform(dataset, "remove", {"descriptorNames": "*mfcc*"})
+        for pattern in self.profile.removed:
+            dataset = transform(dataset, "remove", {"descriptorNames": pattern})
         dataset = transform(dataset, "normalize")
         dataset = transform(
             dataset,
             "pca",
             {
-                "dimension": 30,
-                "descriptorNames": ["*.mean", "*.var"],
-                "resultName": "pca30",
+                "dimension": self.profile.dimension,
+                "descriptorNames": list(self.profile.descriptors),
+                "resultName": self.vector_descriptor,
             },
         )
         self._dataset = dataset
@@ -126,12 +235,14 @@ class GaiaDB:
         """Transform dataset and save to disk."""
 
         if not self.transformed:
-            self.transform()
-            self._metric = DistanceFunctionFactory.create(
-                "euclidean", self.dataset.layout()
-            )
+            with self.stats.timer("analysis.transform"):
+                self.transform()
+                self._metric = DistanceFunctionFactory.create(
+                    "euclidean", self.dataset.layout()
+                )
             self.transformed = True
-        self.dataset.save(str(self.path))
+        with self.stats.timer("analysis.save"):
+            self.dataset.save(str(self.path))
         return self
 
     def __contains__(self, filename):
@@ -154,23 +265,748 @@ class GaiaDB:
             return None
 
 
-@total_ordering
+def point_vector(point: Point, descriptor: str = VECTOR_DESCRIPTOR) -> np.ndarray:
+    """Get the reduced feature vector of a transformed point."""
+    return np.array(point.value(descriptor), dtype=np.float64)
+
+
+def distance_matrix(vectors: np.ndarray) -> np.ndarray:
+    """Compute all pairwise euclidean distances between rows of @vectors."""
+    distances = cross_distances(vectors, vectors)
+    np.fill_diagonal(distances, 0)
+    return distances
+
+
+def cross_distances(sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """Compute the euclidean distance from every source row to every target row."""
+    distances = (
+        np.einsum("ij,ij->i", sources, sources)[:, None]
+        + np.einsum("ij,ij->i", targets, targets)[None, :]
+        - 2 * (sources @ targets.T)
+    )
+    np.maximum(distances, 0, out=distances)
+    return np.sqrt(distances, out=distances)
+
+
+def track_distances(heads: np.ndarray, tails: np.ndarray, transitions: bool):
+    """Get the cost of going from each track to each other track.
+
+    With @transitions the cost of A -> B is the distance from A's tail to B's
+    head, otherwise the distance between the mean vectors of A and B.
+    """
+    if transitions:
+        return cross_distances(tails, heads)
+    return distance_matrix((heads + tails) / 2)
+
+
 class SQLCommand(object):
 
     """A SQL command object."""
 
     def __init__(self, sql_statements):
         self.sql = sql_statements
-        self.result_queue: Queue = Queue()
+        self.future: Future = Future()
+        self.waited = 0.0
+
+
+class SQLBatch(SQLCommand):
+
+    """Statements that are each run for many rows, in one transaction.
+
+    The result is the number of rows each statement changed.
+    """
+
+    def __init__(self, statements):
+        super(SQLBatch, self).__init__(tuple(statement for statement, _ in statements))
+        self.rows = [rows for _, rows in statements]
+
+
+class SQLScheduler(object):
+
+    """Queue of SQL commands, ordered by priority and then first in first out.
+
+    Lower numbers are more urgent. A command's priority improves by one level
+    for every AGING_SECONDS it waits, so a steady stream of urgent commands
+    only delays the rest. Has the put/get/qsize interface of queue.Queue,
+    with (priority, command) items.
+    """
+
+    def __init__(self, name: str, stats: Stats):
+        self.name = name
+        self.stats = stats
+        self.not_empty = Condition()
+        self.waiting: Dict[int, Deque[Tuple[float, int, SQLCommand]]] = {}
+        self.sequence = 0
+        self.size = 0
+
+    def put(self, item: Tuple[int, SQLCommand]) -> None:
+        priority, command = item
+        with self.not_empty:
+            self.sequence += 1
+            self.waiting.setdefault(priority, deque()).append(
+                (time(), self.sequence, command)
+            )
+            self.size += 1
+            self.not_empty.notify()
+
+    def get(self, block: bool = True) -> Tuple[int, SQLCommand]:
+        with self.not_empty:
+            if not block and not self.size:
+                raise Empty
+            while not self.size:
+                self.not_empty.wait()
+            now = time()
+            # Only the head of each priority's queue can be next, as the
+            # commands behind it have the same priority and waited less.
+            priority = min(
+                (
+                    (priority - (now - commands[0][0]) / AGING_SECONDS, commands[0][1]),
+                    priority,
+                )
+                for priority, commands in self.waiting.items()
+                if commands
+            )[1]
+            queued, _, command = self.waiting[priority].popleft()
+            self.size -= 1
+        command.waited = now - queued
+        self.stats.record("%s.wait.%d" % (self.name, priority), now - queued)
+        return priority, command
+
+    def qsize(self) -> int:
+        return self.size
+
+    def depths(self) -> Dict[str, int]:
+        """Count the commands waiting per priority."""
+        with self.not_empty:
+            return {
+                str(priority): len(commands)
+                for priority, commands in sorted(self.waiting.items())
+                if commands
+            }
+
+
+class StatementStats(object):
+
+    """Timings, row counts and queue waits per normalized SQL statement."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.statements: Dict[str, dict] = {}
+
+    @staticmethod
+    def normalize(sql: str) -> str:
+        """Strip the parts of a statement that vary between calls."""
+        sql = re.sub(r"\s+", " ", sql).strip()
+        sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+        sql = re.sub(r"\b\d+(?:\.\d+)?\b", "?", sql)
+        return re.sub(r"\(\?(?:, \?)+\)", "(?, ...)", sql)
+
+    def record(
+        self,
+        sql: str,
+        seconds: float,
+        rows: int,
+        waited: float,
+        explain: Callable[[], str],
+    ) -> None:
+        """Add an execution of @sql.
+
+        @explain is only called when the statement is slow and no plan for it
+        has been recorded yet.
+        """
+        key = self.normalize(sql)
+        with self.lock:
+            entry = self.statements.get(key)
+            if entry is None:
+                entry = self.statements[key] = {
+                    "calls": 0,
+                    "rows": 0,
+                    "time": Histogram(),
+                    "wait": Histogram(),
+                    "plan": None,
+                }
+            entry["calls"] += 1
+            entry["rows"] += rows
+            entry["time"].record(seconds)
+            entry["wait"].record(waited)
+            needs_plan = seconds >= SLOW_STATEMENT_SECONDS and entry["plan"] is None
+        if needs_plan:
+            plan = explain()
+            with self.lock:
+                entry["plan"] = plan
+
+    def snapshot(self) -> Dict[str, dict]:
+        """Get the aggregates, the statements taking most time in total first."""
+        with self.lock:
+            statements = [
+                (
+                    key,
+                    {
+                        "calls": entry["calls"],
+                        "rows": entry["rows"],
+                        "total_seconds": entry["time"].total,
+                        "time": entry["time"].snapshot(),
+                        "wait": entry["wait"].snapshot(),
+                        "plan": entry["plan"],
+                    },
+                )
+                for key, entry in self.statements.items()
+            ]
+        statements.sort(key=lambda item: item[1]["total_seconds"], reverse=True)
+        return dict(statements)
+
+
+class NameCache(object):
+
+    """Bounded least recently used mapping of names to row ids."""
+
+    def __init__(self, name: str, size: int, stats: Stats):
+        self.name = name
+        self.size = size
+        self.stats = stats
+        self.lock = Lock()
+        self.ids: OrderedDict = OrderedDict()
+
+    def get(self, key) -> Optional[int]:
+        with self.lock:
+            row_id = self.ids.get(key)
+            if row_id is not None:
+                self.ids.move_to_end(key)
+        self.stats.increment(
+            "cache.%s.%s" % (self.name, "misses" if row_id is None else "hits")
+        )
+        return row_id
+
+    def put(self, key, row_id: int) -> None:
+        with self.lock:
+            self.ids[key] = row_id
+            self.ids.move_to_end(key)
+            while len(self.ids) > self.size:
+                self.ids.popitem(last=False)
+
+    def discard(self, key) -> None:
+        with self.lock:
+            self.ids.pop(key, None)
+
+    def hit_ratio(self) -> float:
+        counters = self.stats.snapshot_counters()
+        hits = counters.get("cache.%s.hits" % self.name, 0)
+        total = hits + counters.get("cache.%s.misses" % self.name, 0)
+        return hits / total if total else 0.0
+
+    def clear(self) -> None:
+        with self.lock:
+            self.ids.clear()
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class Adjacency(object):
+
+    """Symmetric similarity graph in compressed sparse row form.
+
+    The neighbours of node n are neighbours[offsets[n]:offsets[n + 1]], sorted
+    by descending match. Changes since the last build are kept in a per node
+    overlay, where a match of None means the edge was removed.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = Lock()
+        self.loading = Lock()
+        self.loaded = False
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.neighbours = np.zeros(0, dtype=np.int32)
+        self.matches = np.zeros(0, dtype=np.int64)
+        self.overlay: Dict[int, Dict[int, Optional[int]]] = {}
+        self.overlay_edges = 0
+        # Changes compacted while a load is reading its rows, which the rows
+        # may be missing.
+        self.journal: Optional[Dict[int, Dict[int, Optional[int]]]] = None
+
+    def reset(self) -> None:
+        """Forget everything, so the graph is loaded again on next use."""
+        with self.lock:
+            self.loaded = False
+            self.offsets = np.zeros(1, dtype=np.int64)
+            self.neighbours = np.zeros(0, dtype=np.int32)
+            self.matches = np.zeros(0, dtype=np.int64)
+            self.overlay = {}
+            self.overlay_edges = 0
+            self.journal = None
+
+    def load(self, fetch: Callable[[], List[Tuple[int, int, int]]]) -> None:
+        """Build the arrays from the (node, node, match) rows @fetch returns.
+
+        Changes made while the rows are read stay in effect, even when they
+        are compacted before the arrays are built.
+        """
+        with self.lock:
+            self.journal = {}
+        edges_array = np.array(fetch(), dtype=np.int64).reshape(-1, 3)
+        first = edges_array[:, 0]
+        second = edges_array[:, 1]
+        sources = np.concatenate([first, second])
+        targets = np.concatenate([second, first])
+        matches = np.concatenate([edges_array[:, 2], edges_array[:, 2]])
+        # A pair can be stored in both directions; keep its best match.
+        order = np.lexsort((-matches, targets, sources))
+        sources, targets, matches = sources[order], targets[order], matches[order]
+        unique = np.ones(len(sources), dtype=bool)
+        unique[1:] = (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])
+        with self.lock:
+            self.build(sources[unique], targets[unique], matches[unique])
+            overlay = self.journal
+            self.journal = None
+            for node, changes in self.overlay.items():
+                overlay.setdefault(node, {}).update(changes)
+            self.overlay = overlay
+            self.overlay_edges = sum(len(changes) for changes in overlay.values())
+            self.loaded = True
+
+    def build(
+        self, sources: np.ndarray, targets: np.ndarray, matches: np.ndarray
+    ) -> None:
+        order = np.lexsort((-matches, sources))
+        size = int(sources.max()) + 1 if len(sources) else 0
+        self.offsets = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=size), out=self.offsets[1:])
+        self.neighbours = targets[order].astype(np.int32)
+        self.matches = matches[order]
+
+    def base_slice(self, node: int) -> slice:
+        if node + 1 >= len(self.offsets):
+            return slice(0, 0)
+        return slice(self.offsets[node], self.offsets[node + 1])
+
+    def get_neighbours(self, node: int) -> List[Tuple[int, int]]:
+        """Get (match, neighbour) pairs, best match first."""
+        with self.lock:
+            span = self.base_slice(node)
+            base = zip(self.matches[span].tolist(), self.neighbours[span].tolist())
+            changes = self.overlay.get(node)
+            if not changes:
+                return list(base)
+
+            merged = {neighbour: match for match, neighbour in base}
+        merged.update(changes)
+        return sorted(
+            (
+                (match, neighbour)
+                for neighbour, match in merged.items()
+                if match is not None
+            ),
+            reverse=True,
+        )
+
+    def set_match(self, node1: int, node2: int, match: Optional[int]) -> None:
+        with self.lock:
+            self.overlay.setdefault(node1, {})[node2] = match
+            self.overlay.setdefault(node2, {})[node1] = match
+            self.overlay_edges += 2
+            if self.overlay_edges >= COMPACT_EDGES:
+                self.compact()
+
+    def update(self, edges: List[Tuple[int, int, int]]) -> None:
+        for node1, node2, match in edges:
+            self.set_match(node1, node2, match)
+
+    def remove_node(self, node: int) -> None:
+        for _, neighbour in self.get_neighbours(node):
+            self.set_match(node, neighbour, None)
+
+    def compact(self) -> None:
+        """Fold the overlay into the arrays."""
+        sources = np.repeat(
+            np.arange(len(self.offsets) - 1, dtype=np.int64), np.diff(self.offsets)
+        )
+        keep = np.ones(len(sources), dtype=bool)
+        added_sources, added_targets, added_matches = [], [], []
+        for node, changes in self.overlay.items():
+            span = self.base_slice(node)
+            keep[span] = ~np.isin(self.neighbours[span], list(changes))
+            for neighbour, match in changes.items():
+                if match is not None:
+                    added_sources.append(node)
+                    added_targets.append(neighbour)
+                    added_matches.append(match)
+        self.build(
+            np.concatenate([sources[keep], np.array(added_sources, dtype=np.int64)]),
+            np.concatenate(
+                [self.neighbours[keep], np.array(added_targets, dtype=np.int32)]
+            ),
+            np.concatenate(
+                [self.matches[keep], np.array(added_matches, dtype=np.int64)]
+            ),
+        )
+        if self.journal is not None:
+            for node, changes in self.overlay.items():
+                self.journal.setdefault(node, {}).update(changes)
+        self.overlay = {}
+        self.overlay_edges = 0
+
+    def describe(self) -> dict:
+        """Get the size of the graph, for the stats."""
+        with self.lock:
+            edges = len(self.neighbours)
+            nbytes = (
+                self.offsets.nbytes + self.neighbours.nbytes + self.matches.nbytes
+            )
+            return {
+                "loaded": self.loaded,
+                "edges": edges,
+                "bytes": nbytes,
+                "bytes_per_edge": nbytes / edges if edges else 0,
+                "overlay_edges": self.overlay_edges,
+            }
+
+
+def file_fingerprint(filename: str) -> Optional[str]:
+    """Get a cheap fingerprint that changes when the file does."""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return "%d:%d" % (stat.st_size, stat.st_mtime_ns)
+
+
+class VectorStore(object):
+
+    """Reduced acoustic vectors and analysis state, stored in similarity.db.
+
+    The vectors of the current model are kept in memory as the rows of one
+    contiguous array, so they can be compared all at once. Adding or removing
+    a track is a single row write rather than a dump of the whole dataset.
+    Every profile keeps its vectors in a @table of its own.
+    """
+
+    def __init__(self, execute_sql: Callable[..., Future], table: str = "vectors"):
+        self.execute_sql = execute_sql
+        self.table = table
+        self.lock = Lock()
+        self.model: Optional[str] = None
+        self.names: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.size = 0
+        self.fingerprints: Dict[str, Optional[str]] = {}
+
+    def create(self) -> None:
+        wait(
+            [
+                self.execute_sql((statement,), priority=0)
+                for statement in (
+                    "CREATE TABLE IF NOT EXISTS %s (name VARCHAR(300) PRIMARY KEY,"
+                    " vector BLOB, model VARCHAR(100));" % self.table,
+                    "CREATE INDEX IF NOT EXISTS %smodelx ON %s (model);"
+                    % (self.table, self.table),
+                )
+            ]
+        )
+
+    def get_current_model(self, descriptor: str) -> Optional[str]:
+        """Get the latest model that made @descriptor vectors."""
+        for (version,) in self.execute_sql(
+            (
+                "SELECT version FROM models WHERE descriptor = ? ORDER BY id DESC"
+                " LIMIT 1;",
+                (descriptor,),
+            ),
+            priority=0,
+        ).result():
+            return version
+        return None
+
+    def load(self, model: str) -> None:
+        """Read all vectors of @model into memory, in bulk."""
+        vectors = self.execute_sql(
+            ("SELECT name, vector FROM %s WHERE model = ?;" % self.table, (model,)),
+            priority=0,
+        )
+        analyses = self.execute_sql(
+            (
+                "SELECT filename, fingerprint FROM analyses WHERE state = ?;",
+                (ANALYZED,),
+            ),
+            priority=0,
+        )
+        rows = vectors.result()
+        with self.lock:
+            self.model = model
+            self.names = [name for name, _ in rows]
+            self.rows = {name: row for row, name in enumerate(self.names)}
+            self.size = len(rows)
+            self.vectors = (
+                np.frombuffer(b"".join(blob for _, blob in rows), dtype=np.float32)
+                .reshape(len(rows), -1)
+                .copy()
+                if rows
+                else np.zeros((0, 0), dtype=np.float32)
+            )
+            self.fingerprints = dict(analyses.result())
+
+    def replace(
+        self, model: str, descriptor: str, names: List[str], vectors: np.ndarray
+    ) -> None:
+        """Start a new model with @vectors, replacing all stored vectors."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self.execute_sql(
+            command=SQLBatch(
+                [
+                    (
+                        "INSERT INTO models (version, descriptor, created) VALUES"
+                        " (?, ?, DATETIME('now'));",
+                        [(model, descriptor)],
+                    ),
+                    ("DELETE FROM %s;" % self.table, [()]),
+                    (
+                        "INSERT INTO %s (name, vector, model) VALUES (?, ?, ?);"
+                        % self.table,
+                        [
+                            (name, vector.tobytes(), model)
+                            for name, vector in zip(names, vectors)
+                        ],
+                    ),
+                ]
+            ),
+            priority=0,
+        ).result()
+        with self.lock:
+            self.model = model
+            self.names = list(names)
+            self.rows = {name: row for row, name in enumerate(self.names)}
+            self.size = len(names)
+            self.vectors = vectors.copy()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.rows
+
+    def get(self, name: str) -> Optional[np.ndarray]:
+        with self.lock:
+            row = self.rows.get(name)
+            return None if row is None else self.vectors[row].copy()
+
+    def put(self, name: str, vector: np.ndarray) -> None:
+        """Add or replace the vector of a fragment."""
+        vector = np.asarray(vector, dtype=np.float32)
+        with self.lock:
+            row = self.rows.get(name)
+            if row is None:
+                if self.size == len(self.vectors):
+                    grown = np.zeros(
+                        (max(16, 2 * self.size), len(vector)), dtype=np.float32
+                    )
+                    grown[: self.size] = self.vectors[: self.size]
+                    self.vectors = grown
+                row = self.rows[name] = self.size
+                self.names.append(name)
+                self.size += 1
+            self.vectors[row] = vector
+            model = self.model
+        self.execute_sql(
+            (
+                "INSERT INTO %s (name, vector, model) VALUES (?, ?, ?) ON"
+                " CONFLICT (name) DO UPDATE SET vector = excluded.vector, model ="
+                " excluded.model;" % self.table,
+                (name, vector.tobytes(), model),
+            ),
+            priority=10,
+        )
+
+    def remove(self, filename: str, names: List[str]) -> None:
+        """Remove the fragments @names of @filename and its analysis state."""
+        with self.lock:
+            for name in names:
+                row = self.rows.pop(name, None)
+                if row is None:
+                    continue
+                last = self.size - 1
+                if row != last:
+                    moved = self.names[last]
+                    self.names[row] = moved
+                    self.rows[moved] = row
+                    self.vectors[row] = self.vectors[last]
+                self.names.pop()
+                self.size -= 1
+            self.fingerprints.pop(filename, None)
+        self.execute_sql(
+            command=SQLBatch(
+                [
+                    (
+                        "DELETE FROM %s WHERE name = ?;" % self.table,
+                        [(name,) for name in names],
+                    ),
+                    ("DELETE FROM analyses WHERE filename = ?;", [(filename,)]),
+                ]
+            ),
+            priority=10,
+        )
+
+    def set_state(self, filename: str, state: str) -> None:
+        """Remember how the analysis of @filename went."""
+        fingerprint = file_fingerprint(filename)
+        if state == ANALYZED:
+            self.fingerprints[filename] = fingerprint
+        self.execute_sql(
+            (
+                "INSERT INTO analyses (filename, state, fingerprint, updated) VALUES"
+                " (?, ?, ?, DATETIME('now')) ON CONFLICT (filename) DO UPDATE SET"
+                " state = excluded.state, fingerprint = excluded.fingerprint,"
+                " updated = excluded.updated;",
+                (filename, state, fingerprint),
+            ),
+            priority=10,
+        )
+
+    def is_stale(self, filename: str) -> bool:
+        """Check whether @filename changed since it was analyzed."""
+        fingerprint = self.fingerprints.get(filename)
+        return fingerprint is not None and fingerprint != file_fingerprint(filename)
+
+    def nearest(
+        self, vector: np.ndarray, number: int, accept: Callable[[str], bool]
+    ) -> List[Tuple[float, str]]:
+        """Get the @number nearest fragments whose names pass @accept."""
+        with self.lock:
+            distances = np.linalg.norm(self.vectors[: self.size] - vector, axis=1)
+            wanted = min(self.size, 2 * number + 2)
+            while True:
+                if wanted < self.size:
+                    candidates = np.argpartition(distances, wanted)[:wanted]
+                else:
+                    candidates = np.arange(self.size)
+                candidates = candidates[np.argsort(distances[candidates])]
+                result = [
+                    (float(distances[row]), self.names[row])
+                    for row in candidates
+                    if accept(self.names[row])
+                ]
+                if len(result) >= number or wanted >= self.size:
+                    return result[:number]
+                wanted = min(self.size, wanted * 2)
+
+    def describe(self) -> dict:
+        """Get the size of the store, for the stats."""
+        with self.lock:
+            return {
+                "model": self.model,
+                "vectors": self.size,
+                "bytes": self.vectors.nbytes,
+            }
+
+
+class CentroidIndex(object):
+
+    """Mean track vectors of albums or artists, updated a track at a time.
+
+    Lookups compare the centroids of a few thousand albums or artists rather
+    than the vectors of all fragments.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = Lock()
+        self.keys: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.sums = np.zeros((0, 0))
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.size = 0
+        # What every track added to the centroids, so it can be taken out.
+        self.tracks: Dict[str, Tuple[Tuple[str, ...], np.ndarray]] = {}
+
+    def clear(self) -> None:
+        with self.lock:
+            self.keys = []
+            self.rows = {}
+            self.sums = np.zeros((0, 0))
+            self.counts = np.zeros(0, dtype=np.int64)
+            self.size = 0
+            self.tracks = {}
+
+    def add(self, filename: str, keys: Sequence[str], vector: np.ndarray) -> None:
+        """Count @filename's @vector towards the centroids of @keys."""
+        with self.lock:
+            self._remove(filename)
+            keys = tuple(dict.fromkeys(key for key in keys if key))
+            if not keys:
+                return
+
+            vector = np.asarray(vector, dtype=np.float64)
+            if not self.size:
+                self.sums = np.zeros((0, len(vector)))
+                self.counts = np.zeros(0, dtype=np.int64)
+            for key in keys:
+                row = self.rows.get(key)
+                if row is None:
+                    if self.size == len(self.sums):
+                        grown = np.zeros((max(16, 2 * self.size), len(vector)))
+                        grown[: self.size] = self.sums[: self.size]
+                        self.sums = grown
+                        counts = np.zeros(len(grown), dtype=np.int64)
+                        counts[: self.size] = self.counts[: self.size]
+                        self.counts = counts
+                    row = self.rows[key] = self.size
+                    self.keys.append(key)
+                    self.size += 1
+                self.sums[row] += vector
+                self.counts[row] += 1
+            self.tracks[filename] = (keys, vector)
+
+    def remove(self, filename: str) -> None:
+        with self.lock:
+            self._remove(filename)
+
+    def _remove(self, filename: str) -> None:
+        keys, vector = self.tracks.pop(filename, ((), None))
+        for key in keys:
+            row = self.rows[key]
+            self.sums[row] -= vector
+            self.counts[row] -= 1
+            if self.counts[row]:
+                continue
+
+            del self.rows[key]
+            last = self.size - 1
+            if row != last:
+                moved = self.keys[last]
+                self.keys[row] = moved
+                self.rows[moved] = row
+                self.sums[row] = self.sums[last]
+                self.counts[row] = self.counts[last]
+            self.sums[last] = 0
+            self.counts[last] = 0
+            self.keys.pop()
+            self.size -= 1
+
+    def nearest(self, key: str, number: int) -> List[Tuple[float, str]]:
+        """Get the @number entities whose centroids are nearest to @key's."""
+        with self.lock:
+            row = self.rows.get(key)
+            if row is None:
+                return []
 
-    def __eq__(self, other):
-        return self.sql == other.sql
+            centroids = self.sums[: self.size] / self.counts[: self.size, None]
+            distances = np.linalg.norm(centroids - centroids[row], axis=1)
+            distances[row] = np.inf
+            number = min(number, self.size - 1)
+            if number <= 0:
+                return []
 
-    def __ne__(self, other):
-        return not self == other
+            nearest = np.argpartition(distances, number - 1)[:number]
+            return [
+                (float(distances[i]) * 1000, self.keys[i])
+                for i in nearest[np.argsort(distances[nearest])]
+            ]
 
-    def __lt__(self, other):
-        return self.sql < other.sql
+    def describe(self) -> dict:
+        """Get the size of the index, for the stats."""
+        with self.lock:
+            return {
+                "entities": self.size,
+                "tracks": len(self.tracks),
+                "bytes": self.sums.nbytes + self.counts.nbytes,
+            }
 
 
 FFMPEG_ARGS = (
@@ -183,90 +1019,543 @@ def tmp_path(suffix) -> Path:
     return (Path("/tmp") / Path(str(uuid4()))).with_suffix(suffix)
 
 
+def profile_file_name(stem: str, profile: str, suffix: str) -> str:
+    """Name a per profile file, keeping the old name for the default profile."""
+    if profile == DEFAULT_PROFILE:
+        return stem + suffix
+
+    return "%s_%s%s" % (stem, profile, suffix)
+
+
+def vector_descriptor_name(backend: str, profile: str) -> str:
+    """Name the vectors a backend makes for a profile in the models table."""
+    if profile != DEFAULT_PROFILE:
+        return "%s-%s" % (backend, profile)
+
+    if backend == ACOUSTIC_NUMPY:
+        return NUMPY_VECTOR_DESCRIPTOR
+
+    return VECTOR_DESCRIPTOR
+
+
 class GaiaAnalysis(Thread):
 
     """Gaia acoustic analysis and comparison."""
 
-    def __init__(self, queue):
+    def __init__(
+        self,
+        queue,
+        stats,
+        backend=ACOUSTIC_GAIA,
+        profile=DEFAULT_PROFILE,
+        extra_profiles=(),
+        workers=1,
+        extractor=EXTRACTOR,
+    ):
+        """Set up the acoustic backend.
+
+        @profile chooses the descriptors and dimensions of the vectors that
+        serve lookups. The numpy backend also builds the @extra_profiles side
+        by side from the same signatures, so they can be compared. @workers
+        audio files are run through the @extractor command at once.
+        """
         super(GaiaAnalysis, self).__init__()
-        data_dir = player_get_data_dir()
+        data_dir = Path(player_get_data_dir())
         self.transformed = False
-        self.gaia_db_new = GaiaDB(
-            Path(data_dir) / "new_gaia.db",
-        )
-        print("songs in db: %d" % self.gaia_db_new.dataset.size())
+        self.stats = stats
+        self.profile = profile
+        # With the numpy backend there is no gaia dataset: vectors always live
+        # in the vector store, and the descriptor db only holds the model and
+        # what was analyzed before it was fitted.
+        self.gaia_db_new: Optional[GaiaDB] = None
+        self.descriptor_dbs: Dict[str, DescriptorDB] = {}
+        if backend == ACOUSTIC_NUMPY:
+            self.profiles = list(dict.fromkeys([profile, *extra_profiles]))
+            for name in self.profiles:
+                self.descriptor_dbs[name] = DescriptorDB(
+                    data_dir / profile_file_name("numpy_model", name, ".npz"),
+                    PROFILES[name],
+                )
+        else:
+            if extra_profiles:
+                print("only the numpy backend builds extra profiles")
+            self.profiles = [profile]
+            self.gaia_db_new = GaiaDB(
+                data_dir / profile_file_name("new_gaia", profile, ".db"),
+                stats=stats,
+                profile=PROFILES[profile],
+            )
+        self.descriptor_db = self.descriptor_dbs.get(profile)
+        self.vector_descriptors = {
+            name: vector_descriptor_name(backend, name) for name in self.profiles
+        }
 
         self.commands = {ADD: self._analyze, REMOVE: self._remove_point}
         self.queue = queue
         self.seen = set()
         self.analyzed = 0
         self.factor = 2
+        self.workers = workers
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.extractor = extractor
+        # Set whenever the queue has been worked through and saved.
+        self.idle = Event()
+        # The album and artists of every track the player told us about.
+        self.groups: Dict[str, Tuple[str, Tuple[str, ...]]] = {}
+        self.album_index = CentroidIndex("albums")
+        self.artist_index = CentroidIndex("artists")
+        # Tempo, key and loudness of every analyzed track, shared with the
+        # plugin through a file next to the databases.
+        self.features_path = data_dir / FEATURES_FILE
+        self.features = FeatureTable.load(self.features_path)
+        self.vector_stores: Dict[str, VectorStore] = {}
+        self.vector_store: Optional[VectorStore] = None
+
+    def set_vector_stores(self, vector_stores: Dict[str, VectorStore]) -> None:
+        """Keep vectors and analysis state in one vector store per profile.
+
+        Vectors that are only in the gaia dataset file are copied over the
+        first time. From then on only the transformation of the gaia dataset
+        is loaded, never its points.
+        """
+        for name, vector_store in vector_stores.items():
+            if self.descriptor_db is not None:
+                model = self.descriptor_dbs[name].version
+            else:
+                model = vector_store.get_current_model(self.vector_descriptors[name])
+            if model is not None:
+                vector_store.load(model)
+        vector_store = vector_stores[self.profile]
+        if (
+            self.gaia_db_new is not None
+            and not self.gaia_db_new.load_history()
+            and self.gaia_db_new.path.exists()
+        ):
+            if not vector_store.size:
+                self.gaia_db_new.transform_and_save()
+                self.store_all_vectors(vector_store)
+            self.gaia_db_new.keep_history_only()
+        self.vector_stores = vector_stores
+        self.vector_store = vector_store
+
+    def use_profile(self, profile: str) -> None:
+        """Serve lookups from another of the profiles that are being built.
+
+        Signatures are not kept after analysis, so a profile only gets the
+        tracks analyzed since it was first built. One that does not have
+        every fragment the serving profile has is refused.
+        """
+        if profile not in self.vector_stores:
+            raise KeyError(profile)
+
+        coverage = self.get_coverage(profile)
+        if coverage < 1:
+            raise ValueError(
+                "profile %s only has %.1f%% of the fragments of profile %s"
+                % (profile, 100 * coverage, self.profile)
+            )
+
+        self.profile = profile
+        self.descriptor_db = self.descriptor_dbs.get(profile)
+        self.vector_store = self.vector_stores[profile]
+        self.rebuild_centroids()
+
+    def get_coverage(self, profile: str) -> float:
+        """Get the fraction of the serving profile's fragments @profile has."""
+        vector_store = self.vector_stores[profile]
+        if vector_store is self.vector_store:
+            return 1.0
+
+        with self.vector_store.lock:
+            names = list(self.vector_store.names[: self.vector_store.size])
+        if not names:
+            return 1.0
+
+        return sum(name in vector_store for name in names) / len(names)
+
+    def set_track_groups(self, filename: str, album: str, artists: Sequence[str]):
+        """Count @filename towards the centroids of its album and artists."""
+        self.groups[filename] = (album, tuple(artists))
+        self.update_centroids(filename)
+
+    def forget_track_groups(self, filename: str) -> None:
+        self.groups.pop(filename, None)
+        self.album_index.remove(filename)
+        self.artist_index.remove(filename)
+
+    def update_centroids(self, filename: str) -> None:
+        groups = self.groups.get(filename)
+        if groups is None:
+            return
+
+        vector = self.get_track_vector(filename)
+        if vector is None:
+            return
+
+        album, artists = groups
+        self.album_index.add(filename, [album], vector)
+        self.artist_index.add(filename, artists, vector)
+
+    def rebuild_centroids(self) -> None:
+        """Compute all centroids again, after the vectors changed."""
+        with self.stats.timer("analysis.build_centroids"):
+            self.album_index.clear()
+            self.artist_index.clear()
+            for filename in list(self.groups):
+                self.update_centroids(filename)
+
+    def get_track_vector(self, filename: str) -> Optional[np.ndarray]:
+        """Get the mean of the start and end vectors of an analyzed track."""
+        if self.vector_store is None and not self.gaia_db_new.transformed:
+            return None
+
+        fragments = [self.get_fragment(filename + suffix) for suffix in "01"]
+        if any(fragment is None for fragment in fragments):
+            return None
+
+        if self.vector_store is None:
+            descriptor = self.gaia_db_new.vector_descriptor
+            fragments = [point_vector(fragment, descriptor) for fragment in fragments]
+        return np.mean(fragments, axis=0)
+
+    def get_profile_report(
+        self, sample_size: int = PROFILE_SAMPLE, number: int = 10
+    ) -> Dict[str, dict]:
+        """Compare the memory, lookup latency and neighbours of the profiles.
+
+        The same sample of tracks is looked up in every profile, and the
+        neighbours found are compared with the ones the default profile finds.
+        """
+        reference = self.vector_stores.get(DEFAULT_PROFILE, self.vector_store)
+        if reference is None:
+            return {}
+
+        with reference.lock:
+            queries = [name for name in reference.names if name.endswith("1")]
+        queries = sample(queries, min(sample_size, len(queries)))
+        expected = {
+            query: set(self.nearest_names(reference, query, number))
+            for query in queries
+        }
+        report = {}
+        for profile, vector_store in self.vector_stores.items():
+            latency = Histogram()
+            overlaps = []
+            for query in queries:
+                start = perf_counter()
+                found = self.nearest_names(vector_store, query, number)
+                latency.record(perf_counter() - start)
+                if expected[query]:
+                    overlaps.append(
+                        len(expected[query].intersection(found)) / len(expected[query])
+                    )
+            report[profile] = {
+                **vector_store.describe(),
+                "dimension": PROFILES[profile].dimension,
+                "serving": profile == self.profile,
+                "coverage": self.get_coverage(profile),
+                "lookup_seconds": latency.snapshot(),
+                "neighbour_overlap": float(np.mean(overlaps)) if overlaps else None,
+            }
+        return report
+
+    @staticmethod
+    def nearest_names(vector_store: VectorStore, query: str, number: int) -> List[str]:
+        """Get the start fragments nearest to the fragment @query."""
+        vector = vector_store.get(query)
+        if vector is None:
+            return []
+
+        self_name = query[:-1] + "0"
+        return [
+            name
+            for _, name in vector_store.nearest(
+                vector, number, lambda name: name.endswith("0") and name != self_name
+            )
+        ]
+
+    def store_all_vectors(self, vector_store: VectorStore) -> None:
+        """Write the vectors of all fragments in the gaia dataset as a new model."""
+        dataset = self.gaia_db_new.dataset
+        descriptor = self.gaia_db_new.vector_descriptor
+        names = list(dataset.pointNames())
+        with self.stats.timer("analysis.store_all_vectors"):
+            vector_store.replace(
+                uuid4().hex,
+                self.vector_descriptors[self.profile],
+                names,
+                np.array(
+                    [point_vector(dataset.point(name), descriptor) for name in names]
+                ),
+            )
+
+    def get_dataset_size(self) -> int:
+        """Count the fragments in the gaia dataset or waiting for a model."""
+        if self.descriptor_db is not None:
+            return self.descriptor_db.size()
+
+        if self.vector_store is not None and self.gaia_db_new.transformed:
+            return 0
+
+        return self.gaia_db_new.dataset.size()
+
+    def save(self) -> None:
+        """Persist what was analyzed since the last save.
+
+        With a vector store the fragments were already written one at a
+        time. The gaia dataset is transformed when it is saved for the first
+        time, which starts a new model, and after that only its
+        transformation is kept.
+        """
+        if self.features.changed:
+            with self.stats.timer("analysis.save_features"):
+                self.features.save(self.features_path)
+        if self.descriptor_db is not None:
+            for name, descriptor_db in self.descriptor_dbs.items():
+                if descriptor_db.transformed or not descriptor_db.size():
+                    continue
+                with self.stats.timer("analysis.transform"):
+                    names, vectors = descriptor_db.fit_and_save()
+                with self.stats.timer("analysis.save"):
+                    self.vector_stores[name].replace(
+                        descriptor_db.version,
+                        self.vector_descriptors[name],
+                        names,
+                        vectors,
+                    )
+                if name == self.profile:
+                    self.rebuild_centroids()
+            return
+
+        if self.vector_store is None:
+            transformed = self.gaia_db_new.transformed
+            self.gaia_db_new = self.gaia_db_new.transform_and_save()
+            if not transformed:
+                self.rebuild_centroids()
+            return
+
+        if self.gaia_db_new.transformed or not self.gaia_db_new.dataset.size():
+            return
+
+        with self.stats.timer("analysis.transform"):
+            self.gaia_db_new.transform()
+        self.store_all_vectors(self.vector_store)
+        self.gaia_db_new.keep_history_only()
+        self.rebuild_centroids()
+
+    def has_fragment(self, name: str) -> bool:
+        if self.descriptor_db is not None:
+            return name in self.descriptor_db or name in self.vector_store
+
+        if self.vector_store is None:
+            return name in self.gaia_db_new
+
+        # Before the first transform, fragments wait in the gaia dataset.
+        return name in self.vector_store or (
+            not self.gaia_db_new.transformed and name in self.gaia_db_new
+        )
+
+    def get_fragment(self, name: str):
+        """Get the vector of a fragment from the store, or its gaia point."""
+        if self.vector_store is not None:
+            return self.vector_store.get(name)
+
+        return self.gaia_db_new.get(name)
+
+    def get_query_fragment(self, filename: str):
+        """Get the end fragment of a track, or its start if there is no end."""
+        fragment = self.get_fragment(filename + "1")
+        if fragment is None:
+            fragment = self.get_fragment(filename + "0")
+        return fragment
+
+    def distance(self, fragment, other_fragment) -> float:
+        if self.vector_store is not None:
+            return float(np.linalg.norm(fragment - other_fragment))
+
+        return self.gaia_db_new.metric(fragment, other_fragment)
+
+    def add_fragment(self, name: str, sig_path: Path) -> np.ndarray:
+        """Add the analysis of a fragment from its essentia signature file.
+
+        Returns the scalar features of the fragment.
+        """
+        with self.stats.timer("analysis.load_point"):
+            with sig_path.open() as sig:
+                signature = json.load(sig)
+            features = signature_features(signature)
+            if self.descriptor_db is None:
+                point = self.signature_point(signature)
+            else:
+                descriptors = signature_descriptors(signature)
+        with self.stats.timer("analysis.add_point"):
+            if self.descriptor_db is None:
+                self.add_point(name, point)
+                return features
+
+            for profile, descriptor_db in self.descriptor_dbs.items():
+                vector = descriptor_db.add(name, descriptors)
+                if vector is not None:
+                    self.vector_stores[profile].put(name, vector)
+        return features
+
+    def add_point(self, name: str, point: Point) -> None:
+        """Add a gaia point to the dataset, or its vector to the vector store.
+
+        Once there is a model, points go straight into the vector store.
+        """
+        if self.vector_store is None or not self.gaia_db_new.transformed:
+            self.gaia_db_new[name] = point
+            return
+
+        point.setName(name)
+        self.vector_store.put(
+            name,
+            point_vector(
+                self.gaia_db_new.map_point(point), self.gaia_db_new.vector_descriptor
+            ),
+        )
 
     def _analyze(self, filename: str) -> None:
         """Analyze an audio file."""
+        self._analyze_tracks([filename])
 
-        for i, ffmpeg_args in enumerate(FFMPEG_ARGS):
-            suffix = str(i)
-            if filename + suffix in self.gaia_db_new:
-                continue
+    def _analyze_tracks(self, filenames: List[str]) -> None:
+        """Analyze audio files, extracting up to @workers of them at once.
 
+        Only the extraction runs on the worker threads; fragments are added
+        to the dataset here, in order, as soon as their track is done. A
+        track that is queued more than once is only extracted once.
+        """
+        work = [
+            (filename, self.missing_fragments(filename))
+            for filename in dict.fromkeys(filter(None, filenames))
+        ]
+        for (filename, _), fragments in zip(
+            work, self.map_extraction(lambda item: self.extract_fragments(*item), work)
+        ):
+            self.add_fragments(filename, fragments)
+
+    def map_extraction(self, function, items):
+        if self.executor is None:
+            return map(function, items)
+
+        return self.executor.map(function, items)
+
+    def missing_fragments(self, filename: str) -> List[int]:
+        """Get which fragments of @filename still need to be analyzed."""
+        if self.vector_store is not None and self.vector_store.is_stale(filename):
+            self._remove_point(filename)
+
+        return [
+            i
+            for i in range(len(FFMPEG_ARGS))
+            if not self.has_fragment(filename + str(i))
+        ]
+
+    def extract_fragments(
+        self, filename: str, indices: List[int]
+    ) -> List[Tuple[str, Optional[Path]]]:
+        """Cut fragments out of an audio file and run the extractor on them.
+
+        Returns the fragment names with their signature files, up to and
+        including the first one that could not be analyzed, which has None.
+        Only runs subprocesses, so it is safe to call from several threads.
+        """
+        fragments = []
+        for i in indices:
             new_path = tmp_path(Path(filename).suffix)
 
             env = os.environ.copy()
             try:
-                subprocess.check_call(
-                    [
-                        "ffmpeg",
-                        *ffmpeg_args,
-                        "-i",
-                        filename,
-                        "-c:a",
-                        "copy",
-                        str(new_path),
-                        "-loglevel",
-                        "error",
-                        "-hide_banner",
-                    ],
-                    env=env,
-                    stderr=subprocess.DEVNULL,
-                    stdout=subprocess.DEVNULL,
-                )
+                with self.stats.timer("analysis.ffmpeg"):
+                    subprocess.check_call(
+                        [
+                            "ffmpeg",
+                            *FFMPEG_ARGS[i],
+                            "-i",
+                            filename,
+                            "-c:a",
+                            "copy",
+                            str(new_path),
+                            "-loglevel",
+                            "error",
+                            "-hide_banner",
+                        ],
+                        env=env,
+                        stderr=subprocess.DEVNULL,
+                        stdout=subprocess.DEVNULL,
+                    )
             except subprocess.CalledProcessError:
                 pass
 
             if not new_path.exists():
                 print("ffmpeg failed to extract")
+                self.stats.increment("analysis.ffmpeg_failures")
 
             sig_path = tmp_path(".sig")
-            if not (
-                self.essentia_analyze(self.gaia_db_new.dataset, new_path, sig_path)
-            ):
-                try:
-                    new_path.unlink()
-                except FileNotFoundError:
-                    pass
-                return
-
+            with self.stats.timer("analysis.essentia"):
+                analyzed = self.essentia_analyze(new_path, sig_path, self.extractor)
             try:
                 new_path.unlink()
             except FileNotFoundError:
                 pass
+            if not analyzed:
+                fragments.append((filename + str(i), None))
+                break
+
+            fragments.append((filename + str(i), sig_path))
+        return fragments
+
+    def add_fragments(
+        self, filename: str, fragments: List[Tuple[str, Optional[Path]]]
+    ) -> None:
+        """Add the extracted fragments of an audio file to the dataset."""
+        features = []
+        for name, sig_path in fragments:
+            if sig_path is None:
+                if self.vector_store is not None:
+                    self.vector_store.set_state(filename, FAILED)
+                return
+
             try:
-                point = self.load_point(sig_path)
-                self.gaia_db_new[filename + suffix] = point
+                features.append(self.add_fragment(name, sig_path))
                 self.analyzed += 1
+                self.stats.increment("analysis.fragments")
             except Exception as e:
                 print(e)
+                self.stats.increment("analysis.failures")
 
             try:
                 sig_path.unlink()
             except FileNotFoundError:
                 pass
 
+        self.stats.increment("analysis.tracks")
+        if features:
+            self.features.put(filename, track_features(features))
+        if self.vector_store is not None:
+            self.vector_store.set_state(filename, ANALYZED)
+        self.update_centroids(filename)
         print("{} songs left to analyze.".format(self.queue.qsize()))
 
     def _remove_point(self, filename: str) -> None:
         """Remove a point from the gaia database."""
+        self.album_index.remove(filename)
+        self.artist_index.remove(filename)
+        self.features.remove(filename)
+        for vector_store in self.vector_stores.values():
+            vector_store.remove(filename, [filename + "0", filename + "1"])
+        if self.descriptor_db is not None:
+            for descriptor_db in self.descriptor_dbs.values():
+                descriptor_db.remove(filename + "0")
+                descriptor_db.remove(filename + "1")
+            return
+
+        if self.vector_store is not None and self.gaia_db_new.transformed:
+            # Only the transformation of the gaia dataset is kept.
+            return
+
         try:
             self.gaia_db_new.dataset.removePoint(filename + "0")
         except Exception as exc:
@@ -276,27 +1565,32 @@ class GaiaAnalysis(Thread):
         except Exception as exc:
             print(exc)
 
-    def load_point(self, signame: Path) -> Point:
+    @staticmethod
+    def load_point(signame: Path) -> Point:
         """Load point data from JSON file."""
-        point = Point()
-
         with signame.open() as sig:
-            jsonsig = json.load(sig)
-            if jsonsig.get("metadata", {}).get("tags"):
-                del jsonsig["metadata"]["tags"]
-            yamlsig = yaml.dump(jsonsig)
-        point.loadFromString(yamlsig)
+            return GaiaAnalysis.signature_point(json.load(sig))
+
+    @staticmethod
+    def signature_point(jsonsig: dict) -> Point:
+        """Make a gaia point of an essentia signature."""
+        point = Point()
+        if jsonsig.get("metadata", {}).get("tags"):
+            del jsonsig["metadata"]["tags"]
+        point.loadFromString(yaml.dump(jsonsig))
         return point
 
     @staticmethod
-    def essentia_analyze(gaia_db, file_path: Path, signame: Path) -> bool:
+    def essentia_analyze(
+        file_path: Path, signame: Path, extractor: Sequence[str] = EXTRACTOR
+    ) -> bool:
         """Perform essentia analysis of an audio file."""
         filename = str(file_path)
 
         env = os.environ.copy()
         try:
             subprocess.check_call(
-                [ESSENTIA_EXTRACTOR_PATH, filename, str(signame)],
+                [*extractor, filename, str(signame)],
                 env=env,
                 stderr=subprocess.DEVNULL,
                 stdout=subprocess.DEVNULL,
@@ -314,28 +1608,49 @@ class GaiaAnalysis(Thread):
     def run(self) -> None:
         """Run main loop for gaia analysis thread."""
         print("STARTING GAIA ANALYSIS THREAD")
+        if self.workers > 1:
+            self.executor = ThreadPoolExecutor(self.workers)
         while True:
-            cmd, filename = self.queue.get()
-            print(cmd, filename)
-            while filename:
-                self.commands[cmd](filename)
-                try:
-                    cmd, filename = self.queue.get(block=False)
-                except Empty:
-                    self.gaia_db_new = self.gaia_db_new.transform_and_save()
+            commands = [self.queue.get()]
+            self.idle.clear()
+            self.take_waiting(commands)
+            while commands:
+                cmd, filename = commands.pop(0)
+                print(cmd, filename)
+                if filename and cmd == ADD:
+                    # Take the adds that are waiting right behind this one,
+                    # so the workers have something to do.
+                    filenames = [filename]
+                    while commands and commands[0][0] == ADD:
+                        filenames.append(commands.pop(0)[1])
+                    self._analyze_tracks(filenames)
+                elif filename:
+                    self.commands[cmd](filename)
+                self.take_waiting(commands)
+                if not commands:
+                    self.save()
                     break
                 if self.analyzed >= 500:
                     self.analyzed = 0
-                    self.gaia_db_new = self.gaia_db_new.transform_and_save()
+                    self.save()
             print(
                 "songs in db after processing queue: %d"
-                % self.gaia_db_new.dataset.size()
+                % self.get_dataset_size()
             )
             for sig_file in Path("/tmp").glob("*.sig"):
                 try:
                     sig_file.unlink()
                 except OSError as e:
                     print(f"Error: {sig_file}: {e}")
+            self.idle.set()
+
+    def take_waiting(self, commands: List[Tuple[str, str]]) -> None:
+        """Move queued commands to @commands, until there is one per worker."""
+        while len(commands) < self.workers:
+            try:
+                commands.append(self.queue.get(block=False))
+            except Empty:
+                break
 
     def analyze_and_wait(self, filenames: Sequence[str]) -> None:
         self.queue_filenames(filenames)
@@ -353,9 +1668,7 @@ class GaiaAnalysis(Thread):
 
     def get_best_match(self, filename: str, filenames: List[str]) -> Optional[str]:
         self.queue_filenames([filename] + filenames)
-        point = self.gaia_db_new.get(filename + "1") or self.gaia_db_new.get(
-            filename + "0"
-        )
+        point = self.get_query_fragment(filename)
         if point is None:
             if filenames:
                 return filenames[0] or ""
@@ -364,9 +1677,9 @@ class GaiaAnalysis(Thread):
 
         best, best_name = None, None
         for name in filenames:
-            if not (other_point := self.contains_or_add(name)[0]):
+            if (other_point := self.contains_or_add(name)[0]) is None:
                 continue
-            distance = self.gaia_db_new.metric(point, other_point)
+            distance = self.distance(point, other_point)
             print("%s, %s" % (distance, name))
             if best is None or distance < best:
                 best, best_name = distance, name
@@ -377,9 +1690,7 @@ class GaiaAnalysis(Thread):
         self, filename: str, filenames: List[str]
     ) -> List[Tuple[float, str]]:
         self.queue_filenames([filename] + filenames)
-        point = self.gaia_db_new.get(filename + "1") or self.gaia_db_new.get(
-            filename + "0"
-        )
+        point = self.get_query_fragment(filename)
         if point is None:
             if filenames:
                 return [(1, filenames[0])]
@@ -387,9 +1698,9 @@ class GaiaAnalysis(Thread):
             return []
 
         result = sorted(
-            (self.gaia_db_new.metric(point, other_point) * 1000, name)
+            (self.distance(point, other_point) * 1000, name)
             for name in filenames
-            if (other_point := self.contains_or_add(name)[0])
+            if (other_point := self.contains_or_add(name)[0]) is not None
         )
 
         if not result:
@@ -409,6 +1720,21 @@ class GaiaAnalysis(Thread):
 
     def get_neighbours(self, filename: str, number: int) -> List[Tuple[float, str]]:
         """Get a number of nearest neighbours."""
+        if self.vector_store is not None:
+            point = self.get_query_fragment(filename)
+            if point is None:
+                return []
+
+            self_name = filename + "0"
+            return [
+                (distance * 1000, name[:-1])
+                for distance, name in self.vector_store.nearest(
+                    point,
+                    number,
+                    lambda name: name.endswith("0") and name != self_name,
+                )
+            ]
+
         view = View(self.gaia_db_new.dataset)
 
         point = self.gaia_db_new.get(filename + "1") or self.gaia_db_new.get(
@@ -446,13 +1772,139 @@ class GaiaAnalysis(Thread):
             print(f"Decreasing search factor to {self.factor}")
         return result[:number]
 
-    def contains_or_add(self, filename: str) -> tuple[Point | None, Point | None]:
-        """Check if the filename exists in the database, queue it up if not."""
-        start_point = self.gaia_db_new.get(filename + "0")
-        end_point = self.gaia_db_new.get(filename + "1")
-        if not (start_point and end_point):
-            print(f"{filename} not found in gaia db starts or ends")
-            if filename in self.seen:
+    def miximize(
+        self, filenames: List[str], refine_seconds: float = 0, transitions=False
+    ) -> List[int]:
+        """Get the indices of @filenames in an order with smooth transitions.
+
+        Tracks that have not been analyzed yet are queued for analysis and
+        put at the end. If @refine_seconds is set, the greedy ordering is
+        improved with local search for at most that long. If @transitions is
+        set, going from track A to track B costs the distance from the end
+        of A to the start of B, rather than the distance between the tracks
+        as a whole.
+        """
+        return self.order_vectors(
+            self.get_track_vectors(filenames), refine_seconds, transitions
+        )
+
+    def order_vectors(
+        self, vectors, refine_seconds: float = 0, transitions=False
+    ) -> List[int]:
+        """Order tracks like miximize, from what get_track_vectors returned."""
+        found, missing, heads, tails = vectors
+        if len(found) < 3:
+            return found + missing
+
+        clusterer = Clusterer(
+            found,
+            track_distances(heads, tails, transitions),
+            directed=transitions,
+        )
+        clusterer.cluster()
+        if refine_seconds:
+            self.refine(clusterer, refine_seconds)
+        return [index for cluster in clusterer.clusters for index in cluster] + missing
+
+    def miximize_stream(
+        self,
+        filenames: List[str],
+        emit: Callable[[List[int], bool], None],
+        refine_seconds: float = 0,
+        transitions=False,
+    ) -> None:
+        """Order @filenames like miximize, emitting the order in chunks.
+
+        The first STREAM_CHUNK tracks are picked by walking to the nearest
+        neighbour from the first track, which only needs one row of
+        distances per step, and emitted right away. The rest is ordered with
+        the Clusterer starting from the last emitted track; the next chunk is
+        emitted before the remainder is refined. @emit is called with the
+        indices of each chunk and whether it is the last one.
+        """
+        vectors = self.get_track_vectors(filenames)
+        found, missing, heads, tails = vectors
+        if len(found) <= STREAM_CHUNK + 2:
+            emit(self.order_vectors(vectors, refine_seconds, transitions), True)
+            return
+
+        if transitions:
+            sources, targets = tails, heads
+        else:
+            sources = targets = (heads + tails) / 2
+        remaining = list(range(len(found)))
+        head = [remaining.pop(0)]
+        while len(head) < STREAM_CHUNK:
+            candidates = np.array(remaining)
+            distances = np.linalg.norm(targets[candidates] - sources[head[-1]], axis=1)
+            head.append(remaining.pop(int(np.argmin(distances))))
+        emit([found[i] for i in head], False)
+
+        rest = [head[-1]] + remaining
+        clusterer = Clusterer(
+            [found[i] for i in rest],
+            track_distances(heads[rest], tails[rest], transitions),
+            start=0,
+            directed=transitions,
+        )
+        clusterer.cluster()
+        order = clusterer.clusters[0]
+        emit(order[1 : STREAM_CHUNK + 1], False)
+        if refine_seconds:
+            self.refine(clusterer, refine_seconds, fixed=STREAM_CHUNK + 1)
+            order = clusterer.clusters[0]
+        emit(order[STREAM_CHUNK + 1 :] + missing, True)
+
+    def refine(self, clusterer, refine_seconds: float, fixed: int = 0) -> None:
+        with self.stats.timer("miximize.refine"):
+            before, after = clusterer.refine(refine_seconds, fixed=fixed)
+        print(
+            "refined miximize ordering from %f to %f (%.1f%% shorter)"
+            % (before, after, 100 * (before - after) / (before or 1))
+        )
+        self.stats.increment("miximize.refined")
+        self.stats.register_gauge(
+            "miximize.last_refinement", lambda: {"before": before, "after": after}
+        )
+
+    def get_track_vectors(
+        self, filenames: List[str]
+    ) -> Tuple[List[int], List[int], np.ndarray, np.ndarray]:
+        """Get the head and tail vectors for the analyzed tracks in @filenames.
+
+        Returns the indices of the analyzed tracks, the indices of the ones
+        that still need analysis, and the head and tail vectors of the
+        analyzed tracks as the rows of two arrays.
+        """
+        found, missing, heads, tails = [], [], [], []
+        for index, filename in enumerate(filenames):
+            start_point, end_point = self.contains_or_add(filename)
+            if start_point is None or end_point is None:
+                missing.append(index)
+                continue
+            found.append(index)
+            if self.vector_store is None:
+                descriptor = self.gaia_db_new.vector_descriptor
+                start_point, end_point = (
+                    point_vector(start_point, descriptor),
+                    point_vector(end_point, descriptor),
+                )
+            heads.append(start_point)
+            tails.append(end_point)
+        return found, missing, np.array(heads), np.array(tails)
+
+    def contains_or_add(self, filename: str) -> tuple:
+        """Check if the filename exists in the database, queue it up if not.
+
+        Returns the start and end fragments, as vectors when there is a vector
+        store and as gaia points otherwise.
+        """
+        start_point = self.get_fragment(filename + "0")
+        end_point = self.get_fragment(filename + "1")
+        if start_point is None or end_point is None:
+            self.stats.increment("lookup.misses")
+            print(f"{filename} not found in gaia db starts or ends")
+            if filename in self.seen:
                 print("already seen")
                 return None, None
 
@@ -460,6 +1912,7 @@ class GaiaAnalysis(Thread):
             self.queue.put((ADD, filename))
             return None, None
 
+        self.stats.increment("lookup.hits")
         return start_point, end_point
 
 
@@ -471,243 +1924,882 @@ class DatabaseWrapper(Thread):
         """Set the database path."""
         self.path = path
 
-    def set_queue(self, queue: Queue) -> None:
+    def set_queue(self, queue: SQLScheduler) -> None:
         """Set the queue to use."""
         self.queue = queue
 
+    def set_stats(self, stats: Stats) -> None:
+        """Set the stats to record to."""
+        self.stats = stats
+
+    def set_statement_stats(self, statement_stats: StatementStats) -> None:
+        """Set the per statement stats to record to."""
+        self.statement_stats = statement_stats
+
     def run(self) -> None:
         print("STARTING DATABASE WRAPPER THREAD")
         connection = sqlite3.connect(self.path, isolation_level="immediate")
+        # Write-ahead logging lets the readers run while a write is going on.
+        connection.execute("PRAGMA journal_mode=WAL;")
         cursor = connection.cursor()
-        commit_needed = False
         while True:
-            _, cmd = self.queue.get()
-            sql = cmd.sql
-            if sql == ("STOP",):
-                cmd.result_queue.put(None)
-                connection.close()
-                break
-            result = []
-            commit_needed = False
+            cmd = self.next_command()
+            # Writes are collected into one transaction with whatever else is
+            # already waiting, and their results are only handed back once
+            # the transaction is committed. Reads in between run on the same
+            # connection, so they see the uncommitted writes.
+            uncommitted: List[Tuple[SQLCommand, list]] = []
+            started = time()
+            while True:
+                if cmd.sql[0].upper().startswith("VACUUM"):
+                    # VACUUM cannot run inside a transaction.
+                    self.commit(connection, uncommitted)
+                    uncommitted = []
+                if cmd.sql == ("STOP",):
+                    self.commit(connection, uncommitted)
+                    if cmd.future.running():
+                        cmd.future.set_result(None)
+                    connection.close()
+                    return
+
+                try:
+                    if isinstance(cmd, SQLBatch):
+                        result = self.execute_batch(cursor, cmd)
+                    else:
+                        result = self.execute(cursor, cmd.sql, waited=cmd.waited)
+                except Exception as e:
+                    self.stats.increment("db.errors")
+                    cmd.future.set_exception(e)
+                else:
+                    if cmd.sql[0].upper().startswith("SELECT"):
+                        cmd.future.set_result(result)
+                    else:
+                        uncommitted.append((cmd, result))
+                if (
+                    not uncommitted
+                    or len(uncommitted) >= MAX_BATCH_STATEMENTS
+                    or time() - started >= MAX_BATCH_SECONDS
+                ):
+                    break
+                cmd = self.next_command(block=False)
+                if cmd is None:
+                    break
+            self.commit(connection, uncommitted)
+
+    def next_command(self, block: bool = True) -> Optional[SQLCommand]:
+        """Take the next command off the queue that was not cancelled.
+
+        Its future is marked running, so it can not be cancelled anymore
+        while the command runs. Returns None if nothing is waiting and
+        @block is False.
+        """
+        while True:
             try:
-                cursor.execute(*sql)
+                _, cmd = self.queue.get(block=block)
+            except Empty:
+                return None
+
+            if cmd.future.set_running_or_notify_cancel() or cmd.sql == ("STOP",):
+                return cmd
+
+            self.stats.increment("db.cancelled")
+
+    def execute(
+        self,
+        cursor: sqlite3.Cursor,
+        sql: tuple,
+        timer: str = "db.execute",
+        waited: float = 0.0,
+    ) -> list:
+        """Execute a single statement and fetch its result."""
+        start = time()
+        try:
+            cursor.execute(*sql)
+        except Exception as e:
+            print(e, repr(sql))
+            self.stats.increment("db.errors")
+        result = cursor.fetchall()
+        elapsed = time() - start
+        self.stats.record(timer, elapsed)
+        self.stats.increment("db.statements")
+        self.statement_stats.record(
+            sql[0],
+            elapsed,
+            len(result) if result else max(cursor.rowcount, 0),
+            waited,
+            lambda: self.explain(cursor, sql),
+        )
+        return result
+
+    def execute_batch(self, cursor: sqlite3.Cursor, cmd: SQLBatch) -> List[int]:
+        """Execute each statement of a batch for all of its rows."""
+        changed = []
+        batch_start = time()
+        for statement, rows in zip(cmd.sql, cmd.rows):
+            start = time()
+            try:
+                cursor.executemany(statement, rows)
+                changed.append(cursor.rowcount)
             except Exception as e:
-                print(e, repr(sql))
-            if not sql[0].upper().startswith("SELECT"):
-                commit_needed = True
-            for row in cursor.fetchall():
-                result.append(row)
-            if commit_needed:
-                connection.commit()
-            cmd.result_queue.put(result)
+                print(e, repr(statement))
+                self.stats.increment("db.errors")
+                changed.append(0)
+            self.statement_stats.record(
+                statement,
+                time() - start,
+                max(changed[-1], 0),
+                cmd.waited,
+                lambda: self.explain(cursor, (statement,) + tuple(rows[:1])),
+            )
+        self.stats.record("db.execute_batch", time() - batch_start)
+        self.stats.increment("db.statements", len(cmd.sql))
+        return changed
 
+    @staticmethod
+    def explain(cursor: sqlite3.Cursor, sql: tuple) -> str:
+        """Get the query plan for a statement."""
+        try:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql[0], *sql[1:])
+            return "\n".join(row[-1] for row in cursor.fetchall())
+        except sqlite3.Error as e:
+            return repr(e)
 
-class Pair:
+    def commit(
+        self, connection: sqlite3.Connection, uncommitted: List[Tuple[SQLCommand, list]]
+    ) -> None:
+        """Commit the open transaction and hand back the results of its writes."""
+        if not uncommitted:
+            return
 
-    """A pair of songs."""
+        start = time()
+        try:
+            connection.commit()
+        except sqlite3.Error as e:
+            print(e)
+            self.stats.increment("db.errors")
+            connection.rollback()
+            for cmd, _ in uncommitted:
+                cmd.future.set_exception(e)
+            return
 
-    def __init__(self, song1: str, song2: str, song_distance: float):
-        self.song1 = song1
-        self.song2 = song2
-        self.distance = song_distance
+        self.stats.record("db.commit", time() - start)
+        self.stats.increment("db.commits")
+        self.stats.increment("db.committed_statements", len(uncommitted))
+        for cmd, result in uncommitted:
+            cmd.future.set_result(result)
 
-    def other(self, song: str) -> str:
-        """Return the song paired with @song."""
-        if self.song1 == song:
-            return self.song2
-        return self.song1
 
-    def songs(self) -> List[str]:
-        """Return both songs."""
-        return [self.song1, self.song2]
+class DatabaseReader(DatabaseWrapper):
 
-    def __eq__(self, other) -> bool:
-        return self.song1 == other.song1 and self.song2 == other.song2
+    """Thread that answers SELECTs on its own read-only connection."""
 
-    def __repr__(self) -> str:
-        return "<Pair {song1}, {song2}: {distance}>".format(
-            song1=self.song1, song2=self.song2, distance=self.distance
+    def run(self) -> None:
+        connection = sqlite3.connect(
+            "file:%s?mode=ro" % (quote(self.path),), uri=True, isolation_level=None
         )
+        cursor = connection.cursor()
+        while True:
+            cmd = self.next_command()
+            try:
+                result = self.execute(
+                    cursor, cmd.sql, timer="db.read", waited=cmd.waited
+                )
+            except Exception as e:
+                self.stats.increment("db.errors")
+                cmd.future.set_exception(e)
+            else:
+                cmd.future.set_result(result)
+
+
+CANDIDATES = 16
+STREAM_CHUNK = 10
 
 
 class Clusterer(object):
 
-    """Build a list of songs in optimized order."""
+    """Build a list of songs in optimized order.
+
+    Pairs of songs are considered from most to least similar, and a pair is
+    joined whenever both songs are still at the end of a chain and not
+    already in the same chain, until a single chain is left.
+
+    Rather than sorting all pairs up front, every song offers its nearest
+    unused neighbours to a heap, a few at a time. Chains are tracked with a
+    union-find structure, and the songs at the ends of the chains with a map
+    to the song at the other end.
+
+    If @start is given, the chain will begin with the song at that position.
+    If @directed is set, distances[a, b] is the cost of playing b right after
+    a, which need not be the same as distances[b, a], and the chain is only
+    ever joined tail to head.
+    """
 
     def __init__(
-        self, songs: Sequence[str], comparison_function: Callable[[str, str], float]
+        self,
+        songs: Sequence[Any],
+        distances: np.ndarray,
+        start: Optional[int] = None,
+        directed: bool = False,
     ):
-        self.clusters: List[List[str]] = []
-        self.ends: List[str] = []
-        self.similarities: List[Pair] = []
-        self.build_similarity_matrix(songs, comparison_function)
+        self.songs = list(songs)
+        self.distances = distances
+        self.start = start
+        self.directed = directed
+        self.clusters: List[List[Any]] = []
+        size = len(self.songs)
+        self.capacity = [2] * size
+        if start is not None:
+            self.capacity[start] = 1
+        self.parents = list(range(size))
+        self.ends = {i: i for i in range(size)}
+        self.links: List[List[int]] = [[] for _ in range(size)]
+        self.successors: List[Optional[int]] = [None] * size
+        self.predecessors: List[Optional[int]] = [None] * size
+        self.neighbours: List[np.ndarray] = []
+        self.offered = [0] * size
+        self.build_candidates()
+
+    def build_candidates(self) -> None:
+        """Find the nearest few neighbours of every song in one pass."""
+        size = len(self.songs)
+        distances = self.distances.copy()
+        np.fill_diagonal(distances, np.inf)
+        number = min(CANDIDATES, size - 1)
+        nearest = np.argpartition(distances, number - 1, axis=1)[:, :number]
+        order = np.argsort(np.take_along_axis(distances, nearest, axis=1), axis=1)
+        self.neighbours = list(np.take_along_axis(nearest, order, axis=1))
+
+    def next_candidate(self, song: int) -> Optional[int]:
+        """Get the next nearest neighbour @song has not offered yet."""
+        position = self.offered[song]
+        if position >= len(self.neighbours[song]):
+            if len(self.neighbours[song]) >= len(self.songs) - 1:
+                return None
+            # Ran out of precomputed neighbours, sort the whole row.
+            row = np.argsort(self.distances[song], kind="stable")
+            self.neighbours[song] = row[row != song]
+        self.offered[song] = position + 1
+        return int(self.neighbours[song][position])
+
+    def has_room(self, song: int, outgoing: bool = True) -> bool:
+        """Check whether @song can be linked to one more song."""
+        if not self.directed:
+            return len(self.links[song]) < self.capacity[song]
+        if outgoing:
+            return self.successors[song] is None
+        return self.predecessors[song] is None and song != self.start
+
+    def offer(self, heap: List[Tuple[float, int, int]], song: int) -> None:
+        while self.has_room(song):
+            other = self.next_candidate(song)
+            if other is None:
+                return
+            if self.can_join(song, other):
+                heappush(heap, (self.distances[song, other], song, other))
+                return
 
-    def build_similarity_matrix(
-        self, songs: Sequence[str], comparison_function: Callable[[str, str], float]
-    ) -> None:
-        """Build the similarity matrix."""
-        for song1 in songs:
-            for song2 in songs[songs.index(song1) + 1 :]:
-                self.similarities.append(
-                    Pair(song1, song2, comparison_function(song1, song2))
-                )
-        # sort in reverse, since we'll be popping off the end
-        self.similarities.sort(reverse=True, key=lambda x: x.distance)
-
-    def join(self, cluster1: List[str], cluster2: List[str]) -> List[str]:
-        """Join two clusters together."""
-        if cluster1[0] == cluster2[0]:
-            cluster2.reverse()
-            self.clean(cluster1[0])
-            return cluster2 + cluster1[1:]
-        elif cluster1[-1] == cluster2[0]:
-            self.clean(cluster1[-1])
-            return cluster1 + cluster2[1:]
-        elif cluster1[0] == cluster2[-1]:
-            self.clean(cluster1[0])
-            return cluster2 + cluster1[1:]
-        cluster2.reverse()
-        self.clean(cluster1[-1])
-        return cluster1[:-1] + cluster2
-
-    def pop_cluster_ending_in(self, song: str) -> List[str]:
-        """Pop a cluster with @song at either end."""
-        for cluster in self.clusters[:]:
-            if cluster[0] == song:
-                self.clusters.remove(cluster)
-                self.ends.remove(cluster[0])
-                self.ends.remove(cluster[-1])
-                return cluster
-
-            if cluster[-1] == song:
-                self.clusters.remove(cluster)
-                self.ends.remove(cluster[0])
-                self.ends.remove(cluster[-1])
-                return cluster
-
-        return []
-
-    def cluster(self):
-        """Build clusters out of similarity matrix."""
-        sim = self.similarities.pop()
-        self.clusters = [sim.songs()]
-        self.ends = sim.songs()
-        while self.similarities:
-            sim = self.similarities.pop()
-            songs = sim.songs()
-            if sim.song1 in self.ends or sim.song2 in self.ends:
-                cluster1 = self.pop_cluster_ending_in(sim.song1)
-                cluster2 = self.pop_cluster_ending_in(sim.song2)
-                if cluster1 and cluster2:
-                    new_cluster = self.join(cluster1, songs)
-                    new_cluster = self.join(new_cluster, cluster2)
-                elif cluster1:
-                    if sim.song1 in cluster1 and sim.song2 in cluster1:
-                        new_cluster = cluster1
-                    else:
-                        new_cluster = self.join(cluster1, songs)
-                else:
-                    if sim.song1 in cluster2 and sim.song2 in cluster2:
-                        new_cluster = cluster2
-                    else:
-                        new_cluster = self.join(cluster2, songs)
-                self.clusters.append(new_cluster)
-                self.ends.extend([new_cluster[0], new_cluster[-1]])
+    def find(self, song: int) -> int:
+        """Find the chain @song belongs to."""
+        parents = self.parents
+        while parents[song] != song:
+            parents[song] = parents[parents[song]]
+            song = parents[song]
+        return song
+
+    def can_join(self, song1: int, song2: int) -> bool:
+        return (
+            song1 in self.ends
+            and song2 in self.ends
+            and self.has_room(song1)
+            and self.has_room(song2, outgoing=False)
+            and self.find(song1) != self.find(song2)
+        )
+
+    def join(self, song1: int, song2: int) -> None:
+        """Join the chains ending in @song1 and @song2."""
+        end1 = self.ends.pop(song1)
+        end2 = self.ends.pop(song2)
+        self.ends[end1] = end2
+        self.ends[end2] = end1
+        self.parents[self.find(song1)] = self.find(song2)
+        if self.directed:
+            self.successors[song1] = song2
+            self.predecessors[song2] = song1
+            return
+
+        self.links[song1].append(song2)
+        self.links[song2].append(song1)
+
+    def cluster(self) -> None:
+        """Join songs into a single chain, most similar pairs first."""
+        size = len(self.songs)
+        if size < 2:
+            self.clusters = [self.songs[:]]
+            return
+
+        heap: List[Tuple[float, int, int]] = []
+        for song in range(size):
+            self.offer(heap, song)
+        joined = 0
+        while heap and joined < size - 1:
+            _, song1, song2 = heappop(heap)
+            if self.can_join(song1, song2):
+                self.join(song1, song2)
+                joined += 1
+            self.offer(heap, song1)
+        self.order = np.array(self.chain())
+        self.clusters = [[self.songs[i] for i in self.order]]
+
+    def chain(self) -> List[int]:
+        """Walk the joined chain from one end to the other."""
+        start = self.start
+        if self.directed:
+            if start is None:
+                start = self.predecessors.index(None)
+            chain = [start]
+            while (following := self.successors[chain[-1]]) is not None:
+                chain.append(following)
+            return chain
+
+        if start is None:
+            start = min(song for song, links in enumerate(self.links) if len(links) < 2)
+        chain = [start]
+        previous, current = None, start
+        while True:
+            following = [song for song in self.links[current] if song != previous]
+            if not following:
+                return chain
+            previous, current = current, following[0]
+            chain.append(current)
+
+    def length(self, order: np.ndarray) -> float:
+        """Get the sum of the distances between consecutive songs."""
+        return float(self.distances[order[:-1], order[1:]].sum())
+
+    def refine(self, seconds: float, fixed: int = 0) -> Tuple[float, float]:
+        """Improve the chain with local search until @seconds have passed.
+
+        Alternates 2-opt moves (reversing a stretch of the chain) and Or-opt
+        moves (moving a stretch of one to three songs elsewhere) until
+        neither finds an improvement or time runs out. The first @fixed
+        songs are left where they are. Returns the chain length before and
+        after.
+        """
+        deadline = time() + seconds
+        order = self.order
+        if self.start is not None:
+            fixed = max(fixed, 1)
+        before = self.length(order)
+        improved = len(order) - fixed > 3
+        while improved and time() < deadline:
+            # Reversing a stretch changes its cost when distances are directed.
+            improved = not self.directed and self.two_opt(order, deadline, fixed)
+            improved = self.or_opt(order, deadline, fixed) or improved
+        self.clusters = [[self.songs[i] for i in order]]
+        return before, self.length(order)
+
+    def two_opt(self, order: np.ndarray, deadline: float, fixed: int) -> bool:
+        """Reverse stretches of the chain where that shortens it."""
+        distances = self.distances
+        size = len(order)
+        improved = False
+        for i in range(fixed - 1, size - 2):
+            if time() > deadline:
+                break
+            # Reverse order[i + 1:j + 1] for the best j.
+            ends = order[i + 2 :]
+            nexts = np.append(order[i + 3 :], -1)
+            if i == -1:
+                deltas = np.zeros(len(ends))
             else:
-                self.clusters.append(songs)
-                self.ends.extend(songs)
-
-    def clean(self, found: str) -> None:
-        """Remove similarity scores for processed cluster."""
-        new = []
-        for sim in self.similarities:
-            if found in sim.songs():
-                continue
-            new.append(sim)
-        self.similarities = new
+                a, b = order[i], order[i + 1]
+                deltas = distances[a, ends] - distances[a, b]
+            deltas[:-1] += (
+                distances[order[i + 1], nexts[:-1]] - distances[ends[:-1], nexts[:-1]]
+            )
+            best = int(np.argmin(deltas))
+            if deltas[best] < -1e-9:
+                j = i + 2 + best
+                order[i + 1 : j + 1] = order[i + 1 : j + 1][::-1].copy()
+                improved = True
+        return improved
+
+    def or_opt(self, order: np.ndarray, deadline: float, fixed: int) -> bool:
+        """Move stretches of up to three songs to where they fit better."""
+        distances = self.distances
+        improved = False
+        for length in (1, 2, 3):
+            i = fixed
+            while i + length <= len(order):
+                if time() > deadline:
+                    return improved
+                first, last = order[i], order[i + length - 1]
+                removed = 0.0
+                if i > 0:
+                    removed += distances[order[i - 1], first]
+                if i + length < len(order):
+                    removed += distances[last, order[i + length]]
+                if 0 < i < len(order) - length:
+                    removed -= distances[order[i - 1], order[i + length]]
+                rest = np.concatenate((order[:i], order[i + length :]))
+                # Cost of inserting before rest[0], after rest[-1], or in
+                # between each consecutive pair, in either direction.
+                forward = np.concatenate(
+                    (
+                        [distances[last, rest[0]]],
+                        distances[rest[:-1], first]
+                        + distances[last, rest[1:]]
+                        - distances[rest[:-1], rest[1:]],
+                        [distances[rest[-1], first]],
+                    )
+                )
+                backward = np.concatenate(
+                    (
+                        [distances[first, rest[0]]],
+                        distances[rest[:-1], last]
+                        + distances[first, rest[1:]]
+                        - distances[rest[:-1], rest[1:]],
+                        [distances[rest[-1], last]],
+                    )
+                )
+                forward[:fixed] = np.inf
+                backward[:fixed] = np.inf
+                if self.directed:
+                    backward[:] = np.inf
+                reverse = bool(backward.min() < forward.min())
+                added = backward if reverse else forward
+                position = int(np.argmin(added))
+                if added[position] - removed < -1e-9:
+                    segment = order[i : i + length]
+                    if reverse:
+                        segment = segment[::-1]
+                    order[:] = np.concatenate(
+                        (rest[:position], segment, rest[position:])
+                    )
+                    improved = True
+                i += 1
+        return improved
 
 
 class Similarity(object):
 
     """Here the actual similarity computation and lookup happens."""
 
-    def __init__(self):
+    def __init__(
+        self,
+        acoustic_backend=None,
+        vector_store=VECTOR_STORE_GAIA,
+        profile=DEFAULT_PROFILE,
+        extra_profiles=(),
+        analysis_workers=1,
+        extractor=EXTRACTOR,
+    ):
+        """Open the databases and start the analysis thread.
+
+        @acoustic_backend is ACOUSTIC_GAIA or ACOUSTIC_NUMPY, by default gaia
+        when it is installed. The numpy backend always keeps its vectors in
+        similarity.db; for gaia @vector_store chooses. @profile serves the
+        lookups, and the numpy backend builds @extra_profiles alongside it.
+        @analysis_workers audio files are run through @extractor at once.
+        """
         data_dir = player_get_data_dir()
         self.db_path = os.path.join(data_dir, "similarity.db")
-        self.db_queue: PriorityQueue = PriorityQueue()
+        self.stats = Stats()
+        self.statement_stats = StatementStats()
+        self.db_queue = SQLScheduler("db.queue", self.stats)
+        self.db_read_queue = SQLScheduler("db.read_queue", self.stats)
         self._db_wrapper = DatabaseWrapper()
         self._db_wrapper.daemon = True
         self._db_wrapper.set_path(self.db_path)
         self._db_wrapper.set_queue(self.db_queue)
+        self._db_wrapper.set_stats(self.stats)
+        self._db_wrapper.set_statement_stats(self.statement_stats)
         self._db_wrapper.start()
         self.create_db()
+        self._db_readers = []
+        for _ in range(DATABASE_READERS):
+            reader = DatabaseReader()
+            reader.daemon = True
+            reader.set_path(self.db_path)
+            reader.set_queue(self.db_read_queue)
+            reader.set_stats(self.stats)
+            reader.set_statement_stats(self.statement_stats)
+            reader.start()
+            self._db_readers.append(reader)
+        self.artist_ids = NameCache("artists", ARTIST_CACHE_SIZE, self.stats)
+        self.track_ids = NameCache("tracks", TRACK_CACHE_SIZE, self.stats)
+        self.warm_caches()
+        self.artist_graph = Adjacency("artists")
+        self.track_graph = Adjacency("tracks")
         self.cache_time = 90
-        if GAIA:
-            self.gaia_queue: LifoQueue = LifoQueue()
-            self.gaia_analyser = GaiaAnalysis(self.gaia_queue)
-            self.gaia_analyser.daemon = True
-            self.gaia_analyser.start()
-
-    def execute_sql(self, sql=None, priority=1, command=None):
-        """Put sql command on the queue to be executed."""
+        self.refine_seconds = 0.0
+        self.transitions = False
+        self.stats.register_gauge("db.queue_depth", self.db_queue.depths)
+        self.stats.register_gauge("db.read_queue_depth", self.db_read_queue.depths)
+        self.stats.register_gauge(
+            "db.statements_per_commit", self.get_statements_per_commit
+        )
+        self.stats.register_gauge("db.by_statement", self.statement_stats.snapshot)
+        for graph in (self.artist_graph, self.track_graph):
+            self.stats.register_gauge("graph.%s" % graph.name, graph.describe)
+        for cache in (self.artist_ids, self.track_ids):
+            self.stats.register_gauge("cache.%s.size" % cache.name, cache.__len__)
+            self.stats.register_gauge(
+                "cache.%s.hit_ratio" % cache.name, cache.hit_ratio
+            )
+        if acoustic_backend is None:
+            acoustic_backend = ACOUSTIC_GAIA if GAIA else ACOUSTIC_NUMPY
+        if acoustic_backend == ACOUSTIC_GAIA and not GAIA:
+            print("gaia2 is not installed, using the numpy backend")
+            acoustic_backend = ACOUSTIC_NUMPY
+        self.gaia_queue: LifoQueue = LifoQueue()
+        self.gaia_analyser = GaiaAnalysis(
+            self.gaia_queue,
+            self.stats,
+            backend=acoustic_backend,
+            profile=profile,
+            extra_profiles=extra_profiles,
+            workers=analysis_workers,
+            extractor=extractor,
+        )
+        if acoustic_backend == ACOUSTIC_NUMPY or vector_store == VECTOR_STORE_SQLITE:
+            self.set_vector_stores()
+        print("songs in db: %d" % self.gaia_analyser.get_dataset_size())
+        self.load_track_groups()
+        for index in (self.gaia_analyser.album_index, self.gaia_analyser.artist_index):
+            self.stats.register_gauge(
+                "analysis.centroids.%s" % index.name, index.describe
+            )
+        self.stats.register_gauge(
+            "analysis.features", self.gaia_analyser.features.describe
+        )
+        self.gaia_analyser.daemon = True
+        self.gaia_analyser.start()
+        self.stats.register_gauge("analysis.queue_depth", self.gaia_queue.qsize)
+        self.stats.register_gauge(
+            "analysis.dataset_size", self.gaia_analyser.get_dataset_size
+        )
+
+    def get_statements_per_commit(self):
+        counters = self.stats.snapshot_counters()
+        commits = counters.get("db.commits", 0)
+        return counters.get("db.committed_statements", 0) / commits if commits else 0
+
+    def get_stats(self):
+        """Get a JSON snapshot of the service's counters and timings."""
+        return json.dumps(self.stats.snapshot())
+
+    def set_vector_stores(self):
+        """Keep the acoustic vectors of every profile in similarity.db."""
+        vector_stores = {}
+        for profile in self.gaia_analyser.profiles:
+            vector_store = VectorStore(
+                self.execute_sql, profile_file_name("vectors", profile, "")
+            )
+            vector_store.create()
+            vector_stores[profile] = vector_store
+            self.stats.register_gauge(
+                "analysis.vector_store.%s" % profile, vector_store.describe
+            )
+        with self.stats.timer("analysis.load_vectors"):
+            self.gaia_analyser.set_vector_stores(vector_stores)
+
+    def load_track_groups(self):
+        """Read the albums and artists of the tracks, and compute their centroids."""
+        groups: Dict[str, Tuple[str, List[str]]] = {}
+        for filename, kind, key in self.execute_sql(
+            ("SELECT filename, kind, key FROM track_groups;",), priority=0
+        ).result():
+            album, artists = groups.setdefault(filename, ("", []))
+            if kind == ALBUM:
+                groups[filename] = (key, artists)
+            else:
+                artists.append(key)
+        self.gaia_analyser.groups = {
+            filename: (album, tuple(artists))
+            for filename, (album, artists) in groups.items()
+        }
+        self.gaia_analyser.rebuild_centroids()
+
+    def set_track_groups(self, filename, album, artists):
+        """Tell which album and artists a track belongs to.
+
+        @album is any key that identifies the album, like its musicbrainz id.
+        """
+        self.set_track_groups_many([(filename, album, artists)])
+
+    def set_track_groups_many(self, tracks):
+        """Tell which album and artists each of the tracks belongs to.
+
+        @tracks is a list of (filename, album, artists) triples, which are
+        all written in one transaction.
+        """
+        tracks = [track for track in tracks if track[0]]
+        if not tracks:
+            return
+        rows = []
+        for filename, album, artists in tracks:
+            rows.extend((filename, ARTIST, artist) for artist in artists if artist)
+            if album:
+                rows.append((filename, ALBUM, album))
+        self.execute_sql(
+            command=SQLBatch(
+                [
+                    (
+                        "DELETE FROM track_groups WHERE filename = ?;",
+                        [(filename,) for filename, _, _ in tracks],
+                    ),
+                    (
+                        "INSERT OR IGNORE INTO track_groups (filename, kind, key)"
+                        " VALUES (?, ?, ?);",
+                        rows,
+                    ),
+                ]
+            ),
+            priority=10,
+        )
+        for filename, album, artists in tracks:
+            self.gaia_analyser.set_track_groups(filename, album, artists)
+
+    def get_track_features(self, filenames, name):
+        """Get a scalar feature, like bpm, of tracks; NaN where it is unknown."""
+        if name not in NAMES:
+            raise ValueError(
+                "Unknown feature %r, known features are: %s" % (name, ", ".join(NAMES))
+            )
+
+        return self.gaia_analyser.features.lookup(filenames, name).tolist()
+
+    def get_similar_albums(self, album, number):
+        """Get the albums that sound most like @album, by their centroids."""
+        with self.stats.timer("lookup.similar_albums"):
+            return self.gaia_analyser.album_index.nearest(album, number)
+
+    def get_similar_sounding_artists(self, artist, number):
+        """Get the artists that sound most like @artist, by their centroids."""
+        with self.stats.timer("lookup.similar_sounding_artists"):
+            return self.gaia_analyser.artist_index.nearest(artist, number)
+
+    def use_profile(self, profile):
+        """Serve lookups from another profile that is being built."""
+        self.gaia_analyser.use_profile(profile)
+
+    def get_profile_report(self):
+        """Get a JSON comparison of the profiles that are being built."""
+        return json.dumps(self.gaia_analyser.get_profile_report())
+
+    def dump_stats_periodically(self, path, interval):
+        """Start writing the stats to @path every @interval seconds."""
+        dumper = StatsDumper(self.stats, path, interval)
+        dumper.daemon = True
+        dumper.start()
+
+    def execute_sql(self, sql=None, priority=1, command=None) -> Future:
+        """Put sql command on the queue to be executed.
+
+        SELECTs go to the pool of read-only connections, everything else to
+        the single writer. Returns a future for the fetched rows, so several
+        queries can be in flight at once.
+        """
         if command is None:
             command = SQLCommand(sql)
-        self.db_queue.put((priority, command))
-
-    def get_sql_command(self, sql, priority=1):
-        """Build a SQLCommand, put it on the queue and return it."""
-        command = SQLCommand(sql)
-        self.execute_sql(command=command, priority=priority)
-        return command
+        if command.sql[0].upper().startswith("SELECT"):
+            self.db_read_queue.put((priority, command))
+        else:
+            self.db_queue.put((priority, command))
+        return command.future
+
+    def execute_sql_async(self, sql=None, priority=1, command=None):
+        """Like execute_sql, but awaitable from the running event loop."""
+        return asyncio.wrap_future(
+            self.execute_sql(sql=sql, priority=priority, command=command)
+        )
 
     def remove_track_by_filename(self, filename):
         if not filename:
             return
-        if GAIA:
-            self.gaia_queue.put((REMOVE, filename))
+        self.execute_sql(
+            ("DELETE FROM track_groups WHERE filename = ?;", (filename,)), priority=10
+        )
+        self.gaia_analyser.forget_track_groups(filename)
+        self.gaia_queue.put((REMOVE, filename))
 
     def get_ordered_gaia_tracks_from_list(self, filename, filenames):
         start_time = time()
         tracks = self.gaia_analyser.get_ordered_matches(filename, filenames)
-        print("finding gaia matches took %f s" % (time() - start_time,))
+        elapsed = time() - start_time
+        self.stats.record("lookup.ordered_matches", elapsed)
+        print("finding gaia matches took %f s" % (elapsed,))
         return tracks
 
     def get_ordered_gaia_tracks(self, filename, number):
         """Get neighbours for track."""
         start_time = time()
         tracks = self.gaia_analyser.get_tracks(filename, number)
-        print("finding gaia matches took %f s" % (time() - start_time,))
+        elapsed = time() - start_time
+        self.stats.record("lookup.neighbours", elapsed)
+        print("finding gaia matches took %f s" % (elapsed,))
         return tracks
 
+    def warm_caches(self):
+        """Load the most recently updated artist and track ids in bulk."""
+        artists = self.execute_sql(
+            (
+                "SELECT id, name FROM artists ORDER BY updated DESC LIMIT ?;",
+                (ARTIST_CACHE_SIZE,),
+            ),
+            priority=0,
+        )
+        tracks = self.execute_sql(
+            (
+                "SELECT id, artist, title FROM tracks ORDER BY updated DESC LIMIT ?;",
+                (TRACK_CACHE_SIZE,),
+            ),
+            priority=0,
+        )
+        # Oldest first, so the most recently updated end up least likely to be
+        # evicted.
+        for artist_id, name in reversed(artists.result()):
+            self.artist_ids.put(name, artist_id)
+        for track_id, artist_id, title in reversed(tracks.result()):
+            self.track_ids.put((artist_id, title), track_id)
+
+    def get_artist_id(self, artist_name):
+        """Get the id of an artist, adding the artist when it is new."""
+        artist_id = self.artist_ids.get(artist_name)
+        if artist_id is None:
+            artist_id = self.find_artist_id(artist_name)
+        if artist_id is None:
+            sql = ("INSERT OR IGNORE INTO artists (name) VALUES (?);", (artist_name,))
+            self.execute_sql(sql, priority=0).result()
+            artist_id = self.find_artist_id(artist_name)
+        return artist_id
+
+    def get_track_id(self, artist_name, title):
+        """Get the id of a track, adding the track when it is new."""
+        artist_id = self.get_artist_id(artist_name)
+        track_id = self.track_ids.get((artist_id, title))
+        if track_id is None:
+            track_id = self.find_track_id(artist_id, title)
+        if track_id is None:
+            sql = (
+                "INSERT OR IGNORE INTO tracks (artist, title) VALUES (?, ?);",
+                (artist_id, title),
+            )
+            self.execute_sql(sql, priority=2).result()
+            track_id = self.find_track_id(artist_id, title)
+        return track_id
+
     def get_artist(self, artist_name):
-        """Get artist information from the database."""
-        sql = ("SELECT * FROM artists WHERE name = ?;", (artist_name,))
-        command = self.get_sql_command(sql, priority=1)
-        for row in command.result_queue.get():
-            return row
-        sql2 = ("INSERT INTO artists (name) VALUES (?);", (artist_name,))
-        command = self.get_sql_command(sql2, priority=0)
-        command.result_queue.get()
-        command = self.get_sql_command(sql, priority=1)
-        for row in command.result_queue.get():
-            return row
+        """Get artist information from the database.
+
+        The id comes from the id cache when it can, so only the row itself
+        is read.
+        """
+        return self.get_row(
+            "SELECT * FROM artists WHERE id = ?;", self.get_artist_id(artist_name)
+        )
 
     def get_track_from_artist_and_title(self, artist_name: str, title: str):
         """Get track information from the database."""
-        artist_id = self.get_artist(artist_name)[0]
+        return self.get_row(
+            "SELECT * FROM tracks WHERE id = ?;", self.get_track_id(artist_name, title)
+        )
+
+    def get_row(self, sql, row_id):
+        """Get the row that @sql selects by @row_id, if there is one."""
+        for row in self.execute_sql((sql, (row_id,)), priority=1).result():
+            return row
+        return None
+
+    def find_artist_id(self, artist_name):
+        """Look up the id of an artist, remembering it."""
+        sql = ("SELECT id FROM artists WHERE name = ?;", (artist_name,))
+        for (artist_id,) in self.execute_sql(sql, priority=1).result():
+            self.artist_ids.put(artist_name, artist_id)
+            return artist_id
+        return None
+
+    def find_track_id(self, artist_id, title):
+        """Look up the id of a track, remembering it."""
         sql = (
-            "SELECT * FROM tracks WHERE artist = ? AND title = ?;",
+            "SELECT id FROM tracks WHERE artist = ? AND title = ?;",
             (artist_id, title),
         )
-        command = self.get_sql_command(sql, priority=3)
-        for row in command.result_queue.get():
-            return row
-        sql2 = ("INSERT INTO tracks (artist, title) VALUES (?, ?);", (artist_id, title))
-        command = self.get_sql_command(sql2, priority=2)
-        command.result_queue.get()
-        command = self.get_sql_command(sql, priority=3)
-        for row in command.result_queue.get():
-            return row
+        for (track_id,) in self.execute_sql(sql, priority=3).result():
+            self.track_ids.put((artist_id, title), track_id)
+            return track_id
+        return None
+
+    def remember_artist_ids(self, names: List[str]) -> None:
+        """Put the ids of the artists called @names in the id cache."""
+        for i in range(0, len(names), MAX_SQL_VARIABLES):
+            chunk = names[i : i + MAX_SQL_VARIABLES]
+            self.execute_sql(
+                (
+                    "SELECT id, name FROM artists WHERE name IN (%s);"
+                    % ", ".join("?" * len(chunk)),
+                    chunk,
+                ),
+                priority=1,
+            ).add_done_callback(
+                lambda future: [
+                    self.artist_ids.put(name, artist_id)
+                    for artist_id, name in future.result()
+                ]
+            )
+
+    def remember_track_ids(self, tracks: List[Tuple[str, str]]) -> None:
+        """Put the ids of the (artist name, title) @tracks in the id caches."""
+        size = MAX_SQL_VARIABLES // 2
+        for i in range(0, len(tracks), size):
+            chunk = tracks[i : i + size]
+            self.execute_sql(
+                (
+                    "SELECT tracks.id, artists.id, artists.name, tracks.title FROM"
+                    " tracks INNER JOIN artists ON artists.id = tracks.artist WHERE"
+                    " (artists.name, tracks.title) IN (VALUES %s);"
+                    % ", ".join(["(?, ?)"] * len(chunk)),
+                    [value for track in chunk for value in track],
+                ),
+                priority=1,
+            ).add_done_callback(
+                lambda future: [
+                    (
+                        self.artist_ids.put(name, artist_id),
+                        self.track_ids.put((artist_id, title), track_id),
+                    )
+                    for track_id, artist_id, name, title in future.result()
+                ]
+            )
+
+    def get_graph(self, graph: Adjacency, sql: str) -> Adjacency:
+        """Load @graph from the (node, node, match) rows of @sql on first use."""
+        if not graph.loaded:
+            with graph.loading:
+                if not graph.loaded:
+                    with self.stats.timer("graph.%s.load" % graph.name):
+                        graph.load(
+                            lambda: self.execute_sql((sql,), priority=0).result()
+                        )
+        return graph
+
+    def get_rows_by_id(self, sql: str, ids: List[int]) -> dict:
+        """Run @sql, which selects rows by an IN clause on id, in chunks.
+
+        Returns the rows keyed by their first column.
+        """
+        futures = [
+            self.execute_sql(
+                (
+                    sql % ", ".join("?" * len(ids[i : i + MAX_SQL_VARIABLES])),
+                    ids[i : i + MAX_SQL_VARIABLES],
+                ),
+                priority=0,
+            )
+            for i in range(0, len(ids), MAX_SQL_VARIABLES)
+        ]
+        return {row[0]: row[1:] for future in futures for row in future.result()}
 
     def get_similar_tracks(self, track_id):
         """Get similar tracks from the database.
@@ -715,20 +2807,20 @@ class Similarity(object):
         Sorted by descending match score.
 
         """
-        sql = (
-            "SELECT track_2_track.match, artists.name, tracks.title"
-            " FROM track_2_track INNER JOIN tracks ON"
-            " track_2_track.track2 = tracks.id INNER JOIN artists ON"
-            " artists.id = tracks.artist WHERE track_2_track.track1 = ? UNION "
-            "SELECT track_2_track.match, artists.name, tracks.title"
-            " FROM track_2_track INNER JOIN tracks ON"
-            " track_2_track.track1 = tracks.id INNER JOIN artists ON"
-            " artists.id = tracks.artist WHERE track_2_track.track2"
-            " = ? ORDER BY track_2_track.match DESC;",
-            (track_id, track_id),
+        graph = self.get_graph(
+            self.track_graph, "SELECT track1, track2, match FROM track_2_track;"
         )
-        command = self.get_sql_command(sql, priority=0)
-        return command.result_queue.get()
+        similar = graph.get_neighbours(track_id)
+        names = self.get_rows_by_id(
+            "SELECT tracks.id, artists.name, tracks.title FROM tracks INNER JOIN"
+            " artists ON artists.id = tracks.artist WHERE tracks.id IN (%s);",
+            [neighbour for _, neighbour in similar],
+        )
+        return [
+            (match,) + names[neighbour]
+            for match, neighbour in similar
+            if neighbour in names
+        ]
 
     def get_similar_artists(self, artist_id):
         """Get similar artists from the database.
@@ -736,17 +2828,31 @@ class Similarity(object):
         Sorted by descending match score.
 
         """
-        sql = (
-            "SELECT match, name FROM artist_2_artist INNER JOIN"
-            " artists ON artist_2_artist.artist2 = artists.id WHERE"
-            " artist_2_artist.artist1 = ? UNION "
-            "SELECT match, name FROM artist_2_artist INNER JOIN"
-            " artists ON artist_2_artist.artist1 = artists.id WHERE"
-            " artist_2_artist.artist2 = ? ORDER BY match DESC;",
-            (artist_id, artist_id),
+        graph = self.get_graph(
+            self.artist_graph, "SELECT artist1, artist2, match FROM artist_2_artist;"
         )
-        command = self.get_sql_command(sql, priority=0)
-        return command.result_queue.get()
+        similar = graph.get_neighbours(artist_id)
+        names = self.get_rows_by_id(
+            "SELECT id, name FROM artists WHERE id IN (%s);",
+            [neighbour for _, neighbour in similar],
+        )
+        return [
+            (match,) + names[neighbour]
+            for match, neighbour in similar
+            if neighbour in names
+        ]
+
+    def refresh_edges(self, graph: Adjacency, sql: str, ids: List[int]) -> None:
+        """Copy the stored edges of @ids into @graph.
+
+        @sql selects (node, node, match) rows with an IN clause on the first
+        node.
+        """
+        for i in range(0, len(ids), MAX_SQL_VARIABLES):
+            chunk = ids[i : i + MAX_SQL_VARIABLES]
+            self.execute_sql(
+                (sql % ", ".join("?" * len(chunk)), chunk), priority=1
+            ).add_done_callback(lambda future: graph.update(future.result()))
 
     def get_artist_match(self, artist1, artist2):
         """Get artist match score from database."""
@@ -754,8 +2860,7 @@ class Similarity(object):
             "SELECT match FROM artist_2_artist WHERE artist1 = ?" " AND artist2 = ?;",
             (artist1, artist2),
         )
-        command = self.get_sql_command(sql, priority=2)
-        for row in command.result_queue.get():
+        for row in self.execute_sql(sql, priority=2).result():
             return row[0]
         return 0
 
@@ -765,8 +2870,7 @@ class Similarity(object):
             "SELECT match FROM track_2_track WHERE track1 = ? AND track2 = ?;",
             (track1, track2),
         )
-        command = self.get_sql_command(sql, priority=2)
-        for row in command.result_queue.get():
+        for row in self.execute_sql(sql, priority=2).result():
             return row[0]
         return 0
 
@@ -779,6 +2883,8 @@ class Similarity(object):
                 (match, artist1, artist2),
             ),
             priority=10,
+        ).add_done_callback(
+            lambda _: self.artist_graph.set_match(artist1, artist2, match)
         )
 
     def update_track_match(self, track1, track2, match):
@@ -790,6 +2896,8 @@ class Similarity(object):
                 (match, track1, track2),
             ),
             priority=10,
+        ).add_done_callback(
+            lambda _: self.track_graph.set_match(track1, track2, match)
         )
 
     def insert_artist_match(self, artist1, artist2, match):
@@ -801,6 +2909,8 @@ class Similarity(object):
                 (artist1, artist2, match),
             ),
             priority=10,
+        ).add_done_callback(
+            lambda _: self.artist_graph.set_match(artist1, artist2, match)
         )
 
     def insert_track_match(self, track1, track2, match):
@@ -812,6 +2922,8 @@ class Similarity(object):
                 (track1, track2, match),
             ),
             priority=10,
+        ).add_done_callback(
+            lambda _: self.track_graph.set_match(track1, track2, match)
         )
 
     def update_artist(self, artist_id):
@@ -832,80 +2944,153 @@ class Similarity(object):
         )
 
     def update_similar_artists(self, artists_to_update):
-        """Write similar artist information to the database."""
-        for artist_id, similar in list(artists_to_update.items()):
-            for artist in similar:
-                row = self.get_artist(artist["artist"])
-                if row:
-                    id2 = row[0]
-                    if self.get_artist_match(artist_id, id2):
-                        self.update_artist_match(artist_id, id2, artist["score"])
-                        continue
-                    self.insert_artist_match(artist_id, id2, artist["score"])
-            self.update_artist(artist_id)
+        """Write similar artist information to the database.
+
+        @artists_to_update maps artist ids to lists of {"artist", "score"}
+        dicts. Everything is written in a single transaction: missing artists
+        are added, and existing match scores are updated in place. Artists
+        whose ids are cached are known to exist and are not inserted again;
+        the ids of the others are cached once the transaction is committed.
+        """
+        similar = [
+            (artist_id, artist["score"], artist["artist"])
+            for artist_id, artists in artists_to_update.items()
+            for artist in artists
+        ]
+        new_artists = [
+            name
+            for name in {name for _, _, name in similar}
+            if self.artist_ids.get(name) is None
+        ]
+
+        def committed(_):
+            self.remember_artist_ids(new_artists)
+            self.refresh_edges(
+                self.artist_graph,
+                "SELECT artist1, artist2, match FROM artist_2_artist WHERE artist1"
+                " IN (%s);",
+                list(artists_to_update),
+            )
+
+        self.execute_sql(
+            command=SQLBatch(
+                [
+                    (
+                        "INSERT OR IGNORE INTO artists (name) VALUES (?);",
+                        [(name,) for name in new_artists],
+                    ),
+                    (
+                        "INSERT INTO artist_2_artist (artist1, artist2, match) SELECT"
+                        " ?, id, ? FROM artists WHERE name = ? ON CONFLICT (artist1,"
+                        " artist2) DO UPDATE SET match = excluded.match;",
+                        similar,
+                    ),
+                    (
+                        "UPDATE artists SET updated = DATETIME('now') WHERE id = ?;",
+                        [(artist_id,) for artist_id in artists_to_update],
+                    ),
+                ]
+            ),
+            priority=10,
+        ).add_done_callback(committed)
 
     def update_similar_tracks(self, tracks_to_update):
-        """Write similar track information to the database."""
-        for track_id, similar in list(tracks_to_update.items()):
-            for track in similar:
-                row = self.get_track_from_artist_and_title(
-                    track["artist"], track["title"]
-                )
-                if row:
-                    id2 = row[0]
-                    if self.get_track_match(track_id, id2):
-                        self.update_track_match(track_id, id2, track["score"])
-                        continue
-                    self.insert_track_match(track_id, id2, track["score"])
-            self.update_track(track_id)
+        """Write similar track information to the database.
+
+        @tracks_to_update maps track ids to lists of {"artist", "title",
+        "score"} dicts. Everything is written in a single transaction:
+        missing artists and tracks are added, and existing match scores are
+        updated in place. Like in update_similar_artists, only artists and
+        tracks missing from the id caches are inserted, and their ids are
+        cached afterwards.
+        """
+        similar = [
+            (track_id, track["score"], track["artist"], track["title"])
+            for track_id, tracks in tracks_to_update.items()
+            for track in tracks
+        ]
+        new_artists = [
+            name
+            for name in {artist for _, _, artist, _ in similar}
+            if self.artist_ids.get(name) is None
+        ]
+        unknown = set(new_artists)
+        new_tracks = [
+            (artist, title)
+            for artist, title in {(artist, title) for _, _, artist, title in similar}
+            if artist in unknown
+            or self.track_ids.get((self.artist_ids.get(artist), title)) is None
+        ]
+
+        def committed(_):
+            self.remember_track_ids(new_tracks)
+            self.refresh_edges(
+                self.track_graph,
+                "SELECT track1, track2, match FROM track_2_track WHERE track1 IN"
+                " (%s);",
+                list(tracks_to_update),
+            )
 
-    def create_db(self):
-        """Set up a database for the artist and track similarity scores."""
         self.execute_sql(
-            (
+            command=SQLBatch(
+                [
+                    (
+                        "INSERT OR IGNORE INTO artists (name) VALUES (?);",
+                        [(artist,) for artist in new_artists],
+                    ),
+                    (
+                        "INSERT OR IGNORE INTO tracks (artist, title) SELECT id, ?"
+                        " FROM artists WHERE name = ?;",
+                        [(title, artist) for artist, title in new_tracks],
+                    ),
+                    (
+                        "INSERT INTO track_2_track (track1, track2, match) SELECT ?,"
+                        " tracks.id, ? FROM tracks INNER JOIN artists ON artists.id ="
+                        " tracks.artist WHERE artists.name = ? AND tracks.title = ?"
+                        " ON CONFLICT (track1, track2) DO UPDATE SET match ="
+                        " excluded.match;",
+                        similar,
+                    ),
+                    (
+                        "UPDATE tracks SET updated = DATETIME('now') WHERE id = ?;",
+                        [(track_id,) for track_id in tracks_to_update],
+                    ),
+                ]
+            ),
+            priority=10,
+        ).add_done_callback(committed)
+
+    def create_db(self):
+        """Set up a database for the artist and track similarity scores.
+
+        Waits until the tables exist, so the read-only connections can be
+        opened right after.
+        """
+        futures = [
+            self.execute_sql((statement,), priority=0)
+            for statement in (
                 "CREATE TABLE IF NOT EXISTS artists (id INTEGER PRIMARY KEY, name"
                 " VARCHAR(100), updated DATE, UNIQUE(name));",
-            ),
-            priority=0,
-        )
-        self.execute_sql(
-            (
                 "CREATE TABLE IF NOT EXISTS artist_2_artist (artist1 INTEGER,"
                 " artist2 INTEGER, match INTEGER, UNIQUE(artist1, artist2));",
-            ),
-            priority=0,
-        )
-        self.execute_sql(
-            (
                 "CREATE TABLE IF NOT EXISTS tracks (id INTEGER PRIMARY KEY, artist"
                 " INTEGER, title VARCHAR(100), updated DATE, "
                 "UNIQUE(artist, title));",
-            ),
-            priority=0,
-        )
-        self.execute_sql(
-            (
                 "CREATE TABLE IF NOT EXISTS track_2_track (track1 INTEGER, track2"
                 " INTEGER, match INTEGER, UNIQUE(track1, track2));",
-            ),
-            priority=0,
-        )
-        self.execute_sql(
-            ("CREATE INDEX IF NOT EXISTS a2aa1x ON artist_2_artist " "(artist1);",),
-            priority=0,
-        )
-        self.execute_sql(
-            ("CREATE INDEX IF NOT EXISTS a2aa2x ON artist_2_artist " "(artist2);",),
-            priority=0,
-        )
-        self.execute_sql(
-            ("CREATE INDEX IF NOT EXISTS t2tt1x ON track_2_track (track1);",),
-            priority=0,
-        )
-        self.execute_sql(
-            ("CREATE INDEX IF NOT EXISTS t2tt2x ON track_2_track (track2);",),
-            priority=0,
-        )
+                "CREATE INDEX IF NOT EXISTS a2aa1x ON artist_2_artist " "(artist1);",
+                "CREATE INDEX IF NOT EXISTS a2aa2x ON artist_2_artist " "(artist2);",
+                "CREATE INDEX IF NOT EXISTS t2tt1x ON track_2_track (track1);",
+                "CREATE INDEX IF NOT EXISTS t2tt2x ON track_2_track (track2);",
+                "CREATE TABLE IF NOT EXISTS models (id INTEGER PRIMARY KEY, version"
+                " VARCHAR(100), descriptor VARCHAR(100), created DATE);",
+                "CREATE TABLE IF NOT EXISTS analyses (filename VARCHAR(300) PRIMARY"
+                " KEY, state VARCHAR(20), fingerprint VARCHAR(100), updated DATE);",
+                "CREATE TABLE IF NOT EXISTS track_groups (filename VARCHAR(300), kind"
+                " VARCHAR(10), key VARCHAR(300), UNIQUE(filename, kind, key));",
+            )
+        ]
+        wait(futures)
 
     def delete_orphan_artist(self, artist):
         """Delete artists that have no tracks."""
@@ -914,9 +3099,10 @@ class Similarity(object):
             "artists.id NOT IN (SELECT tracks.artist from tracks);",
             (artist,),
         )
-        command = self.get_sql_command(sql, priority=10)
-        for row in command.result_queue.get():
+        for row in self.execute_sql(sql, priority=10).result():
             artist_id = row[0]
+            self.artist_ids.discard(artist)
+            self.artist_graph.remove_node(artist_id)
             self.execute_sql(
                 (
                     "DELETE FROM artist_2_artist WHERE artist1 = ? OR artist2 = " "?;",
@@ -928,34 +3114,142 @@ class Similarity(object):
                 ("DELETE FROM artists WHERE id = ?", (artist_id,)), priority=10
             )
 
+    def get_page_counts(self):
+        """Get the page size, page and free page counts and auto vacuum mode."""
+        page_size, page_count, free, auto_vacuum = [
+            future.result()[0][0]
+            for future in [
+                self.execute_sql(("PRAGMA %s;" % pragma,), priority=10)
+                for pragma in (
+                    "page_size",
+                    "page_count",
+                    "freelist_count",
+                    "auto_vacuum",
+                )
+            ]
+        ]
+        return page_size, page_count, free, AUTO_VACUUM_MODES[auto_vacuum]
+
+    def collect_garbage(self, vacuum=""):
+        """Delete all orphaned artists and dangling similarity edges.
+
+        Orphaned artists have no tracks and no similarity edges, so the
+        artist graph survives a collection.
+
+        Everything is deleted in a single transaction. With @vacuum set to
+        VACUUM_FULL the database file is rebuilt afterwards, which also
+        switches it to incremental auto vacuum. VACUUM_INCREMENTAL releases the
+        free pages of a database that has been switched. Returns a report of
+        the rows and bytes reclaimed as a JSON object.
+        """
+        with self.stats.timer("gc"):
+            page_size, pages_before, _, auto_vacuum_before = self.get_page_counts()
+            deleted = self.execute_sql(
+                command=SQLBatch(
+                    [
+                        (
+                            "DELETE FROM track_2_track WHERE NOT EXISTS (SELECT 1"
+                            " FROM tracks WHERE tracks.id = track_2_track.track1)"
+                            " OR NOT EXISTS (SELECT 1 FROM tracks WHERE tracks.id ="
+                            " track_2_track.track2);",
+                            [()],
+                        ),
+                        (
+                            # Similar artists usually have no tracks of
+                            # their own: only artists nothing refers to go.
+                            "DELETE FROM artists WHERE NOT EXISTS (SELECT 1 FROM"
+                            " tracks WHERE tracks.artist = artists.id) AND NOT"
+                            " EXISTS (SELECT 1 FROM artist_2_artist WHERE"
+                            " artist_2_artist.artist1 = artists.id OR"
+                            " artist_2_artist.artist2 = artists.id);",
+                            [()],
+                        ),
+                        (
+                            "DELETE FROM artist_2_artist WHERE NOT EXISTS (SELECT 1"
+                            " FROM artists WHERE artists.id ="
+                            " artist_2_artist.artist1) OR NOT EXISTS (SELECT 1 FROM"
+                            " artists WHERE artists.id = artist_2_artist.artist2);",
+                            [()],
+                        ),
+                    ]
+                ),
+                priority=10,
+            ).result()
+            if vacuum == VACUUM_FULL:
+                self.execute_sql(("PRAGMA auto_vacuum = INCREMENTAL;",), priority=10)
+                self.execute_sql(("VACUUM;",), priority=10).result()
+            elif vacuum == VACUUM_INCREMENTAL:
+                self.execute_sql(("PRAGMA incremental_vacuum;",), priority=10).result()
+            _, pages_after, free_after, auto_vacuum_after = self.get_page_counts()
+        # The deleted ids are not known here, so start over.
+        self.artist_ids.clear()
+        self.track_graph.reset()
+        self.artist_graph.reset()
+        report = {
+            "deleted": dict(
+                zip(("track_2_track", "artists", "artist_2_artist"), deleted)
+            ),
+            # What the file shrank by. Switching to incremental auto vacuum
+            # adds pointer map pages, which can make the file a little larger.
+            "bytes_reclaimed": max(0, (pages_before - pages_after) * page_size),
+            "file_bytes": pages_after * page_size,
+            "free_bytes": free_after * page_size,
+            "vacuum": vacuum,
+            "auto_vacuum": auto_vacuum_after,
+            "auto_vacuum_switched": auto_vacuum_after != auto_vacuum_before,
+        }
+        self.stats.increment("gc.rows_deleted", sum(deleted))
+        self.stats.increment("gc.bytes_reclaimed", report["bytes_reclaimed"])
+        print("collected garbage:", report)
+        return json.dumps(report)
+
     def analyze_track(self, filename):
         """Perform gaia analysis of a track."""
         if not filename:
             return
-        if GAIA:
-            self.gaia_queue.put((ADD, filename))
+        self.gaia_queue.put((ADD, filename))
 
     def analyze_tracks(self, filenames):
         """Analyze audio files."""
         if not filenames:
             return
-        if GAIA:
-            for filename in filenames:
-                self.gaia_queue.put((ADD, filename))
+        for filename in filenames:
+            self.gaia_queue.put((ADD, filename))
 
     def get_best_match(self, filename, filenames):
-        if not GAIA:
-            return
+        with self.stats.timer("lookup.best_match"):
+            return self.gaia_analyser.get_best_match(filename, filenames)
+
+    def miximize(self, filenames):
+        """Get the indices of @filenames in an order with smooth transitions."""
+        with self.stats.timer("miximize"):
+            return self.gaia_analyser.miximize(
+                filenames, self.refine_seconds, self.transitions
+            )
 
-        return self.gaia_analyser.get_best_match(filename, filenames)
+    def miximize_stream(self, filenames, emit):
+        """Order @filenames like miximize, calling @emit(indices, done) per chunk."""
+        with self.stats.timer("miximize"):
+            self.gaia_analyser.miximize_stream(
+                filenames, emit, self.refine_seconds, self.transitions
+            )
+
+    @staticmethod
+    def has_gaia():
+        """Get whether acoustic similarity is available.
+
+        It always is now that there is a numpy backend; the name is kept for
+        existing clients.
+        """
+        return True
 
 
 class SimilarityService(dbus.service.Object):
 
     """Service that can be queried for similar songs."""
 
-    def __init__(self, bus_name, object_path):
-        self.similarity = Similarity()
+    def __init__(self, bus_name, object_path, **similarity_options):
+        self.similarity = Similarity(**similarity_options)
         dbus.service.Object.__init__(self, bus_name=bus_name, object_path=object_path)
         self.loop = GObject.MainLoop()
 
@@ -979,6 +3273,40 @@ class SimilarityService(dbus.service.Object):
         """Get similar tracks by gaia acoustic analysis."""
         return self.similarity.get_ordered_gaia_tracks(filename, number)
 
+    @method(dbus_interface=IFACE, in_signature="ssas")
+    def set_track_groups(self, filename, album, artists):
+        """Tell which album and artists a track belongs to."""
+        self.similarity.set_track_groups(
+            filename, album, [artist for artist in artists]
+        )
+
+    @method(dbus_interface=IFACE, in_signature="a(ssas)")
+    def set_track_groups_many(self, tracks):
+        """Tell which album and artists each of the tracks belongs to."""
+        self.similarity.set_track_groups_many(
+            [
+                (str(filename), str(album), [str(artist) for artist in artists])
+                for filename, album, artists in tracks
+            ]
+        )
+
+    @method(dbus_interface=IFACE, in_signature="ass", out_signature="ad")
+    def get_track_features(self, filenames, name):
+        """Get a scalar feature of tracks, like their bpm."""
+        return self.similarity.get_track_features(
+            [filename for filename in filenames], name
+        )
+
+    @method(dbus_interface=IFACE, in_signature="sx", out_signature="a(xs)")
+    def get_similar_albums(self, album, number):
+        """Get acoustically similar albums."""
+        return self.similarity.get_similar_albums(album, number)
+
+    @method(dbus_interface=IFACE, in_signature="sx", out_signature="a(xs)")
+    def get_similar_sounding_artists(self, artist, number):
+        """Get acoustically similar artists."""
+        return self.similarity.get_similar_sounding_artists(artist, number)
+
     @method(dbus_interface=IFACE, in_signature="sas", out_signature="a(xs)")
     def get_ordered_gaia_tracks_from_list(self, filename, filenames):
         return self.similarity.get_ordered_gaia_tracks_from_list(
@@ -988,12 +3316,112 @@ class SimilarityService(dbus.service.Object):
     @method(dbus_interface=IFACE, out_signature="b")
     def has_gaia(self):
         """Get gaia installation status."""
-        return GAIA
+        return self.similarity.has_gaia()
 
     @method(dbus_interface=IFACE, in_signature="sas", out_signature="s")
     def get_best_match(self, filename, filenames):
         return self.similarity.get_best_match(filename, filenames)
 
+    @method(
+        dbus_interface=IFACE,
+        in_signature="as",
+        out_signature="ax",
+        async_callbacks=("reply_handler", "error_handler"),
+    )
+    def miximize(self, filenames, reply_handler, error_handler):
+        """Get the indices of the tracks in an order with smooth transitions.
+
+        The ordering runs on its own thread, so the service stays responsive
+        while a large selection is processed.
+        """
+        filenames = [str(filename) for filename in filenames]
+
+        def run():
+            try:
+                indices = self.similarity.miximize(filenames)
+            except Exception as e:
+                GObject.idle_add(error_handler, e)
+                return
+            GObject.idle_add(reply_handler, indices)
+
+        thread = Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    @method(dbus_interface=IFACE, in_signature="sas")
+    def miximize_streaming(self, token, filenames):
+        """Order the tracks like miximize, emitting miximize_chunk signals.
+
+        The first chunk is sent as soon as it is fixed, so playback can start
+        while the rest of a large selection is still being ordered. @token
+        is chosen by the caller and passed along with every chunk. If the
+        ordering fails, miximize_failed is emitted instead of the remaining
+        chunks.
+        """
+        filenames = [str(filename) for filename in filenames]
+
+        def emit(indices, done):
+            GObject.idle_add(self.miximize_chunk, token, indices, done)
+
+        def run():
+            try:
+                self.similarity.miximize_stream(filenames, emit)
+            except Exception as e:
+                print(repr(e))
+                GObject.idle_add(self.miximize_failed, token, repr(e))
+
+        thread = Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    @dbus.service.signal(dbus_interface=IFACE, signature="saxb")
+    def miximize_chunk(self, token, indices, done):
+        """Emitted with the next stretch of a streaming miximize ordering."""
+
+    @dbus.service.signal(dbus_interface=IFACE, signature="ss")
+    def miximize_failed(self, token, message):
+        """Emitted when a streaming miximize ordering could not be finished."""
+
+    @method(
+        dbus_interface=IFACE,
+        in_signature="s",
+        out_signature="s",
+        async_callbacks=("reply_handler", "error_handler"),
+    )
+    def collect_garbage(self, vacuum, reply_handler, error_handler):
+        """Delete orphaned artists and dangling edges, returning a JSON report.
+
+        @vacuum is "", "incremental" or "full".
+        """
+        vacuum = str(vacuum)
+
+        def run():
+            try:
+                report = self.similarity.collect_garbage(vacuum)
+            except Exception as e:
+                GObject.idle_add(error_handler, e)
+                return
+            GObject.idle_add(reply_handler, report)
+
+        thread = Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    @method(dbus_interface=IFACE, out_signature="s")
+    def get_stats(self):
+        """Get counters and latency histograms as a JSON object."""
+        return self.similarity.get_stats()
+
+    @method(dbus_interface=IFACE, in_signature="s")
+    def use_profile(self, profile):
+        """Serve lookups from another profile that is being built."""
+        self.similarity.use_profile(profile)
+
+    @method(dbus_interface=IFACE, out_signature="s")
+    def get_profile_report(self):
+        """Get the memory, latency and neighbour overlap of every profile."""
+        return self.similarity.get_profile_report()
+
     def run(self):
         """Run loop."""
         self.loop.run()
@@ -1008,17 +3436,110 @@ def register_service(bus):
     return name != dbus.bus.REQUEST_NAME_REPLY_EXISTS
 
 
-def publish_service(bus):
+def publish_service(bus, options):
     """Publish the service on DBus."""
     print("publishing")
     bus_name = dbus.service.BusName(DBUS_BUSNAME, bus=bus)
-    service = SimilarityService(bus_name=bus_name, object_path=DBUS_PATH)
+    service = SimilarityService(
+        bus_name=bus_name,
+        object_path=DBUS_PATH,
+        acoustic_backend=options.acoustic_backend,
+        vector_store=options.vector_store,
+        profile=options.profile,
+        extra_profiles=options.build_profiles,
+        analysis_workers=options.analysis_workers,
+        extractor=shlex.split(options.extractor),
+    )
+    if options.socket:
+        print("serving on %s" % options.socket)
+        SimilaritySocketServer(service.similarity, options.socket).start()
+    service.similarity.refine_seconds = options.refine_seconds
+    service.similarity.transitions = options.transitions
+    if options.stats_file:
+        service.similarity.dump_stats_periodically(
+            options.stats_file, options.stats_interval
+        )
     service.run()
 
 
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(description="Autoqueue similarity service.")
+    parser.add_argument(
+        "--socket",
+        nargs="?",
+        const=get_socket_path(),
+        default=None,
+        help="also serve requests on a Unix domain socket at this path",
+    )
+    parser.add_argument(
+        "--stats-file", default=None, help="periodically write stats to this file"
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        default=60,
+        help="seconds between writes to the stats file",
+    )
+    parser.add_argument(
+        "--refine-seconds",
+        type=float,
+        default=0,
+        help="time budget for improving miximize orderings with local search",
+    )
+    parser.add_argument(
+        "--transitions",
+        action="store_true",
+        help="order miximize selections by the distance from each track's end "
+        "to the next track's start",
+    )
+    parser.add_argument(
+        "--acoustic-backend",
+        choices=ACOUSTIC_BACKENDS,
+        default=None,
+        help="compute acoustic vectors with gaia2 or with numpy (default: gaia2 "
+        "when it is installed); numpy always uses the sqlite vector store",
+    )
+    parser.add_argument(
+        "--vector-store",
+        choices=VECTOR_STORES,
+        default=VECTOR_STORE_GAIA,
+        help="keep acoustic vectors in the gaia dataset file, or in similarity.db "
+        "where tracks are added and removed one row at a time",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=sorted(PROFILES),
+        default=DEFAULT_PROFILE,
+        help="the descriptors and dimensions of the vectors that serve lookups",
+    )
+    parser.add_argument(
+        "--build-profiles",
+        nargs="*",
+        choices=sorted(PROFILES),
+        default=[],
+        help="also build these profiles from the same analyses, to compare with "
+        "get_profile_report and switch to with use_profile (numpy backend only). "
+        "A profile only gets the tracks analyzed after it is first built",
+    )
+    parser.add_argument(
+        "--analysis-workers",
+        type=int,
+        default=1,
+        help="how many audio files to extract descriptors from at once",
+    )
+    parser.add_argument(
+        "--extractor",
+        default=ESSENTIA_EXTRACTOR_PATH,
+        help="command that writes the essentia signature of an audio file to a "
+        "JSON file, given both paths",
+    )
+    return parser.parse_args(arguments)
+
+
 def main():
     """Start the service if it is not already running."""
+    options = parse_arguments()
     DBusGMainLoop(set_as_default=True)
     bus = dbus.SessionBus()
     if register_service(bus):
-        publish_service(bus)
+        publish_service(bus, options)
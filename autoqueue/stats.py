@@ -0,0 +1,155 @@
+"""Counters and latency histograms for the similarity service."""
+
+import json
+import os
+import resource
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock, Thread
+from time import perf_counter, sleep, time
+from typing import Callable, Dict, List
+
+# Bucket upper bounds in seconds: 0.1ms doubling up to about 14 minutes.
+BUCKETS = [0.0001 * 2**i for i in range(24)]
+
+
+class Histogram(object):
+
+    """Latency histogram with exponentially growing buckets."""
+
+    def __init__(self):
+        self.counts: List[int] = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def record(self, seconds: float) -> None:
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.minimum is None or seconds < self.minimum:
+            self.minimum = seconds
+        if self.maximum is None or seconds > self.maximum:
+            self.maximum = seconds
+
+    def percentile(self, fraction: float) -> float:
+        """Get the upper bound of the bucket the percentile falls in."""
+        wanted = fraction * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= wanted and bucket_count:
+                if i == len(BUCKETS):
+                    return self.maximum
+                return min(BUCKETS[i], self.maximum)
+        return 0.0
+
+    def snapshot(self) -> dict:
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": self.total / self.count,
+            "min": self.minimum,
+            "max": self.maximum,
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+        }
+
+
+class Stats(object):
+
+    """Thread safe registry of counters, histograms and gauges.
+
+    Gauges are callables that are evaluated when a snapshot is taken, so
+    things like queue depth are only computed when somebody asks.
+    """
+
+    def __init__(self):
+        self.started = time()
+        self.lock = Lock()
+        self.counters: Dict[str, int] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self.gauges: Dict[str, Callable[[], object]] = {}
+
+    def increment(self, name: str, amount: int = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record(self, name: str, seconds: float) -> None:
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.record(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        """Record how long the body of the with statement takes."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, perf_counter() - start)
+
+    def register_gauge(self, name: str, gauge: Callable[[], object]) -> None:
+        self.gauges[name] = gauge
+
+    def snapshot_counters(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.counters)
+
+    def snapshot(self) -> dict:
+        uptime = time() - self.started
+        counters = self.snapshot_counters()
+        with self.lock:
+            histograms = {
+                name: histogram.snapshot()
+                for name, histogram in self.histograms.items()
+            }
+        gauges = {}
+        for name, gauge in list(self.gauges.items()):
+            try:
+                gauges[name] = gauge()
+            except Exception as e:
+                gauges[name] = repr(e)
+        gauges["memory.max_rss_kb"] = resource.getrusage(
+            resource.RUSAGE_SELF
+        ).ru_maxrss
+        return {
+            "uptime": uptime,
+            "counters": counters,
+            "rates_per_minute": {
+                name: value * 60 / uptime for name, value in counters.items()
+            },
+            "histograms": histograms,
+            "gauges": gauges,
+        }
+
+    def dump(self, path: str) -> None:
+        """Write a snapshot to @path, replacing it atomically."""
+        tmp = path + ".tmp"
+        with open(tmp, "w") as stats_file:
+            json.dump(self.snapshot(), stats_file, indent=2, sort_keys=True)
+        os.replace(tmp, path)
+
+
+class StatsDumper(Thread):
+
+    """Periodically dump stats to a file."""
+
+    def __init__(self, stats: Stats, path: str, interval: float):
+        super(StatsDumper, self).__init__()
+        self.stats = stats
+        self.path = path
+        self.interval = interval
+
+    def run(self) -> None:
+        while True:
+            sleep(self.interval)
+            try:
+                self.stats.dump(self.path)
+            except OSError as e:
+                print(f"Error: {self.path}: {e}")
@@ -0,0 +1,555 @@
+"""Transports for talking to the similarity service.
+
+D-Bus is the default way for a player plugin to reach the similarity
+service, but it needs a session bus and pays for marshalling on every
+call. The proxies in this module expose the same calling convention as a
+dbus.Interface (positional arguments plus optional reply_handler,
+error_handler and timeout keyword arguments) so AutoQueueBase does not
+need to know which transport it is using.
+"""
+
+import multiprocessing
+import os
+import socket
+import socketserver
+import struct
+from abc import ABCMeta, abstractmethod
+from concurrent.futures import Future
+from itertools import count
+from queue import Queue
+from threading import Lock, Thread
+
+from autoqueue.utilities import player_get_data_dir
+
+try:
+    from gi.repository import GLib
+
+    GLIB = True
+except ImportError:
+    GLIB = False
+try:
+    import msgpack
+
+    MSGPACK = True
+except ImportError:
+    MSGPACK = False
+
+DBUS = "dbus"
+EMBEDDED = "embedded"
+PROCESS = "process"
+SOCKET = "socket"
+
+TRANSPORTS = (DBUS, EMBEDDED, PROCESS, SOCKET)
+
+SOCKET_NAME = "similarity.sock"
+FRAME_HEADER = struct.Struct(">I")
+
+EXPORTED_METHODS = frozenset(
+    {
+        "analyze_track",
+        "analyze_tracks",
+        "collect_garbage",
+        "get_best_match",
+        "get_ordered_gaia_tracks",
+        "get_ordered_gaia_tracks_from_list",
+        "get_profile_report",
+        "get_similar_albums",
+        "get_similar_sounding_artists",
+        "get_stats",
+        "get_track_features",
+        "has_gaia",
+        "miximize",
+        "remove_track_by_filename",
+        "set_track_groups",
+        "set_track_groups_many",
+        "use_profile",
+    }
+)
+
+
+def dispatch(function, *args, main_loop=False):
+    """Run a reply or error handler.
+
+    With @main_loop set the handler is queued on the GLib main loop, so
+    code that runs one (like the player plugin) gets its callbacks on
+    that thread. Otherwise the handler is called right away, on whatever
+    thread finished the call.
+    """
+    if not (main_loop and GLIB):
+        function(*args)
+        return
+
+    def idle():
+        function(*args)
+        return False
+
+    GLib.idle_add(idle)
+
+
+class SimilarityProxy(metaclass=ABCMeta):
+
+    """Base class for non D-Bus similarity transports."""
+
+    main_loop = False
+
+    @abstractmethod
+    def submit(self, name, args):
+        """Start a call and return a Future for its result."""
+
+    def __getattr__(self, name):
+        if name not in EXPORTED_METHODS:
+            raise AttributeError(name)
+
+        def call(*args, reply_handler=None, error_handler=None, timeout=None):
+            future = self.submit(name, args)
+            if reply_handler is None and error_handler is None:
+                return future.result(timeout)
+
+            future.add_done_callback(
+                lambda done: self.handle_reply(done, reply_handler, error_handler)
+            )
+
+        return call
+
+    def handle_reply(self, future, reply_handler, error_handler):
+        exception = future.exception()
+        if exception is not None:
+            if error_handler is not None:
+                dispatch(error_handler, exception, main_loop=self.main_loop)
+            return
+
+        if reply_handler is None:
+            return
+
+        result = future.result()
+        if result is None:
+            dispatch(reply_handler, main_loop=self.main_loop)
+        else:
+            dispatch(reply_handler, result, main_loop=self.main_loop)
+
+
+def run_call(similarity, name, args, future):
+    """Call a method on a Similarity object and resolve the future."""
+    if not future.set_running_or_notify_cancel():
+        return
+    try:
+        future.set_result(getattr(similarity, name)(*args))
+    except Exception as e:
+        future.set_exception(e)
+
+
+class EmbeddedSimilarity(SimilarityProxy):
+
+    """Talk to a Similarity instance in this process.
+
+    Calls are run one at a time on a worker thread, like the D-Bus service
+    handles them one at a time on its main loop, so the player's main loop
+    is never blocked by a lookup.
+    """
+
+    def __init__(self, similarity=None, main_loop=False):
+        self.main_loop = main_loop
+        if similarity is None:
+            from autoqueue.similarity import Similarity
+
+            similarity = Similarity()
+        self.similarity = similarity
+        self.calls: Queue = Queue()
+        self.worker = Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def submit(self, name, args):
+        future: Future = Future()
+        self.calls.put((name, args, future))
+        return future
+
+    def run(self):
+        while True:
+            name, args, future = self.calls.get()
+            run_call(self.similarity, name, args, future)
+
+
+def call_exported(similarity, name, args):
+    """Call an exported method and return a (success, result) pair."""
+    if name not in EXPORTED_METHODS:
+        return False, AttributeError(name)
+    try:
+        return True, getattr(similarity, name)(*args)
+    except Exception as e:
+        return False, e
+
+
+def serve_pipe(connection):
+    """Serve Similarity calls sent over a multiprocessing pipe."""
+    from autoqueue.similarity import Similarity
+
+    similarity = Similarity()
+    while True:
+        try:
+            call_id, name, args = connection.recv()
+        except EOFError:
+            break
+
+        connection.send((call_id, *call_exported(similarity, name, args)))
+
+
+class ConnectionSimilarity(SimilarityProxy):
+
+    """Base class for transports that pipeline calls over one connection.
+
+    Every call is tagged with an id, so any number of calls can be in
+    flight at once and replies are matched up as they come in.
+    """
+
+    def __init__(self, main_loop=False):
+        self.main_loop = main_loop
+        self.call_ids = count()
+        self.pending = {}
+        self.closed = False
+        self.send_lock = Lock()
+        self.reader = Thread(target=self.read_replies)
+        self.reader.daemon = True
+        self.reader.start()
+
+    @abstractmethod
+    def send_message(self, message):
+        """Send a (call_id, name, args) message."""
+
+    @abstractmethod
+    def receive_message(self):
+        """Receive a (call_id, success, result) message, or raise EOFError."""
+
+    def submit(self, name, args):
+        future: Future = Future()
+        future.set_running_or_notify_cancel()
+        with self.send_lock:
+            if self.closed:
+                # Nothing would ever read the reply.
+                future.set_exception(EOFError("similarity connection closed"))
+                return future
+
+            call_id = next(self.call_ids)
+            self.pending[call_id] = future
+            try:
+                self.send_message((call_id, name, list(args)))
+            except (OSError, EOFError) as e:
+                del self.pending[call_id]
+                future.set_exception(e)
+        return future
+
+    def read_replies(self):
+        while True:
+            try:
+                call_id, success, result = self.receive_message()
+            except EOFError:
+                break
+
+            future = self.pending.pop(call_id)
+            if success:
+                future.set_result(result)
+            else:
+                future.set_exception(
+                    result if isinstance(result, Exception) else RuntimeError(result)
+                )
+
+        with self.send_lock:
+            self.closed = True
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for future in pending:
+            future.set_exception(EOFError("similarity connection closed"))
+
+
+class ProcessSimilarity(ConnectionSimilarity):
+
+    """Talk to a Similarity instance in a child process over a pipe."""
+
+    def __init__(self, main_loop=False):
+        context = multiprocessing.get_context("spawn")
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=serve_pipe, args=(child_connection,))
+        self.process.daemon = True
+        self.process.start()
+        super(ProcessSimilarity, self).__init__(main_loop=main_loop)
+
+    def send_message(self, message):
+        self.connection.send(message)
+
+    def receive_message(self):
+        return self.connection.recv()
+
+
+def pack(value) -> bytes:
+    """Encode a value in the msgpack format.
+
+    Only the types the similarity methods use are supported: None, bools,
+    ints, floats, strings, bytes, lists, tuples and dicts. Tuples come back
+    as lists.
+    """
+    if MSGPACK:
+        return msgpack.packb(value, use_bin_type=True)
+
+    chunks: list = []
+    _pack(value, chunks)
+    return b"".join(chunks)
+
+
+def _pack_length(length, small_tag, tags, chunks):
+    if small_tag is not None and length < 16:
+        chunks.append(bytes((small_tag | length,)))
+    elif length < 0x10000:
+        chunks.append(struct.pack(">BH", tags[0], length))
+    else:
+        chunks.append(struct.pack(">BI", tags[1], length))
+
+
+def _pack(value, chunks):
+    if value is None:
+        chunks.append(b"\xc0")
+    elif value is True:
+        chunks.append(b"\xc3")
+    elif value is False:
+        chunks.append(b"\xc2")
+    elif isinstance(value, int):
+        if 0 <= value < 0x80:
+            chunks.append(bytes((value,)))
+        elif -32 <= value < 0:
+            chunks.append(struct.pack(">b", value))
+        elif value >= 0:
+            chunks.append(struct.pack(">BQ", 0xCF, value))
+        else:
+            chunks.append(struct.pack(">Bq", 0xD3, value))
+    elif isinstance(value, float):
+        chunks.append(struct.pack(">Bd", 0xCB, value))
+    elif isinstance(value, str):
+        encoded = value.encode("utf-8")
+        if len(encoded) < 32:
+            chunks.append(bytes((0xA0 | len(encoded),)))
+        else:
+            _pack_length(len(encoded), None, (0xDA, 0xDB), chunks)
+        chunks.append(encoded)
+    elif isinstance(value, (bytes, bytearray)):
+        if len(value) < 0x100:
+            chunks.append(struct.pack(">BB", 0xC4, len(value)))
+        else:
+            _pack_length(len(value), None, (0xC5, 0xC6), chunks)
+        chunks.append(bytes(value))
+    elif isinstance(value, (list, tuple)):
+        _pack_length(len(value), 0x90, (0xDC, 0xDD), chunks)
+        for item in value:
+            _pack(item, chunks)
+    elif isinstance(value, dict):
+        _pack_length(len(value), 0x80, (0xDE, 0xDF), chunks)
+        for key, item in value.items():
+            _pack(key, chunks)
+            _pack(item, chunks)
+    else:
+        raise TypeError("Cannot pack %r" % (value,))
+
+
+def unpack(data: bytes):
+    """Decode a msgpack encoded value."""
+    if MSGPACK:
+        return msgpack.unpackb(data, raw=False)
+
+    value, _ = _unpack(data, 0)
+    return value
+
+
+FIXED = {0xC0: None, 0xC2: False, 0xC3: True}
+NUMBERS = {
+    0xCA: struct.Struct(">f"),
+    0xCB: struct.Struct(">d"),
+    0xCC: struct.Struct(">B"),
+    0xCD: struct.Struct(">H"),
+    0xCE: struct.Struct(">I"),
+    0xCF: struct.Struct(">Q"),
+    0xD0: struct.Struct(">b"),
+    0xD1: struct.Struct(">h"),
+    0xD2: struct.Struct(">i"),
+    0xD3: struct.Struct(">q"),
+}
+LENGTHS = {
+    0xC4: struct.Struct(">B"),
+    0xC5: struct.Struct(">H"),
+    0xC6: struct.Struct(">I"),
+    0xD9: struct.Struct(">B"),
+    0xDA: struct.Struct(">H"),
+    0xDB: struct.Struct(">I"),
+    0xDC: struct.Struct(">H"),
+    0xDD: struct.Struct(">I"),
+    0xDE: struct.Struct(">H"),
+    0xDF: struct.Struct(">I"),
+}
+
+
+def _unpack(data, offset):
+    tag = data[offset]
+    offset += 1
+    if tag < 0x80:
+        return tag, offset
+    if tag >= 0xE0:
+        return tag - 0x100, offset
+    if tag in FIXED:
+        return FIXED[tag], offset
+    if tag in NUMBERS:
+        number = NUMBERS[tag]
+        return number.unpack_from(data, offset)[0], offset + number.size
+    if tag in LENGTHS:
+        size = LENGTHS[tag]
+        length = size.unpack_from(data, offset)[0]
+        offset += size.size
+    else:
+        length = tag & (0x1F if 0xA0 <= tag < 0xC0 else 0x0F)
+    if 0xA0 <= tag < 0xC0 or tag in (0xD9, 0xDA, 0xDB):
+        return data[offset : offset + length].decode("utf-8"), offset + length
+    if tag in (0xC4, 0xC5, 0xC6):
+        return bytes(data[offset : offset + length]), offset + length
+    if 0x90 <= tag < 0xA0 or tag in (0xDC, 0xDD):
+        items = []
+        for _ in range(length):
+            item, offset = _unpack(data, offset)
+            items.append(item)
+        return items, offset
+    if 0x80 <= tag < 0x90 or tag in (0xDE, 0xDF):
+        mapping = {}
+        for _ in range(length):
+            key, offset = _unpack(data, offset)
+            mapping[key], offset = _unpack(data, offset)
+        return mapping, offset
+    raise ValueError("Cannot unpack type 0x%02x" % (tag,))
+
+
+def send_frame(sock, value):
+    """Send a length prefixed, msgpack encoded message."""
+    payload = pack(value)
+    sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+
+
+def receive_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError("socket closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def receive_frame(sock):
+    """Receive a length prefixed, msgpack encoded message."""
+    (size,) = FRAME_HEADER.unpack(receive_exactly(sock, FRAME_HEADER.size))
+    return unpack(receive_exactly(sock, size))
+
+
+def get_socket_path():
+    """Get the default path of the similarity service socket."""
+    return os.path.join(player_get_data_dir(), SOCKET_NAME)
+
+
+class SimilarityRequestHandler(socketserver.BaseRequestHandler):
+
+    """Serve pipelined calls from one socket client, in order."""
+
+    def handle(self):
+        while True:
+            try:
+                call_id, name, args = receive_frame(self.request)
+            except (EOFError, ConnectionError):
+                return
+
+            with self.server.call_lock:
+                success, result = call_exported(self.server.similarity, name, args)
+            if not success:
+                result = repr(result)
+            try:
+                try:
+                    send_frame(self.request, (call_id, success, result))
+                except (TypeError, ValueError, OverflowError) as e:
+                    # The result could not be encoded, and nothing was
+                    # written yet: fail this call instead of the client.
+                    send_frame(self.request, (call_id, False, repr(e)))
+            except OSError:
+                return
+
+
+class SimilaritySocketServer(socketserver.ThreadingUnixStreamServer):
+
+    """Unix domain socket endpoint for a Similarity instance."""
+
+    daemon_threads = True
+
+    def __init__(self, similarity, path=None):
+        self.similarity = similarity
+        self.path = path or get_socket_path()
+        # Similarity keeps caches and graphs in memory that are not safe to
+        # change from several threads, so calls run one at a time as they
+        # do on the D-Bus main loop. Clients still pipeline: frames are
+        # read and replies written outside the lock.
+        self.call_lock = Lock()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        super(SimilaritySocketServer, self).__init__(
+            self.path, SimilarityRequestHandler
+        )
+
+    def start(self):
+        """Serve requests on a background thread."""
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class SocketSimilarity(ConnectionSimilarity):
+
+    """Talk to the similarity service over its Unix domain socket."""
+
+    def __init__(self, path=None, main_loop=False):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path or get_socket_path())
+        super(SocketSimilarity, self).__init__(main_loop=main_loop)
+
+    def send_message(self, message):
+        send_frame(self.sock, message)
+
+    def receive_message(self):
+        try:
+            return receive_frame(self.sock)
+        except ConnectionError:
+            raise EOFError("socket closed")
+
+
+def get_dbus_similarity():
+    """Get a proxy for the similarity service on the session bus."""
+    import dbus
+
+    bus = dbus.SessionBus()
+    sim = bus.get_object(
+        "org.autoqueue", "/org/autoqueue/Similarity", follow_name_owner_changes=True
+    )
+    return dbus.Interface(sim, dbus_interface="org.autoqueue.SimilarityInterface")
+
+
+def connect(transport=DBUS, path=None, main_loop=False):
+    """Get an object to make similarity calls on, using @transport.
+
+    @path is the socket to connect to for the socket transport. Set
+    @main_loop when the caller runs a GLib main loop and wants reply
+    handlers called on it; D-Bus replies always arrive there.
+    """
+    if transport == DBUS:
+        return get_dbus_similarity()
+
+    if transport == EMBEDDED:
+        return EmbeddedSimilarity(main_loop=main_loop)
+
+    if transport == PROCESS:
+        return ProcessSimilarity(main_loop=main_loop)
+
+    if transport == SOCKET:
+        return SocketSimilarity(path, main_loop=main_loop)
+
+    raise ValueError("Unknown transport: %r" % (transport,))
@@ -0,0 +1,188 @@
+"""Measure how fast the analysis pipeline gets through a corpus.
+
+    python benchmarks/analysis_throughput.py --tracks 50 --workers 1 2 4 \\
+        --latency 2 --busy --output throughput.json
+
+Generates a corpus of audio files (or reuses the one in --corpus-dir), and
+for every worker count starts a fresh similarity service in a subprocess
+that analyzes all of it, end to end: ffmpeg cuts the fragments, a stand-in
+extractor with tunable latency writes their signatures, and GaiaAnalysis adds
+them to the dataset and saves it. Pass --extractor to time the real essentia
+extractor instead. Reports tracks per minute, the time spent in each stage
+and peak memory, as JSON. Needs ffmpeg.
+"""
+
+import argparse
+import json
+import os
+import resource
+import shlex
+import shutil
+import subprocess
+import sys
+import wave
+from contextlib import redirect_stdout
+from pathlib import Path
+from tempfile import mkdtemp
+from time import perf_counter, sleep, time
+
+import numpy as np
+
+STANDIN_EXTRACTOR = Path(__file__).with_name("standin_extractor.py")
+SAMPLE_RATE = 11025
+# The stats timer of each stage of the pipeline.
+STAGES = {
+    "fragment_extraction": "analysis.ffmpeg",
+    "extraction": "analysis.essentia",
+    "load_point": "analysis.load_point",
+    "add_point": "analysis.add_point",
+    "transform": "analysis.transform",
+    "save": "analysis.save",
+}
+
+
+def make_corpus(directory, tracks, seconds):
+    """Write @tracks mono WAV files of chords, different for every track."""
+    directory.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(0)
+    time_axis = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    paths = []
+    for track in range(tracks):
+        path = directory / ("track-%05d.wav" % track)
+        paths.append(path)
+        if path.exists():
+            continue
+        frequencies = 110 * 2 ** (rng.integers(0, 36, size=3) / 12)
+        samples = sum(np.sin(2 * np.pi * f * time_axis) for f in frequencies)
+        samples += rng.normal(scale=0.1, size=len(samples))
+        pcm = (samples / np.abs(samples).max() * 30000).astype("<i2")
+        with wave.open(str(path), "wb") as audio:
+            audio.setnchannels(1)
+            audio.setsampwidth(2)
+            audio.setframerate(SAMPLE_RATE)
+            audio.writeframes(pcm.tobytes())
+    return paths
+
+
+def run_once(options):
+    """Analyze the corpus with one worker count, in this process."""
+    os.environ["HOME"] = mkdtemp()
+    from autoqueue.similarity import Similarity
+
+    paths = sorted(Path(options.corpus_dir).glob("*.wav"))[: options.tracks]
+    if options.extractor:
+        extractor = shlex.split(options.extractor)
+    else:
+        extractor = [sys.executable, str(STANDIN_EXTRACTOR)]
+        extractor += ["--latency", str(options.latency)]
+        if options.busy:
+            extractor.append("--busy")
+    similarity = Similarity(
+        acoustic_backend=options.backend,
+        vector_store=options.vector_store,
+        analysis_workers=options.workers[0],
+        extractor=extractor,
+    )
+    analyser = similarity.gaia_analyser
+    start = perf_counter()
+    similarity.analyze_tracks([str(path) for path in paths])
+    while True:
+        analyser.idle.wait()
+        if not similarity.gaia_queue.qsize():
+            break
+        sleep(0.01)
+    seconds = perf_counter() - start
+    snapshot = similarity.stats.snapshot()
+    histograms = snapshot["histograms"]
+    stages = {}
+    for stage, timer in STAGES.items():
+        histogram = histograms.get(timer, {"count": 0, "mean": 0.0})
+        stages[stage] = {
+            "calls": histogram["count"],
+            "total_seconds": histogram["mean"] * histogram["count"],
+            "mean_ms": histogram["mean"] * 1000,
+        }
+    tracks = snapshot["counters"].get("analysis.tracks", 0)
+    return {
+        "workers": options.workers[0],
+        "tracks": tracks,
+        "seconds": seconds,
+        "tracks_per_minute": tracks * 60 / seconds,
+        "stages": stages,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "peak_child_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tracks", type=int, default=50)
+    parser.add_argument("--seconds", type=float, default=70, help="track length")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument(
+        "--latency", type=float, default=1.0, help="seconds per stand-in extraction"
+    )
+    parser.add_argument(
+        "--busy", action="store_true", help="keep a core busy instead of sleeping"
+    )
+    parser.add_argument(
+        "--extractor", default=None, help="run this extractor instead of the stand-in"
+    )
+    parser.add_argument("--backend", choices=["gaia", "numpy"], default=None)
+    parser.add_argument("--vector-store", choices=["gaia", "sqlite"], default="gaia")
+    parser.add_argument("--corpus-dir", default=None, help="keep the corpus here")
+    parser.add_argument("--output", default=None, help="write the JSON here")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.child:
+        with redirect_stdout(sys.stderr):
+            result = run_once(options)
+        json.dump(result, sys.stdout)
+        return
+
+    if shutil.which("ffmpeg") is None:
+        print("ffmpeg is not installed", file=sys.stderr)
+        sys.exit(1)
+
+    options.corpus_dir = options.corpus_dir or mkdtemp()
+    make_corpus(Path(options.corpus_dir), options.tracks, options.seconds)
+    runs = []
+    for workers in options.workers:
+        print("%d workers" % workers, file=sys.stderr)
+        arguments = [
+            sys.executable,
+            __file__,
+            "--child",
+            "--workers",
+            str(workers),
+            "--tracks",
+            str(options.tracks),
+            "--latency",
+            str(options.latency),
+            "--vector-store",
+            options.vector_store,
+            "--corpus-dir",
+            options.corpus_dir,
+        ]
+        if options.busy:
+            arguments.append("--busy")
+        if options.extractor:
+            arguments += ["--extractor", options.extractor]
+        if options.backend:
+            arguments += ["--backend", options.backend]
+        # Each run gets a process of its own, so peak memory is its own too.
+        output = subprocess.run(arguments, stdout=subprocess.PIPE, check=True).stdout
+        runs.append(json.loads(output))
+
+    report = {"created": time(), "options": vars(options), "runs": runs}
+    if options.output:
+        with open(options.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
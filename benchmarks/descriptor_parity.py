@@ -0,0 +1,132 @@
+"""Compare the numpy descriptor pipeline with gaia2.
+
+    python benchmarks/descriptor_parity.py /path/to/signatures/
+
+Reads the essentia JSON signatures in a directory, reduces them to the
+vectors of a profile with both the gaia2 transformation chain and the numpy
+one, and reports how well the two agree: the rank correlation of all
+pairwise distances, and the overlap of each fragment's nearest neighbours.
+Exits with status 1 when either falls below its --min-correlation or
+--min-overlap threshold, so it can catch a regression. Needs gaia2; the
+numpy pipeline is what is used when it is missing.
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+
+from autoqueue.descriptors import (
+    DEFAULT_PROFILE,
+    PROFILES,
+    DescriptorModel,
+    load_signature,
+)
+from autoqueue.similarity import (
+    GAIA,
+    GaiaAnalysis,
+    GaiaDB,
+    distance_matrix,
+    point_vector,
+)
+
+
+def ranks(values):
+    order = np.argsort(values)
+    result = np.empty(len(values))
+    result[order] = np.arange(len(values))
+    return result
+
+
+def neighbour_overlap(first, second, number):
+    """Get the mean fraction of shared nearest neighbours."""
+    np.fill_diagonal(first, np.inf)
+    np.fill_diagonal(second, np.inf)
+    first_neighbours = np.argsort(first, axis=1)[:, :number]
+    second_neighbours = np.argsort(second, axis=1)[:, :number]
+    return float(
+        np.mean(
+            [
+                len(set(a) & set(b)) / number
+                for a, b in zip(first_neighbours, second_neighbours)
+            ]
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory", help="directory with essentia .json signatures")
+    parser.add_argument("--neighbours", type=int, default=10)
+    parser.add_argument("--profile", choices=sorted(PROFILES), default=DEFAULT_PROFILE)
+    parser.add_argument(
+        "--min-correlation",
+        type=float,
+        default=0.9,
+        help="lowest distance rank correlation that passes",
+    )
+    parser.add_argument(
+        "--min-overlap",
+        type=float,
+        default=0.8,
+        help="lowest neighbour overlap with gaia2 that passes",
+    )
+    options = parser.parse_args()
+    if not GAIA:
+        print("gaia2 is not installed, nothing to compare with", file=sys.stderr)
+        sys.exit(1)
+
+    paths = sorted(Path(options.directory).glob("*.json"))
+    profile = PROFILES[options.profile]
+    gaia_db = GaiaDB(Path(options.directory) / "parity_gaia.db", profile=profile)
+    start = perf_counter()
+    for path in paths:
+        gaia_db[path.name] = GaiaAnalysis.load_point(path)
+    gaia_db.transform()
+    gaia_vectors = np.array(
+        [point_vector(gaia_db[path.name], gaia_db.vector_descriptor) for path in paths]
+    )
+    gaia_seconds = perf_counter() - start
+
+    start = perf_counter()
+    signatures = [load_signature(path) for path in paths]
+    model = DescriptorModel.fit(signatures, profile)
+    numpy_vectors = np.array([model.transform(signature) for signature in signatures])
+    numpy_seconds = perf_counter() - start
+
+    gaia_distances = distance_matrix(gaia_vectors)
+    numpy_distances = distance_matrix(numpy_vectors)
+    upper = np.triu_indices(len(paths), 1)
+    correlation = np.corrcoef(
+        ranks(gaia_distances[upper]), ranks(numpy_distances[upper])
+    )[0, 1]
+    report = {
+        "fragments": len(paths),
+        "distance_rank_correlation": float(correlation),
+        "neighbour_overlap": neighbour_overlap(
+            gaia_distances, numpy_distances, options.neighbours
+        ),
+        "gaia_seconds": gaia_seconds,
+        "numpy_seconds": numpy_seconds,
+    }
+    failures = [
+        "%s %.3f is below %.3f" % (name, report[name], minimum)
+        for name, minimum in (
+            ("distance_rank_correlation", options.min_correlation),
+            ("neighbour_overlap", options.min_overlap),
+        )
+        if not report[name] >= minimum
+    ]
+    report["passed"] = not failures
+    json.dump(report, sys.stdout, indent=2)
+    print()
+    if failures:
+        print("parity check failed: " + "; ".join(failures), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""Measure latency and recall of the acoustic lookups for each backend.
+
+    python benchmarks/retrieval_quality.py --sizes 10000 100000 1000000 \\
+        --output results.json
+
+Builds a synthetic dataset of start and end fragment vectors for every size,
+or loads it from --dataset-dir when it was generated before, and runs
+get_neighbours, get_ordered_matches and get_best_match through every backend
+that is available: the vector store, and the gaia dataset when gaia2 is
+installed. Each run reports p50/p99 latency, throughput, memory and how many
+of the exact nearest neighbours were found (recall@k), as JSON, so results can
+be compared between revisions.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+from concurrent.futures import Future
+from contextlib import redirect_stdout
+from pathlib import Path
+from queue import Queue
+from tempfile import mkdtemp
+from time import perf_counter, time
+
+import numpy as np
+
+# Keep GaiaAnalysis away from the real data directory, and what the service
+# prints out of the results.
+os.environ["HOME"] = mkdtemp()
+with redirect_stdout(sys.stderr):
+    from autoqueue.descriptors import DEFAULT_PROFILE
+    from autoqueue.similarity import (
+        ACOUSTIC_GAIA,
+        ACOUSTIC_NUMPY,
+        GAIA,
+        NUMPY_VECTOR_DESCRIPTOR,
+        VECTOR_DESCRIPTOR,
+        GaiaAnalysis,
+        GaiaDB,
+        VectorStore,
+    )
+    from autoqueue.stats import Stats
+
+VECTOR_STORE = "vector_store"
+GAIA_DATASET = "gaia"
+
+
+def discard_sql(sql=None, priority=1, command=None):
+    """Stand in for the database thread; only lookups are measured."""
+    future = Future()
+    future.set_result([])
+    return future
+
+
+def fragment_names(tracks):
+    filenames = ["/synthetic/%07d.mp3" % track for track in range(tracks)]
+    names = [filename + suffix for filename in filenames for suffix in "01"]
+    return filenames, names
+
+
+def make_dataset(fragments, dimension, clusters, seed):
+    """Get start and end vectors of tracks that fall into clusters."""
+    rng = np.random.default_rng(seed)
+    tracks = fragments // 2
+    centers = rng.normal(size=(clusters, dimension))
+    songs = centers[rng.integers(clusters, size=tracks)] + rng.normal(
+        scale=0.5, size=(tracks, dimension)
+    )
+    heads = songs + rng.normal(scale=0.2, size=songs.shape)
+    tails = songs + rng.normal(scale=0.2, size=songs.shape)
+    return heads, tails
+
+
+def load_dataset(options, fragments):
+    """Load a generated dataset from the dataset directory, or make and save it."""
+    path = None
+    if options.dataset_dir:
+        path = Path(options.dataset_dir) / (
+            "synthetic-%d-%d-%d.npz" % (fragments, options.dimension, options.seed)
+        )
+        if path.exists():
+            with np.load(path) as data:
+                return data["heads"], data["tails"]
+
+    heads, tails = make_dataset(
+        fragments, options.dimension, options.clusters, options.seed
+    )
+    if path is not None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(path, heads=heads, tails=tails)
+    return heads, tails
+
+
+def build_vector_store(names, vectors):
+    analysis = GaiaAnalysis(Queue(), Stats(), backend=ACOUSTIC_NUMPY)
+    vector_store = VectorStore(discard_sql)
+    vector_store.replace("benchmark", NUMPY_VECTOR_DESCRIPTOR, names, vectors)
+    analysis.set_vector_stores({DEFAULT_PROFILE: vector_store})
+    return analysis, vector_store.describe()["bytes"]
+
+
+def build_gaia(names, vectors):
+    import yaml
+    from gaia2 import Point
+
+    analysis = GaiaAnalysis(Queue(), Stats(), backend=ACOUSTIC_GAIA)
+    gaia_db = GaiaDB(Path(mkdtemp()) / "benchmark_gaia.db")
+    for name, vector in zip(names, vectors):
+        point = Point()
+        point.loadFromString(yaml.dump({VECTOR_DESCRIPTOR: vector.tolist()}))
+        gaia_db[name] = point
+    gaia_db.transformed = True
+    analysis.gaia_db_new = gaia_db
+    return analysis, None
+
+
+BUILDERS = {VECTOR_STORE: build_vector_store, GAIA_DATASET: build_gaia}
+
+
+def summarize(timings, hits):
+    timings = np.array(timings)
+    return {
+        "calls": len(timings),
+        "p50_ms": float(np.percentile(timings, 50) * 1000),
+        "p99_ms": float(np.percentile(timings, 99) * 1000),
+        "calls_per_second": float(len(timings) / timings.sum()),
+        "recall_at_k": float(np.mean(hits)),
+    }
+
+
+def exact_nearest(vectors, query, number, exclude=None):
+    distances = np.linalg.norm(vectors - query, axis=1)
+    if exclude is not None:
+        distances[exclude] = np.inf
+    number = min(number, len(distances))
+    nearest = np.argpartition(distances, number - 1)[:number]
+    return nearest[np.argsort(distances[nearest])]
+
+
+def run_backend(analysis, filenames, heads, tails, options, rng):
+    """Time the three lookups and compare what they return with exact search."""
+    neighbours = options.neighbours
+    queries = rng.choice(len(filenames), size=options.queries)
+    results = {}
+
+    timings, hits = [], []
+    for query in queries:
+        start = perf_counter()
+        found = analysis.get_neighbours(filenames[query], neighbours)
+        timings.append(perf_counter() - start)
+        exact = {
+            filenames[i]
+            for i in exact_nearest(heads, tails[query], neighbours, exclude=query)
+        }
+        hits.append(len(exact.intersection(name for _, name in found)) / len(exact))
+    results["get_neighbours"] = summarize(timings, hits)
+
+    ordered_timings, ordered_hits, best_timings, best_hits = [], [], [], []
+    for query in queries:
+        candidates = rng.choice(len(filenames), size=options.candidates, replace=False)
+        names = [filenames[i] for i in candidates]
+        exact = candidates[exact_nearest(heads[candidates], tails[query], neighbours)]
+        expected = {filenames[i] for i in exact}
+
+        start = perf_counter()
+        ordered = analysis.get_ordered_matches(filenames[query], names)
+        ordered_timings.append(perf_counter() - start)
+        found = {name for _, name in ordered[: len(expected)]}
+        ordered_hits.append(len(expected & found) / len(expected))
+
+        start = perf_counter()
+        best = analysis.get_best_match(filenames[query], names)
+        best_timings.append(perf_counter() - start)
+        best_hits.append(best == filenames[exact[0]])
+    results["get_ordered_matches"] = summarize(ordered_timings, ordered_hits)
+    results["get_best_match"] = summarize(best_timings, best_hits)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10000, 100000, 1000000]
+    )
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        choices=sorted(BUILDERS),
+        default=[VECTOR_STORE, GAIA_DATASET],
+    )
+    parser.add_argument("--dimension", type=int, default=30)
+    parser.add_argument("--clusters", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--candidates", type=int, default=100)
+    parser.add_argument("--neighbours", type=int, default=10, help="the k in recall@k")
+    parser.add_argument(
+        "--dataset-dir", default=None, help="keep generated datasets here for reuse"
+    )
+    parser.add_argument("--output", default=None, help="write the JSON here")
+    options = parser.parse_args()
+    backends = [
+        backend for backend in options.backends if backend != GAIA_DATASET or GAIA
+    ]
+    if GAIA_DATASET in options.backends and not GAIA:
+        print("gaia2 is not installed, skipping the gaia backend", file=sys.stderr)
+
+    runs = []
+    for size in options.sizes:
+        heads, tails = load_dataset(options, size)
+        filenames, names = fragment_names(len(heads))
+        vectors = np.empty((len(names), options.dimension))
+        vectors[0::2] = heads
+        vectors[1::2] = tails
+        for backend in backends:
+            print("%s: %d fragments" % (backend, len(names)), file=sys.stderr)
+            # The lookups print as they go; keep stdout for the results.
+            with redirect_stdout(sys.stderr):
+                rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                start = perf_counter()
+                analysis, vector_bytes = BUILDERS[backend](names, vectors)
+                build_seconds = perf_counter() - start
+                rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+                operations = run_backend(
+                    analysis,
+                    filenames,
+                    heads,
+                    tails,
+                    options,
+                    np.random.default_rng(options.seed),
+                )
+            runs.append(
+                {
+                    "backend": backend,
+                    "fragments": len(names),
+                    "build_seconds": build_seconds,
+                    "vector_bytes": vector_bytes,
+                    "max_rss_growth_kb": rss_growth,
+                    "operations": operations,
+                }
+            )
+            del analysis
+
+    report = {
+        "created": time(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "options": vars(options),
+        "runs": runs,
+    }
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
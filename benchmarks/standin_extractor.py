@@ -0,0 +1,150 @@
+"""Stand in for essentia's streaming_extractor_music in benchmarks.
+
+    python benchmarks/standin_extractor.py [--latency S] [--busy] audio sig.json
+
+Writes a signature with the layout and roughly the size of the real one:
+low level statistics, MFCCs, rhythm and tonal descriptors and metadata. The
+values are derived from the audio data, so different files get different
+signatures and the same file always gets the same one. --latency sets how
+long an extraction takes, sleeping by default or keeping a core busy with
+--busy, like the real extractor does.
+"""
+
+import argparse
+import hashlib
+import json
+from time import perf_counter, sleep
+
+import numpy as np
+
+SCALARS = (
+    "average_loudness",
+    "dynamic_complexity",
+    "spectral_centroid",
+    "spectral_complexity",
+    "spectral_decrease",
+    "spectral_energy",
+    "spectral_energyband_high",
+    "spectral_energyband_low",
+    "spectral_energyband_middle_high",
+    "spectral_energyband_middle_low",
+    "spectral_entropy",
+    "spectral_flux",
+    "spectral_kurtosis",
+    "spectral_rms",
+    "spectral_rolloff",
+    "spectral_skewness",
+    "spectral_spread",
+    "spectral_strongpeak",
+    "zerocrossingrate",
+    "dissonance",
+    "hfc",
+    "pitch_salience",
+    "silence_rate_20dB",
+    "silence_rate_30dB",
+    "silence_rate_60dB",
+)
+BANDS = {"barkbands": 27, "erbbands": 40, "melbands": 40, "spectral_contrast_coeffs": 6}
+KEYS = ("A", "A#", "B", "C", "C#", "D", "D#", "E", "F", "F#", "G", "G#")
+
+
+def statistics(rng, center, size=None):
+    """Get the statistics essentia reports for one descriptor."""
+    shape = () if size is None else (size,)
+    mean = center + rng.normal(scale=0.1 * np.abs(center) + 0.01, size=shape)
+    var = np.abs(rng.normal(scale=0.05 * np.abs(center) + 0.01, size=shape))
+    result = {
+        "mean": mean,
+        "var": var,
+        "min": mean - 2 * np.sqrt(var),
+        "max": mean + 2 * np.sqrt(var),
+        "median": mean + rng.normal(scale=0.01, size=shape),
+        "dmean": np.sqrt(var) / 2,
+        "dvar": var / 4,
+        "dmean2": np.sqrt(var) / 3,
+        "dvar2": var / 9,
+    }
+    return {
+        name: value.tolist() if size else float(value) for name, value in result.items()
+    }
+
+
+def signature(seed, duration):
+    rng = np.random.default_rng(seed)
+    # A few latent factors, so that some tracks sound alike.
+    style = rng.normal(size=8)
+    mixing = np.random.default_rng(0).normal(size=(len(SCALARS), 8))
+    centers = 1 + np.abs(mixing @ style)
+    lowlevel = {
+        name: statistics(rng, center) for name, center in zip(SCALARS, centers)
+    }
+    for name, size in BANDS.items():
+        lowlevel[name] = statistics(rng, 1 + abs(style[size % 8]), size)
+    mfcc = rng.normal(size=13) * 10 + style[:1] * 5
+    covariance = np.cov(rng.normal(size=(13, 40)))
+    lowlevel["mfcc"] = {
+        "mean": mfcc.tolist(),
+        "cov": covariance.tolist(),
+        "icov": np.linalg.pinv(covariance).tolist(),
+    }
+    bpm = float(60 + 120 * (1 + np.tanh(style[0])) / 2)
+    beats = np.arange(0, duration, 60 / bpm)
+    return {
+        "lowlevel": lowlevel,
+        "rhythm": {
+            "bpm": bpm,
+            "beats_count": len(beats),
+            "beats_position": beats.tolist(),
+            "beats_loudness": statistics(rng, 0.1),
+            "danceability": float(1 + np.tanh(style[1])),
+            "onset_rate": float(abs(style[2]) * 3),
+            "bpm_histogram_first_peak_bpm": statistics(rng, bpm),
+        },
+        "tonal": {
+            "key_key": KEYS[int(abs(style[3]) * 100) % len(KEYS)],
+            "key_scale": "major" if style[4] > 0 else "minor",
+            "key_strength": float(abs(np.tanh(style[5]))),
+            "chords_histogram": np.abs(rng.normal(size=24)).tolist(),
+            "chords_changes_rate": float(abs(style[6]) / 10),
+            "hpcp": statistics(rng, 0.5, 36),
+            "tuning_frequency": float(440 + rng.normal()),
+        },
+        "metadata": {
+            "audio_properties": {
+                "length": duration,
+                "sample_rate": 44100,
+                "analysis_sample_rate": 44100,
+            },
+            "tags": {"file_name": "stand-in"},
+            "version": {"essentia": "stand-in"},
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("audio")
+    parser.add_argument("signature")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--busy", action="store_true")
+    parser.add_argument("--duration", type=float, default=30.0)
+    options = parser.parse_args()
+
+    deadline = perf_counter() + options.latency
+    digest = hashlib.sha1()
+    with open(options.audio, "rb") as audio:
+        # Skip the header, which is the same for files of one format.
+        audio.seek(4096)
+        digest.update(audio.read(1 << 20))
+    result = signature(int.from_bytes(digest.digest()[:8], "big"), options.duration)
+    with open(options.signature, "w") as sig:
+        json.dump(result, sig)
+    if options.busy:
+        while perf_counter() < deadline:
+            pass
+    else:
+        sleep(max(0.0, deadline - perf_counter()))
+
+
+if __name__ == "__main__":
+    main()
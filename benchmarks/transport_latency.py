@@ -0,0 +1,99 @@
+"""Compare call latency of the similarity transports.
+
+Run the service with a socket endpoint first:
+
+    autoqueue-similarity-service --socket
+
+and then:
+
+    python benchmarks/transport_latency.py /path/to/analyzed/song.mp3
+
+For every transport that can be reached this times sequential calls (one
+round trip at a time) and, for the socket transport, pipelined calls
+(everything sent before the first reply is read).
+"""
+
+import argparse
+import json
+import sys
+from time import perf_counter
+
+import numpy as np
+
+from autoqueue.transport import DBUS, EMBEDDED, SOCKET, connect
+
+
+def time_sequential(similarity, call, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        call(similarity)
+        timings.append(perf_counter() - start)
+    return timings
+
+
+def time_pipelined(similarity, name, args, repeat):
+    start = perf_counter()
+    futures = [similarity.submit(name, args) for _ in range(repeat)]
+    for future in futures:
+        future.result()
+    return (perf_counter() - start) / repeat
+
+
+def summarize(timings):
+    return {
+        "p50_ms": float(np.percentile(timings, 50) * 1000),
+        "p99_ms": float(np.percentile(timings, 99) * 1000),
+        "calls_per_second": len(timings) / sum(timings),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("filename", help="an analyzed track to look up")
+    parser.add_argument("--number", type=int, default=40)
+    parser.add_argument("--repeat", type=int, default=500)
+    parser.add_argument("--socket", default=None, help="socket path to connect to")
+    parser.add_argument(
+        "--transports",
+        nargs="+",
+        default=[DBUS, SOCKET],
+        choices=[DBUS, SOCKET, EMBEDDED],
+        help="transports to compare; embedded opens the databases in this process",
+    )
+    options = parser.parse_args()
+
+    calls = {
+        "has_gaia": lambda similarity: similarity.has_gaia(),
+        "get_ordered_gaia_tracks": lambda similarity: (
+            similarity.get_ordered_gaia_tracks(options.filename, options.number)
+        ),
+    }
+    report = {}
+    for transport in options.transports:
+        try:
+            similarity = connect(transport, path=options.socket)
+        except Exception as e:
+            print("%s: unavailable (%r)" % (transport, e), file=sys.stderr)
+            continue
+        for name, call in calls.items():
+            report["%s %s" % (transport, name)] = summarize(
+                time_sequential(similarity, call, options.repeat)
+            )
+        if transport == SOCKET:
+            seconds = time_pipelined(
+                similarity,
+                "get_ordered_gaia_tracks",
+                (options.filename, options.number),
+                options.repeat,
+            )
+            report["socket pipelined get_ordered_gaia_tracks"] = {
+                "mean_ms": seconds * 1000,
+                "calls_per_second": 1 / seconds,
+            }
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
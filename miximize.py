@@ -1,5 +1,7 @@
 """Add selected songs to the queue in ideal order."""
 
+from uuid import uuid4
+
 import dbus
 from dbus.mainloop.glib import DBusGMainLoop
 from quodlibet import _, app
@@ -32,22 +34,59 @@ class MiximizePlugin(SongsMenuPlugin):
                     " acoustic similarity.")
     PLUGIN_ICON = "gtk-find-and-replace"
     PLUGIN_VERSION = "0.1"
+    _matches = ()
 
     def player_enqueue(self, indices):
         """Put the song at the end of the queue."""
         app.window.playlist.enqueue([self._songs[index] for index in indices])
         self._songs = None
 
+    def chunk_received(self, token, indices, done):
+        """Queue the next stretch of the ordering as soon as it arrives."""
+        if token != self._token:
+            return
+        app.window.playlist.enqueue([self._songs[index] for index in indices])
+        self._queued.update(indices)
+        if done:
+            self.stop_listening()
+
+    def ordering_failed(self, token, message):
+        """Queue the songs that were not queued yet, in the selected order."""
+        if token != self._token:
+            return
+        print(message)
+        app.window.playlist.enqueue([
+            song for index, song in enumerate(self._songs)
+            if index not in self._queued])
+        self.stop_listening()
+
+    def stop_listening(self):
+        """Stop listening for the signals of the current ordering."""
+        self._songs = None
+        for match in self._matches:
+            match.remove()
+        self._matches = ()
+
     def plugin_songs(self, songs):
         """Send songs to dbus similarity service."""
         bus = dbus.SessionBus()
         self._songs = songs
+        self._queued = set()
+        self._token = str(uuid4())
         sim = bus.get_object(
             'org.autoqueue', '/org/autoqueue/Similarity',
             follow_name_owner_changes=True)
         similarity = dbus.Interface(
             sim, dbus_interface='org.autoqueue.SimilarityInterface')
         print([song['~filename'] for song in songs])
-        similarity.miximize(
-            [song['~filename'] for song in songs],
-            reply_handler=self.player_enqueue, error_handler=no_op)
+        # Stop listening for the chunks of an ordering that was replaced.
+        for match in self._matches:
+            match.remove()
+        self._matches = (
+            similarity.connect_to_signal(
+                'miximize_chunk', self.chunk_received),
+            similarity.connect_to_signal(
+                'miximize_failed', self.ordering_failed))
+        similarity.miximize_streaming(
+            self._token, [song['~filename'] for song in songs],
+            reply_handler=no_op, error_handler=no_op)
@@ -17,10 +17,12 @@ from quodlibet import _, app, config
 from quodlibet.plugins import PluginConfig, PluginConfigMixin
 from quodlibet.plugins.events import EventPlugin
 from quodlibet.qltk.entry import UndoEntry
+from quodlibet.query import Query
 from quodlibet.util import copool
 
 from autoqueue import AutoQueueBase
 from autoqueue.player import PlayerBase, SongBase
+from autoqueue.transport import DBUS, TRANSPORTS
 
 INT_SETTINGS = {
     "desired_queue_length": {"value": 4440, "label": "queue (seconds)"},
@@ -49,6 +51,14 @@ STR_SETTINGS = {
     "geohash": {"value": "", "label": "geohash (see geohash.org)"},
     "extra_context": {"value": "", "label": "extra context"},
     "owm_api_key": {"value": "", "label": "API key for openweathermap"},
+    "transport": {
+        "value": DBUS,
+        "label": "similarity transport: %s (needs a restart)" % ", ".join(TRANSPORTS),
+    },
+    "socket_path": {
+        "value": "",
+        "label": "similarity service socket, for the socket transport",
+    },
 }
 
 
@@ -187,6 +197,41 @@ class Song(SongBase):
             return None
 
 
+class SongIndex(object):
+    """The songs in the library by filename, kept up to date by its events."""
+
+    def __init__(self):
+        self.songs = None
+        # Filenames by song, so renamed songs can be found under their old name.
+        self.filenames = {}
+
+    def get_songs(self):
+        if self.songs is None:
+            self.songs = {}
+            self.add(app.library.values())
+        return self.songs
+
+    def add(self, songs):
+        if self.songs is None:
+            # Not built yet, and it will have these songs when it is.
+            return
+        for song in songs:
+            old_filename = self.filenames.get(id(song))
+            if old_filename is not None and self.songs.get(old_filename) is song:
+                del self.songs[old_filename]
+            filename = song("~filename")
+            self.songs[filename] = song
+            self.filenames[id(song)] = filename
+
+    def remove(self, songs):
+        if self.songs is None:
+            return
+        for song in songs:
+            filename = self.filenames.pop(id(song), None)
+            if filename is not None and self.songs.get(filename) is song:
+                del self.songs[filename]
+
+
 class AutoQueue(AutoQueueBase, EventPlugin, PluginConfigMixin):
     """The actual plugin class."""
 
@@ -198,7 +243,16 @@ class AutoQueue(AutoQueueBase, EventPlugin, PluginConfigMixin):
 
     def __init__(self):
         self._enabled = False
-        AutoQueueBase.__init__(self, Player())
+        transport = self.config_get("transport", default=DBUS)
+        if transport not in TRANSPORTS:
+            print("unknown similarity transport %r, using %s" % (transport, DBUS))
+            transport = DBUS
+        AutoQueueBase.__init__(
+            self,
+            Player(),
+            transport=transport,
+            socket_path=self.config_get("socket_path", default="") or None,
+        )
         self._generators = deque()
         self.configuration.desired_queue_length = config.getint(
             "plugins", "autoqueue_desired_queue_length", default=900
@@ -249,8 +303,17 @@ class AutoQueue(AutoQueueBase, EventPlugin, PluginConfigMixin):
         ssong = Song(song)
         GLib.idle_add(self.on_song_started, ssong)
 
+    def plugin_on_added(self, songs):
+        """Triggered when songs are added to the library."""
+        self.player.index.add(songs)
+
+    def plugin_on_changed(self, songs):
+        """Triggered when songs in the library change, or are renamed."""
+        self.player.index.add(songs)
+
     def plugin_on_removed(self, songs):
         """Triggered when songs are removed from the library."""
+        self.player.index.remove(songs)
         GLib.idle_add(self.on_removed, [Song(s) for s in songs])
 
     def PluginPreferences(self, parent):
@@ -291,6 +354,10 @@ class AutoQueue(AutoQueueBase, EventPlugin, PluginConfigMixin):
 
 
 class Player(PlayerBase):
+    def __init__(self):
+        self.index = SongIndex()
+        self.restrictions = {}
+
     def execute_async(self, method, *args, **kwargs):
         """Execute a method asynchronously."""
         if "funcid" not in kwargs:
@@ -394,6 +461,26 @@ class Player(PlayerBase):
             return []
         return [Song(song) for song in songs]
 
+    def search_files(self, filenames, restrictions=None):
+        """Look up the songs with these filenames in the index."""
+        songs = self.index.get_songs()
+        query = None
+        if restrictions:
+            query = self.restrictions.get(restrictions)
+            if query is None:
+                try:
+                    query = Query(restrictions)
+                except Exception as e:
+                    print(repr(restrictions), repr(e))
+                    return []
+                self.restrictions[restrictions] = query
+        found = []
+        for filename in filenames:
+            song = songs.get(filename)
+            if song is not None and (query is None or query.search(song)):
+                found.append(Song(song))
+        return found
+
     def get_songs_in_queue(self):
         """Return (wrapped) song objects for the songs in the queue."""
         if app.window is None:
@@ -19,6 +19,7 @@ setup(
     author_email="thisfred@gmail.com",
     url="https://launchpad.net/autoqueue",
     install_requires=[
+        "numpy",
         "python-dateutil",
         "pygeohash",
         "pylast",